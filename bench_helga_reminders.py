@@ -0,0 +1,359 @@
+"""
+Benchmarks for helga-reminders. Everything runs in process against a twisted
+Clock in place of the reactor. Usage::
+
+    python bench_helga_reminders.py scale [--sizes 10000,100000,1000000] [--output FILE]
+    python bench_helga_reminders.py burst [--count N] [--round-trip MS]
+    python bench_helga_reminders.py parse [--count N]
+    python bench_helga_reminders.py memory [--size N]
+
+``scale`` stores the given numbers of reminders in the memory backend and measures
+insert throughput, startup, listing latency, fire throughput and peak memory at
+each size. Each size runs in its own process so peak memory is not shared, and the
+results are written to a JSON file for comparison between releases.
+
+``burst`` fires a burst of reminders against a fake MongoDB collection that sleeps
+for a fixed round trip on every call, one at a time and batched.
+
+``parse`` measures how many commands of each form the grammar parses per second.
+
+``memory`` measures the bytes each pending reminder costs in the scheduler's
+cache, held as stored documents and as compact Reminder records.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import platform
+import resource
+import time
+
+from mock import Mock, patch
+from twisted.internet.task import Clock
+
+import helga_reminders as reminders
+
+
+class FakeCollection(object):
+    """
+    Just enough of a pymongo collection for the fire path. Every call costs one
+    simulated round trip
+    """
+
+    def __init__(self, round_trip):
+        self.round_trip = round_trip
+        self.docs = {}
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        time.sleep(self.round_trip)
+
+    def find(self, query=None):
+        self._call()
+        ids = set(query['_id']['$in'])
+        return [doc for _id, doc in self.docs.iteritems() if _id in ids]
+
+    def bulk_write(self, requests, ordered=True):
+        self._call()
+
+
+class CountingClient(object):
+    """
+    A helga client that only counts what it is asked to send
+    """
+
+    def __init__(self):
+        self.sent = 0
+
+    def msg(self, channel, message):
+        self.sent += 1
+
+    def me(self, channel, message):
+        pass
+
+
+class CountingQueue(reminders.DeliveryQueue):
+    """
+    A delivery queue that never throttles and counts the messages put on it
+    """
+
+    def __init__(self, clock):
+        super(CountingQueue, self).__init__(clock=clock, rate=1e9, burst=1e9)
+        self.puts = 0
+
+    def put(self, client, channel, message, coalesce=True):
+        self.puts += 1
+        super(CountingQueue, self).put(client, channel, message, coalesce)
+
+
+def bench_fire_burst(count, round_trip, tolerance):
+    """
+    Fire ``count`` reminders whose deadlines are spread over the same second and
+    return (seconds, database calls)
+    """
+    collection = FakeCollection(round_trip)
+    clock = Clock()
+    scheduler = reminders.Scheduler(clock=clock, tolerance=tolerance)
+    # Database calls go through a thread pool that only reports back through a running
+    # reactor, so run them inline or the Clock-driven fire path never sees a result
+    store = reminders.ReminderStore(reminders.MongoBackend(), inline=True)
+    client = Mock()
+    when = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+
+    with patch.object(reminders, '_scheduler', scheduler), \
+            patch.object(reminders, '_store', store), \
+            patch.object(reminders, '_delivery', reminders.DeliveryQueue(clock=clock)), \
+            patch.object(reminders, 'db', Mock(reminders=collection)), \
+            patch.object(reminders, '_cache', {}):
+        for i in xrange(count):
+            reminder = {'_id': i, 'when': when, 'channel': '#bots', 'message': 'standup'}
+            collection.docs[i] = reminder
+            reminders._schedule_reminder(reminders.Reminder.from_doc(reminder), 1 + float(i) / count, client)
+
+        # Step the clock the way the reactor would see time pass
+        start = time.time()
+        for _ in xrange(2000):
+            clock.advance(0.001)
+        elapsed = time.time() - start
+
+    return elapsed, collection.calls
+
+
+# Representative commands for each rule of the grammar
+parse_samples = (
+    ('in', reminders._parse_in_args, ['12m', 'take', 'out', 'the', 'trash']),
+    ('in on channel', reminders._parse_in_args, ['12h', 'on', 'work', 'submit', 'timesheet']),
+    ('at', reminders._parse_at_args, ['13:00', 'standup', 'time']),
+    ('at timezone repeat', reminders._parse_at_args,
+     ['13:00', 'US/Eastern', 'on', '#work', 'standup', 'time', 'repeat', 'MTuWThF']),
+    ('at cron', reminders._parse_at_args,
+     ['09:00', 'standup', 'repeat', 'cron', '*/30', '9-17', '*', '*', '1-5']),
+    ('list', reminders._parse_list_args, ['#work', 'page', '2']),
+)
+
+
+def bench_parse(count):
+    """
+    Parse each sample command ``count`` times and return [(label, parses per second)]
+    """
+    results = []
+    for label, parse, args in parse_samples:
+        start = time.time()
+        for _ in xrange(count):
+            parse(args, '#bots')
+        elapsed = time.time() - start
+        results.append((label, count / elapsed if elapsed else None))
+    return results
+
+
+def _doc(i, channels=100):
+    return {
+        '_id': reminders.objectid.ObjectId(),
+        'when': datetime.datetime(2015, 1, 1) + datetime.timedelta(seconds=i),
+        'channel': u'#chan{0}'.format(i % channels),
+        'message': u'standup for team {0}'.format(i),
+        'creator': u'me',
+        'repeat': [0, 1, 2, 3, 4],
+        'timezone': 'US/Eastern',
+    }
+
+
+def bench_memory(size, form):
+    """
+    The bytes per pending reminder of a cache of ``size`` reminders held as
+    ``form``: 'documents' as loaded from the database, 'records' as Reminder records
+    that keep their message, or 'compact' as records loaded without it
+    """
+    convert = {
+        'documents': lambda doc: doc,
+        'records': reminders.Reminder.from_doc,
+        'compact': lambda doc: reminders.Reminder.from_doc(doc, message=False),
+    }[form]
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cache = {}
+    for i in xrange(size):
+        reminder = convert(_doc(i))
+        cache[reminder['_id'] if form == 'documents' else reminder._id] = reminder
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in kilobytes on Linux
+    return (after - before) * 1024.0 / size
+
+
+def _bench_memory_child(size, form, results):
+    results.put(bench_memory(size, form))
+
+
+def run_memory(size):
+    """
+    Run bench_memory for each form in a fresh process
+    """
+    results = []
+    for form in ('documents', 'records', 'compact'):
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(target=_bench_memory_child, args=(size, form, queue))
+        child.start()
+        results.append((form, queue.get()))
+        child.join()
+    return results
+
+
+def _timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def _median(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2]
+
+
+def bench_scale(size, channels=100, list_samples=20):
+    """
+    Measure the plugin holding ``size`` reminders, split evenly between one-time
+    reminders made with 'in' and daily repeats made with 'at', and return a dict
+    of results. Times are in seconds unless the key says otherwise
+    """
+    clock = Clock()
+    backend = reminders.MemoryBackend()
+    client = CountingClient()
+    delivery = CountingQueue(clock)
+    result = {'size': size}
+
+    with patch.object(reminders, '_store', reminders.ReminderStore(backend, inline=True)), \
+            patch.object(reminders, '_scheduler', reminders.Scheduler(clock=Clock(), tolerance=1)), \
+            patch.object(reminders, '_delivery', delivery), \
+            patch.object(reminders, '_cache', {}), \
+            patch.object(reminders, '_coordinator', None), \
+            patch.object(reminders, '_refill', None), \
+            patch.object(reminders, '_horizon_end', None), \
+            patch.object(reminders, '_horizon', return_value=datetime.timedelta(hours=48)), \
+            patch.object(reminders, 'task'):
+
+        half = size // 2
+
+        def insert_in():
+            for i in xrange(half):
+                args = ['{0}m'.format(i % 1440 + 1), 'on', '#chan{0}'.format(i % channels), 'standup']
+                reminders.in_reminder(client, '#bots', 'me', args)
+
+        def insert_at():
+            for i in xrange(size - half):
+                minute = i % 1440
+                args = ['{0:02d}:{1:02d}'.format(minute // 60, minute % 60), 'UTC',
+                        'on', '#chan{0}'.format(i % channels), 'standup', 'repeat', 'MTuWThFSaSu']
+                reminders.at_reminder(client, '#bots', 'me', args)
+
+        elapsed = _timed(insert_in)
+        result['insert_in_per_s'] = half / elapsed if elapsed else None
+        elapsed = _timed(insert_at)
+        result['insert_at_per_s'] = (size - half) / elapsed if elapsed else None
+
+        # Start over from what is in the database, the way a restart would. The
+        # inserts were scheduled on a clock that is never advanced
+        reminders._scheduler = reminders.Scheduler(clock=clock, tolerance=1)
+        reminders._cache.clear()
+        result['startup'] = _timed(reminders.init_reminders, client)
+        result['scheduled'] = len(reminders._scheduler)
+
+        last_page = max(1, -(-size // channels) // getattr(reminders.settings, 'REMINDERS_LIST_PAGE_SIZE', 10))
+        for key, page in (('list_first_page_ms', 1), ('list_last_page_ms', last_page)):
+            samples = [_timed(reminders.list_reminders, client, 'me', '#chan0', page) for _ in xrange(list_samples)]
+            result[key] = _median(samples) * 1000
+        delivery.puts = 0
+
+        # Step a day through the clock a second at a time
+        start = time.time()
+        for _ in xrange(86400):
+            clock.advance(1)
+        elapsed = time.time() - start
+
+        result['fired'] = delivery.puts
+        result['fire_per_s'] = delivery.puts / elapsed if elapsed else None
+
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def _bench_scale_child(size, results):
+    results.put(bench_scale(size))
+
+
+def run_scale(sizes):
+    """
+    Run bench_scale for each size in a fresh process
+    """
+    results = []
+    for size in sizes:
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(target=_bench_scale_child, args=(size, queue))
+        child.start()
+        results.append(queue.get())
+        child.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark helga-reminders')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    scale = subparsers.add_parser('scale', help='measure the plugin at several collection sizes')
+    scale.add_argument('--sizes', default='10000,100000,1000000', help='comma separated reminder counts')
+    scale.add_argument('--output', default='bench-results.json', help='where to write the JSON results')
+
+    burst = subparsers.add_parser('burst', help='fire a burst of reminders against a slow database')
+    burst.add_argument('--count', type=int, default=1000, help='reminders in the burst')
+    burst.add_argument('--round-trip', type=float, default=0.5, help='simulated database round trip in ms')
+
+    parse = subparsers.add_parser('parse', help='measure command parsing throughput')
+    parse.add_argument('--count', type=int, default=100000, help='parses of each sample command')
+
+    memory = subparsers.add_parser('memory', help='measure the memory each pending reminder takes')
+    memory.add_argument('--size', type=int, default=1000000, help='pending reminders')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'memory':
+        print 'Bytes per pending reminder with {0} pending'.format(args.size)
+        for form, size in run_memory(args.size):
+            print '  {0:<10} {1:>8.0f}'.format(form, size)
+        return
+
+    if args.benchmark == 'parse':
+        print 'Parsing each command {0} times'.format(args.count)
+        for label, rate in bench_parse(args.count):
+            print '  {0:<20} {1:>10.0f}/s'.format(label, rate)
+        return
+
+    if args.benchmark == 'burst':
+        round_trip = args.round_trip / 1000.0
+
+        print 'Fire burst of {0} reminders, {1}ms per database call'.format(args.count, args.round_trip)
+        for label, tolerance in (('one at a time', 0), ('batched', 1)):
+            elapsed, calls = bench_fire_burst(args.count, round_trip, tolerance)
+            print '  {0:<14} {1:>8.1f}ms {2:>6} db calls'.format(label, elapsed * 1000, calls)
+        return
+
+    results = run_scale(int(size) for size in args.sizes.split(','))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'python': platform.python_version(),
+            'time': datetime.datetime.utcnow().isoformat(),
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+
+    print '{0:>9} {1:>10} {2:>10} {3:>9} {4:>9} {5:>9} {6:>10} {7:>10}'.format(
+        'size', 'in/s', 'at/s', 'startup', 'list ms', 'last ms', 'fire/s', 'peak MB')
+    for r in results:
+        print '{0:>9} {1:>10.0f} {2:>10.0f} {3:>8.2f}s {4:>9.2f} {5:>9.2f} {6:>10.0f} {7:>10.1f}'.format(
+            r['size'], r['insert_in_per_s'], r['insert_at_per_s'], r['startup'], r['list_first_page_ms'],
+            r['list_last_page_ms'], r['fire_per_s'], r['peak_rss_kb'] / 1024.0)
+    print 'Results written to {0}'.format(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,170 +1,2094 @@
+import argparse
+import bisect
+import copy
+import cProfile
 import datetime
+import functools
+import json
+import os
+import pstats
+import random
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+from collections import defaultdict, deque, OrderedDict
 
-from itertools import ifilter, imap
+import pytz
+import smokesignal
+
+from bson import objectid
+from pymongo import ASCENDING, DESCENDING, DeleteMany, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from twisted.internet import defer, reactor, task, threads
+from twisted.python.threadpool import ThreadPool
+
+from helga import log, settings
+from helga.db import db
+from helga.plugins import command, random_ack, ResponseNotReady
+
+from helga_reminders_scheduler import Scheduler
+
+
+logger = log.getLogger(__name__)
+
+
+in_seconds_map = {
+    'm': 60,
+    'h': 3600,
+    'd': 86400,
+}
+
+# This is how python datetime does it
+days_of_week = {
+    'M':  0,
+    'Tu': 1,
+    'W':  2,
+    'Th': 3,
+    'F':  4,
+    'Sa': 5,
+    'Su': 6,
+}
+days_of_week_lookup = dict((v, k) for k, v in days_of_week.iteritems())
+
+# _day_deltas[dow][mask] is the number of days from weekday dow, starting tomorrow, until
+# the next weekday set in the 7-bit repeat mask. An empty mask has no next day and maps to 0
+_day_deltas = [
+    [0] + [next(delta for delta in xrange(1, 8) if mask & (1 << ((dow + delta) % 7)))
+           for mask in xrange(1, 128)]
+    for dow in xrange(7)
+]
+
+
+def _lru_cache(maxsize=128):
+    """
+    Memoize a single argument function, keeping the ``maxsize`` most recently used
+    results. Python 2 has no functools.lru_cache
+    """
+    def decorator(func):
+        cache = OrderedDict()
+
+        @functools.wraps(func)
+        def wrapper(key):
+            try:
+                value = cache.pop(key)
+            except KeyError:
+                value = func(key)
+                if len(cache) >= maxsize:
+                    cache.popitem(last=False)
+            cache[key] = value
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+class DeliveryQueue(object):
+    """
+    Sits between firing reminders and ``client.msg`` so a burst of reminders can't
+    flood a channel. Each channel gets a token bucket that refills at ``rate``
+    messages per second up to ``burst``. Messages queued for the same channel
+    before a flush are packed together into as few lines as fit in ``line_limit``
+    characters, and whatever the bucket can't cover yet is sent once it refills.
+
+    ``depth`` and ``lag`` report how much is waiting and for how long, and
+    ``last_lag`` is how long the most recently delivered line had waited.
+    """
+
+    separator = u' | '
+
+    def __init__(self, clock=None, rate=1, burst=4, line_limit=400):
+        self.clock = clock
+        self.rate = float(rate)
+        self.burst = burst
+        self.line_limit = line_limit
+        self.last_lag = 0
+        self._pending = {}
+        self._tokens = {}
+        self._timers = {}
+
+    @property
+    def _clock(self):
+        return self.clock or reactor
+
+    @property
+    def depth(self):
+        return sum(len(queue) for queue in self._pending.itervalues())
+
+    @property
+    def lag(self):
+        oldest = [queue[0][0] for queue in self._pending.itervalues()]
+        return self._clock.seconds() - min(oldest) if oldest else 0
+
+    def put(self, client, channel, message, coalesce=True):
+        """
+        Queue a message for a channel. Nothing is sent until the next flush. Messages
+        queued with ``coalesce=False`` are always sent on a line of their own
+        """
+        if channel not in self._pending:
+            self._pending[channel] = deque()
+        self._pending[channel].append((self._clock.seconds(), client, message, coalesce))
+
+    def flush(self):
+        """
+        Send everything the channels' token buckets allow right now
+        """
+        for channel in self._pending.keys():
+            if channel not in self._timers:
+                self._flush(channel)
+
+    def _take_token(self, channel, now):
+        """
+        Take a token from the channel's bucket. Returns 0 on success, otherwise the
+        number of seconds until a token will be available
+        """
+        tokens, updated = self._tokens.get(channel, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+        if tokens < 1:
+            self._tokens[channel] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+        self._tokens[channel] = (tokens - 1, now)
+        return 0
+
+    def _flush(self, channel):
+        self._timers.pop(channel, None)
+        queue = self._pending[channel]
+        now = self._clock.seconds()
+
+        while queue:
+            wait = self._take_token(channel, now)
+            if wait:
+                self._timers[channel] = self._clock.callLater(wait, self._flush, channel)
+                return
+
+            queued_at, client, line, coalesce = queue.popleft()
+            while coalesce and queue and queue[0][1] is client and queue[0][3]:
+                message = queue[0][2]
+                if len(line) + len(self.separator) + len(message) > self.line_limit:
+                    break
+                line = self.separator.join((line, message))
+                queue.popleft()
+
+            client.msg(channel, line)
+            self.last_lag = now - queued_at
+
+        del self._pending[channel]
+
+
+class StatsdSink(object):
+    """
+    Sends metrics to a statsd server over UDP. Failures to send are ignored
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='helga.reminders'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, name, value, kind):
+        try:
+            self.socket.sendto('{0}.{1}:{2}|{3}'.format(self.prefix, name, value, kind), self.address)
+        except socket.error:
+            pass
+
+    def incr(self, name, count=1):
+        self._send(name, count, 'c')
+
+    def timing(self, name, ms):
+        self._send(name, int(round(ms)), 'ms')
+
+    def gauge(self, name, value):
+        self._send(name, value, 'g')
+
+
+class MemorySink(object):
+    """
+    Records every metric sent to it as a (kind, name, value) tuple. Useful for tests
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def incr(self, name, count=1):
+        self.sent.append(('incr', name, count))
+
+    def timing(self, name, ms):
+        self.sent.append(('timing', name, ms))
+
+    def gauge(self, name, value):
+        self.sent.append(('gauge', name, value))
+
+
+class Metrics(object):
+    """
+    Counters, a fire lag histogram and database timings for ``reminders stats``.
+    Everything recorded is also passed on to ``sink``, which can be a StatsdSink,
+    a MemorySink or anything else with the same three methods.
+    """
+
+    # Upper bounds, in seconds, of the fire lag histogram buckets
+    lag_buckets = (0.1, 0.5, 1, 5, 30, 60, 300)
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.reset()
+
+    def reset(self):
+        self.counters = defaultdict(int)
+        self.lag = [0] * (len(self.lag_buckets) + 1)
+        self.max_lag = 0
+
+        # name -> [calls, total seconds, slowest seconds]
+        self.timings = {}
+
+    def _forward(self, method, *args):
+        if self.sink is not None:
+            try:
+                getattr(self.sink, method)(*args)
+            except Exception:
+                logger.exception('Could not send metric %s', args[0])
+
+    def incr(self, name, count=1):
+        if count:
+            self.counters[name] += count
+            self._forward('incr', name, count)
+
+    def fire_lag(self, seconds):
+        seconds = max(seconds, 0)
+        self.lag[bisect.bisect_left(self.lag_buckets, seconds)] += 1
+        self.max_lag = max(self.max_lag, seconds)
+        self._forward('timing', 'fire_lag', seconds * 1000)
+
+    def timing(self, name, seconds):
+        timing = self.timings.setdefault(name, [0, 0, 0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+        self._forward('timing', name, seconds * 1000)
+
+    def gauge(self, name, value):
+        self._forward('gauge', name, value)
+
+    def lag_histogram(self):
+        """
+        (label, count) for each non-empty fire lag bucket
+        """
+        labels = ['<{0}s'.format(bound) for bound in self.lag_buckets]
+        labels.append('>={0}s'.format(self.lag_buckets[-1]))
+        return [(label, count) for label, count in zip(labels, self.lag) if count]
+
+
+class Profiler(object):
+    """
+    Runs a random ``sample_rate`` fraction of calls to functions wrapped with
+    ``profiled`` under cProfile while enabled. The samples are merged into one set
+    of stats, written to ``path`` in pstats format every ``interval`` seconds and
+    when profiling is turned off.
+
+    Only the time spent before a function returns is profiled. Database calls
+    that finish later in the thread pool are covered by the db timings in Metrics.
+    """
+
+    def __init__(self, sample_rate=0.1, path='reminders.prof', interval=300, clock=None):
+        self.sample_rate = sample_rate
+        self.path = path
+        self.interval = interval
+        self.clock = clock
+        self.enabled = False
+        self.samples = 0
+        self.stats = None
+        self._dumps = None
+        self._active = False
+
+    def profiled(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # cProfile can't profile inside another profiled call
+            if not self.enabled or self._active or random.random() >= self.sample_rate:
+                return func(*args, **kwargs)
+
+            profile = cProfile.Profile()
+            self._active = True
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                self._active = False
+                self._add(profile)
+        return wrapper
+
+    def _add(self, profile):
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+        self.samples += 1
+
+    def start(self, sample_rate=None):
+        """
+        Start sampling from scratch, optionally at a new rate
+        """
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+
+        self.stop(dump=False)
+        self.enabled = True
+        self.samples = 0
+        self.stats = None
+
+        self._dumps = task.LoopingCall(self.dump)
+        if self.clock is not None:
+            self._dumps.clock = self.clock
+        self._dumps.start(self.interval, now=False).addErrback(_log_failure, 'Profile dumps stopped')
+
+    def stop(self, dump=True):
+        if self._dumps is not None and self._dumps.running:
+            self._dumps.stop()
+        self._dumps = None
+        self.enabled = False
+
+        if dump:
+            self.dump()
+
+    def dump(self):
+        if self.stats is not None:
+            self.stats.dump_stats(self.path)
+
+
+# The only fields needed to list reminders
+list_fields = ('_id', 'when', 'channel', 'message', 'repeat')
+
+
+def _targets(channel):
+    """
+    The channels and nicks a stored 'channel' delivers to. Fan-out reminders store
+    a list of them
+    """
+    return channel if isinstance(channel, (list, tuple)) else [channel]
+
+
+def _project(doc):
+    return dict((field, doc[field]) for field in list_fields if field in doc)
+
+
+class MongoBackend(object):
+    """
+    Stores reminders in the ``reminders`` collection of helga's MongoDB database.
+    This is the default backend.
+    """
+
+    blocking = True
+    leases = True
+
+    @property
+    def available(self):
+        return db is not None
+
+    @property
+    def collection(self):
+        return db.reminders
+
+    @property
+    def history_collection(self):
+        return db.reminders_history
+
+    def ensure_indexes(self):
+        self.collection.create_index('when')
+        # Multikey, so fan-out reminders are listed under each of their targets
+        self.collection.create_index([('channel', ASCENDING), ('when', ASCENDING)])
+        self.collection.create_index('creator')
+        self.collection.create_index([('partition', ASCENDING), ('when', ASCENDING)])
+        self.collection.create_index('lease.owner')
+
+        # MongoDB expires history in the background
+        ttl = _history_ttl()
+        if ttl:
+            self.history_collection.create_index('archived', expireAfterSeconds=int(ttl.total_seconds()))
+        self.history_collection.create_index([('channel', ASCENDING), ('archived', DESCENDING)])
+
+    def _uses_index(self, plan):
+        if plan.get('stage') == 'COLLSCAN':
+            return False
+        children = plan.get('inputStages', []) + [plan[key] for key in ('inputStage', 'queryPlan') if key in plan]
+        return all(self._uses_index(child) for child in children)
+
+    def explain(self):
+        now = datetime.datetime.utcnow()
+        cursors = {
+            'due': self.collection.find({'when': {'$gte': now, '$lt': now}}),
+            'for_channel': self.collection.find({'channel': ''}).sort('when', ASCENDING),
+            'get_many': self.collection.find({'_id': {'$in': []}}),
+        }
+        return dict((name, self._uses_index(cursor.explain()['queryPlanner']['winningPlan']))
+                    for name, cursor in cursors.iteritems())
+
+    def insert(self, reminder):
+        return self.collection.insert(reminder)
+
+    def insert_many(self, reminders):
+        for reminder in reminders:
+            reminder.setdefault('_id', objectid.ObjectId())
+
+        try:
+            return len(self.collection.insert_many(reminders, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            # Reminders that are already stored are skipped, anything else is an error
+            if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                raise
+            return e.details['nInserted']
+
+    def scan(self, batch_size=1000):
+        return self.collection.find().sort('_id', ASCENDING).batch_size(batch_size)
+
+    def get(self, reminder_id):
+        return self.collection.find_one({'_id': reminder_id})
+
+    def get_many(self, reminder_ids):
+        return list(self.collection.find({'_id': {'$in': reminder_ids}}))
+
+    def due(self, end, start=None):
+        query = {'$lt': end}
+        if start is not None:
+            query['$gte'] = start
+        return list(self.collection.find({'when': query}))
+
+    def for_channel(self, channel, skip=0, limit=0):
+        fields = dict((field, True) for field in list_fields)
+        cursor = self.collection.find({'channel': channel}, fields).sort('when', 1)
+        return list(cursor.skip(skip).limit(limit))
+
+    def save(self, reminder):
+        self.collection.save(reminder)
+
+    def remove(self, reminder_id):
+        self.collection.remove(reminder_id)
+
+    def update(self, reminder_id, fields):
+        return self.collection.find_one_and_update({'_id': reminder_id}, {'$set': fields},
+                                                   return_document=ReturnDocument.AFTER)
+
+    def bulk_update(self, updates, removed, history=()):
+        requests = [UpdateOne({'_id': reminder_id}, {'$set': fields}) for reminder_id, fields in updates]
+        if removed:
+            requests.append(DeleteMany({'_id': {'$in': removed}}))
+
+        if requests:
+            self.collection.bulk_write(requests, ordered=False)
+        if history:
+            self.history_collection.insert_many(history, ordered=False)
+
+    def history(self, channel, limit):
+        cursor = self.history_collection.find({'channel': channel}).sort('archived', DESCENDING)
+        return list(cursor.limit(limit))
+
+    def heartbeat(self, node_id, expires, now):
+        db.reminder_nodes.update_one({'_id': node_id}, {'$set': {'expires': expires}}, upsert=True)
+        return [node['_id'] for node in db.reminder_nodes.find({'expires': {'$gt': now}}).sort('_id', ASCENDING)]
+
+    def renew(self, node_id, reminder_ids, expires):
+        query = {'_id': {'$in': reminder_ids}, 'lease.owner': node_id}
+        self.collection.update_many(query, {'$set': {'lease.expires': expires}})
+        return [doc['_id'] for doc in self.collection.find(query, {'_id': True})]
+
+    def release(self, node_id, reminder_ids):
+        self.collection.update_many({'_id': {'$in': reminder_ids}, 'lease.owner': node_id},
+                                    {'$set': {'lease': None}})
+
+    def claim(self, node_id, partitions, end, now, expires):
+        query = {
+            'when': {'$lt': end},
+            'partition': {'$in': partitions},
+            '$or': [
+                {'lease': None},
+                {'lease.expires': {'$lt': now}},
+                # Our own leases that were not renewed this round, e.g. from before a restart
+                {'lease.owner': node_id, 'lease.expires': {'$lt': expires}},
+            ],
+        }
+        update = {'$set': {'lease': {'owner': node_id, 'expires': expires}}}
+
+        claimed = []
+        while True:
+            doc = self.collection.find_one_and_update(query, update, return_document=ReturnDocument.AFTER)
+            if doc is None:
+                return claimed
+            claimed.append(doc)
+
+
+class MemoryBackend(object):
+    """
+    Keeps reminders in a dict for the life of the process. Nothing survives a
+    restart, so this is only suitable for small deployments and tests.
+    """
+
+    blocking = False
+    available = True
+    leases = True
+
+    def __init__(self):
+        self.docs = {}
+        self.nodes = {}
+        # History in the order it was archived, so expiry only ever trims the front
+        self.archive = deque()
+
+    def _store(self, reminder):
+        doc = copy.deepcopy(reminder)
+        doc['when'] = _utc_naive(doc['when'])
+        self.docs[doc['_id']] = doc
+
+    def _sorted(self, docs):
+        return [copy.deepcopy(doc) for doc in sorted(docs, key=lambda doc: doc['when'])]
+
+    def ensure_indexes(self):
+        pass
+
+    def explain(self):
+        # Nothing here is indexed, but nothing here is a database either
+        return {}
+
+    def insert(self, reminder):
+        reminder.setdefault('_id', objectid.ObjectId())
+        self._store(reminder)
+        return reminder['_id']
+
+    def insert_many(self, reminders):
+        inserted = 0
+        for reminder in reminders:
+            reminder.setdefault('_id', objectid.ObjectId())
+            if reminder['_id'] not in self.docs:
+                self._store(reminder)
+                inserted += 1
+        return inserted
+
+    def scan(self, batch_size=1000):
+        for reminder_id in sorted(self.docs):
+            if reminder_id in self.docs:
+                yield copy.deepcopy(self.docs[reminder_id])
+
+    def get(self, reminder_id):
+        return copy.deepcopy(self.docs.get(reminder_id))
+
+    def get_many(self, reminder_ids):
+        return [copy.deepcopy(self.docs[i]) for i in reminder_ids if i in self.docs]
+
+    def due(self, end, start=None):
+        return self._sorted(doc for doc in self.docs.itervalues()
+                            if doc['when'] < end and (start is None or doc['when'] >= start))
+
+    def for_channel(self, channel, skip=0, limit=0):
+        docs = self._sorted(doc for doc in self.docs.itervalues() if channel in _targets(doc['channel']))
+        return map(_project, docs[skip:skip + limit if limit else None])
+
+    def save(self, reminder):
+        self._store(reminder)
+
+    def remove(self, reminder_id):
+        self.docs.pop(reminder_id, None)
+
+    def update(self, reminder_id, fields):
+        if reminder_id not in self.docs:
+            return None
+
+        fields = copy.deepcopy(fields)
+        if 'when' in fields:
+            fields['when'] = _utc_naive(fields['when'])
+        self.docs[reminder_id].update(fields)
+        return copy.deepcopy(self.docs[reminder_id])
+
+    def bulk_update(self, updates, removed, history=()):
+        for reminder_id, fields in updates:
+            self.update(reminder_id, fields)
+
+        for reminder_id in removed:
+            self.docs.pop(reminder_id, None)
+
+        if history:
+            self.archive.extend(copy.deepcopy(entry) for entry in history)
+            self._expire_history()
+
+    def _expire_history(self):
+        ttl = _history_ttl()
+        if ttl:
+            cutoff = datetime.datetime.utcnow() - ttl
+            while self.archive and self.archive[0]['archived'] < cutoff:
+                self.archive.popleft()
+
+    def history(self, channel, limit):
+        self._expire_history()
+
+        entries = [entry for entry in self.archive if entry['channel'] == channel]
+        entries.sort(key=lambda entry: entry['archived'], reverse=True)
+        return copy.deepcopy(entries[:limit])
+
+    def _leased_by(self, reminder_id, node_id):
+        lease = self.docs.get(reminder_id, {}).get('lease')
+        return lease is not None and lease['owner'] == node_id
+
+    def heartbeat(self, node_id, expires, now):
+        self.nodes[node_id] = expires
+        return sorted(node for node, until in self.nodes.iteritems() if until > now)
+
+    def renew(self, node_id, reminder_ids, expires):
+        held = [reminder_id for reminder_id in reminder_ids if self._leased_by(reminder_id, node_id)]
+        for reminder_id in held:
+            self.docs[reminder_id]['lease']['expires'] = expires
+        return held
+
+    def release(self, node_id, reminder_ids):
+        for reminder_id in reminder_ids:
+            if self._leased_by(reminder_id, node_id):
+                self.docs[reminder_id]['lease'] = None
+
+    def claim(self, node_id, partitions, end, now, expires):
+        claimed = []
+        for doc in sorted(self.docs.itervalues(), key=lambda doc: doc['when']):
+            lease = doc.get('lease')
+            free = (lease is None or lease['expires'] < now or
+                    (lease['owner'] == node_id and lease['expires'] < expires))
+
+            if doc['when'] < end and doc.get('partition') in partitions and free:
+                doc['lease'] = {'owner': node_id, 'expires': expires}
+                claimed.append(copy.deepcopy(doc))
+        return claimed
+
+
+class SQLiteBackend(object):
+    """
+    Stores reminders in an SQLite database at settings.REMINDERS_SQLITE_PATH, with
+    'when' and 'channel' indexed. Everything other than _id and when is kept as JSON
+    in the data column. Fan-out reminders have no channel column; instead each of
+    their targets gets a row in reminder_targets.
+    """
+
+    blocking = True
+    available = True
+    leases = False
+
+    time_format = '%Y-%m-%d %H:%M:%S.%f'
+
+    channel_where = 'channel = ? OR id IN (SELECT id FROM reminder_targets WHERE channel = ?)'
+
+    def __init__(self, path=None):
+        self.path = path or getattr(settings, 'REMINDERS_SQLITE_PATH', 'reminders.sqlite')
+        self.lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            # Queries come from pool threads, but never concurrently thanks to the lock
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        return self._conn
+
+    def _execute(self, sql, *params):
+        with self.lock:
+            with self.conn:
+                return self.conn.execute(sql, params).fetchall()
+
+    def _row(self, reminder):
+        data = dict((k, v) for k, v in reminder.iteritems() if k not in ('_id', 'when'))
+        channel = reminder.get('channel')
+        return (str(reminder['_id']), _utc_naive(reminder['when']).strftime(self.time_format),
+                None if isinstance(channel, list) else channel, json.dumps(data))
+
+    def _write_targets(self, reminders):
+        """
+        Replace the reminder_targets rows of reminders. Call with the lock held
+        """
+        self.conn.executemany('DELETE FROM reminder_targets WHERE id = ?',
+                              [(str(reminder['_id']),) for reminder in reminders])
+        self.conn.executemany('INSERT INTO reminder_targets VALUES (?, ?)', [
+            (target, str(reminder['_id']))
+            for reminder in reminders if isinstance(reminder.get('channel'), list)
+            for target in reminder['channel']
+        ])
+
+    def _doc(self, row):
+        doc = json.loads(row[3])
+        doc['_id'] = objectid.ObjectId(row[0])
+        doc['when'] = datetime.datetime.strptime(row[1], self.time_format)
+        return doc
+
+    def _select(self, where, *params):
+        if 'ORDER BY' not in where:
+            where += ' ORDER BY "when"'
+        rows = self._execute('SELECT id, "when", channel, data FROM reminders WHERE ' + where, *params)
+        return [self._doc(row) for row in rows]
+
+    def ensure_indexes(self):
+        with self.lock:
+            with self.conn:
+                self.conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS reminders (
+                        id TEXT PRIMARY KEY,
+                        "when" TEXT NOT NULL,
+                        channel TEXT,
+                        data TEXT NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS reminders_when ON reminders ("when");
+                    CREATE INDEX IF NOT EXISTS reminders_channel ON reminders (channel, "when");
+                    CREATE TABLE IF NOT EXISTS reminder_targets (
+                        channel TEXT NOT NULL,
+                        id TEXT NOT NULL,
+                        PRIMARY KEY (channel, id)
+                    );
+                    CREATE INDEX IF NOT EXISTS reminder_targets_id ON reminder_targets (id);
+                    CREATE TABLE IF NOT EXISTS reminders_history (
+                        id TEXT PRIMARY KEY,
+                        archived TEXT NOT NULL,
+                        channel TEXT,
+                        data TEXT NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS reminders_history_archived ON reminders_history (archived);
+                    CREATE INDEX IF NOT EXISTS reminders_history_channel ON reminders_history (channel, archived);
+                """)
+
+    def explain(self):
+        queries = {
+            'due': ('"when" >= ? AND "when" < ?', '', ''),
+            'for_channel': (self.channel_where + ' ORDER BY "when"', '', ''),
+            'get_many': ('id IN (?)', ''),
+        }
+        plans = {}
+        for name, query in queries.iteritems():
+            rows = self._execute('EXPLAIN QUERY PLAN SELECT * FROM reminders WHERE ' + query[0], *query[1:])
+            details = [row[-1] for row in rows]
+            plans[name] = not any(d.startswith('SCAN') and 'INDEX' not in d for d in details)
+        return plans
+
+    def insert(self, reminder):
+        reminder.setdefault('_id', objectid.ObjectId())
+        with self.lock:
+            with self.conn:
+                self.conn.execute('INSERT INTO reminders VALUES (?, ?, ?, ?)', self._row(reminder))
+                self._write_targets([reminder])
+        return reminder['_id']
+
+    def insert_many(self, reminders):
+        for reminder in reminders:
+            reminder.setdefault('_id', objectid.ObjectId())
+
+        with self.lock:
+            with self.conn:
+                # Only reminders that were actually inserted get targets, so a skipped
+                # duplicate never replaces the targets of the stored reminder
+                inserted = [reminder for reminder in reminders
+                            if self.conn.execute('INSERT OR IGNORE INTO reminders VALUES (?, ?, ?, ?)',
+                                                 self._row(reminder)).rowcount]
+                self._write_targets(inserted)
+                return len(inserted)
+
+    def scan(self, batch_size=1000):
+        # Page through by id rather than holding a cursor open, so the lock is
+        # never held between batches
+        last = ''
+        while True:
+            docs = self._select('id > ? ORDER BY id LIMIT ?', last, batch_size)
+            for doc in docs:
+                yield doc
+            if len(docs) < batch_size:
+                return
+            last = str(docs[-1]['_id'])
+
+    def get(self, reminder_id):
+        docs = self._select('id = ?', str(reminder_id))
+        return docs[0] if docs else None
+
+    def get_many(self, reminder_ids):
+        if not reminder_ids:
+            return []
+        marks = ', '.join('?' * len(reminder_ids))
+        return self._select('id IN ({0})'.format(marks), *map(str, reminder_ids))
+
+    def due(self, end, start=None):
+        if start is None:
+            return self._select('"when" < ?', end.strftime(self.time_format))
+        return self._select('"when" >= ? AND "when" < ?',
+                            start.strftime(self.time_format), end.strftime(self.time_format))
+
+    def for_channel(self, channel, skip=0, limit=0):
+        # A negative LIMIT means no limit to SQLite
+        docs = self._select(self.channel_where + ' ORDER BY "when" LIMIT ? OFFSET ?',
+                            channel, channel, limit or -1, skip)
+        return map(_project, docs)
+
+    def save(self, reminder):
+        with self.lock:
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO reminders VALUES (?, ?, ?, ?)', self._row(reminder))
+                self._write_targets([reminder])
+
+    def remove(self, reminder_id):
+        with self.lock:
+            with self.conn:
+                self.conn.execute('DELETE FROM reminders WHERE id = ?', (str(reminder_id),))
+                self.conn.execute('DELETE FROM reminder_targets WHERE id = ?', (str(reminder_id),))
+
+    def _update(self, reminder_id, fields):
+        """
+        Apply fields to a stored reminder and return it, or None if there is no such
+        reminder. Call with the lock held
+        """
+        row = self.conn.execute('SELECT id, "when", channel, data FROM reminders WHERE id = ?',
+                                (str(reminder_id),)).fetchone()
+        if row is None:
+            return None
+
+        doc = self._doc(row)
+        doc.update(fields)
+        self.conn.execute('REPLACE INTO reminders VALUES (?, ?, ?, ?)', self._row(doc))
+        if 'channel' in fields:
+            self._write_targets([doc])
+        return doc
+
+    def update(self, reminder_id, fields):
+        with self.lock:
+            with self.conn:
+                doc = self._update(reminder_id, fields)
+        if doc is not None:
+            doc['when'] = _utc_naive(doc['when'])
+        return doc
+
+    def bulk_update(self, updates, removed, history=()):
+        with self.lock:
+            with self.conn:
+                for reminder_id, fields in updates:
+                    self._update(reminder_id, fields)
+
+                removed = [(str(reminder_id),) for reminder_id in removed]
+                self.conn.executemany('DELETE FROM reminders WHERE id = ?', removed)
+                self.conn.executemany('DELETE FROM reminder_targets WHERE id = ?', removed)
+
+                if history:
+                    self.conn.executemany('INSERT INTO reminders_history VALUES (?, ?, ?, ?)',
+                                          map(self._history_row, history))
+
+                # SQLite has no TTL indexes, so expire old history as new history arrives
+                ttl = _history_ttl()
+                if history and ttl:
+                    cutoff = datetime.datetime.utcnow() - ttl
+                    self.conn.execute('DELETE FROM reminders_history WHERE archived < ?',
+                                      (cutoff.strftime(self.time_format),))
+
+    def _history_row(self, entry):
+        data = dict((k, v) for k, v in entry.iteritems() if k not in ('_id', 'archived'))
+        data['reminder_id'] = str(data['reminder_id'])
+        for field in ('when', 'delivered'):
+            if data.get(field) is not None:
+                data[field] = data[field].strftime(self.time_format)
+        archived = entry['archived'].strftime(self.time_format)
+        return (str(entry['_id']), archived, entry['channel'], json.dumps(data))
+
+    def history(self, channel, limit):
+        rows = self._execute('SELECT id, archived, channel, data FROM reminders_history WHERE channel = ? '
+                             'ORDER BY archived DESC LIMIT ?', channel, limit)
+        entries = []
+        for row in rows:
+            entry = json.loads(row[3])
+            entry['_id'] = objectid.ObjectId(row[0])
+            entry['archived'] = datetime.datetime.strptime(row[1], self.time_format)
+            entry['reminder_id'] = objectid.ObjectId(entry['reminder_id'])
+            for field in ('when', 'delivered'):
+                if entry.get(field) is not None:
+                    entry[field] = datetime.datetime.strptime(entry[field], self.time_format)
+            entries.append(entry)
+        return entries
+
+
+backends = {
+    'mongo': MongoBackend,
+    'memory': MemoryBackend,
+    'sqlite': SQLiteBackend,
+}
+
+
+class ReminderStore(object):
+    """
+    Deferred-returning access to reminder storage. The backend is picked by
+    settings.REMINDERS_BACKEND, one of 'mongo' (the default), 'memory' or 'sqlite'.
+
+    Calls to blocking backends run in a bounded thread pool so a slow database never
+    blocks the reactor, and each operation is cancelled if it takes longer than its
+    configured timeout. Results are delivered back on the reactor thread.
+
+    The pool size comes from settings.REMINDERS_DB_POOL_SIZE. Timeouts, in seconds,
+    come from settings.REMINDERS_DB_TIMEOUTS keyed by operation name, falling back
+    to settings.REMINDERS_DB_TIMEOUT. Writes are never timed out: the pool thread
+    would finish the write anyway, and the reminder it stored would never be
+    scheduled. With ``inline=True`` calls run synchronously on the calling thread,
+    which is only useful for tests.
+    """
+
+    writes = frozenset(['insert', 'insert_many', 'save', 'remove', 'update', 'bulk_update'])
+
+    def __init__(self, backend=None, inline=False):
+        self._backend = backend
+        self.inline = inline
+        self._pool = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = backends[getattr(settings, 'REMINDERS_BACKEND', 'mongo')]()
+        return self._backend
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            size = getattr(settings, 'REMINDERS_DB_POOL_SIZE', 4)
+            self._pool = ThreadPool(minthreads=1, maxthreads=size, name='helga-reminders')
+            self._pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self._pool.stop)
+        return self._pool
+
+    def timeout(self, operation):
+        if operation in self.writes:
+            return None
+
+        timeouts = getattr(settings, 'REMINDERS_DB_TIMEOUTS', {})
+        return timeouts.get(operation, getattr(settings, 'REMINDERS_DB_TIMEOUT', 10))
+
+    def _defer(self, operation, *args):
+        func = getattr(self.backend, operation)
+        started = time.time()
+
+        if self.inline or not self.backend.blocking:
+            d = defer.maybeDeferred(func, *args)
+        else:
+            d = threads.deferToThreadPool(reactor, self.pool, func, *args)
+
+            timeout = self.timeout(operation)
+            if timeout:
+                d.addTimeout(timeout, reactor)
+
+        return d.addBoth(self._timed, operation, started)
+
+    def _timed(self, result, operation, started):
+        _metrics.timing('db.' + operation, time.time() - started)
+        return result
+
+    def ensure_indexes(self):
+        return self._defer('ensure_indexes')
+
+    def explain(self):
+        return self._defer('explain')
+
+    def insert(self, reminder):
+        return self._defer('insert', reminder)
+
+    def insert_many(self, reminders):
+        return self._defer('insert_many', reminders)
+
+    def get(self, reminder_id):
+        return self._defer('get', reminder_id)
+
+    def get_many(self, reminder_ids):
+        return self._defer('get_many', reminder_ids)
+
+    def due(self, end, start=None):
+        return self._defer('due', end, start)
+
+    def for_channel(self, channel, skip=0, limit=0):
+        return self._defer('for_channel', channel, skip, limit)
+
+    def save(self, reminder):
+        return self._defer('save', reminder)
+
+    def remove(self, reminder_id):
+        return self._defer('remove', reminder_id)
+
+    def update(self, reminder_id, fields):
+        return self._defer('update', reminder_id, fields)
+
+    def bulk_update(self, updates, removed, history=()):
+        return self._defer('bulk_update', updates, removed, history)
+
+    def history(self, channel, limit):
+        return self._defer('history', channel, limit)
+
+    def heartbeat(self, node_id, expires, now):
+        return self._defer('heartbeat', node_id, expires, now)
+
+    def renew(self, node_id, reminder_ids, expires):
+        return self._defer('renew', node_id, reminder_ids, expires)
+
+    def release(self, node_id, reminder_ids):
+        return self._defer('release', node_id, reminder_ids)
+
+    def claim(self, node_id, partitions, end, now, expires):
+        return self._defer('claim', node_id, partitions, end, now, expires)
+
+
+class Coordinator(object):
+    """
+    Shares the firing of reminders between several helga instances using the same
+    database. Every reminder carries a partition number and a lease naming the
+    instance that will fire it and when that claim runs out.
+
+    Live instances heartbeat into the ``reminder_nodes`` collection and split the
+    partitions between them in node id order. Each refill an instance renews the
+    leases it holds and claims unleased or expired reminders in its partitions, so
+    when an instance dies its partitions pass to the survivors and its leases are
+    taken over once they lapse.
+    """
+
+    def __init__(self, node_id=None, partitions=64, lease=30):
+        self.node_id = node_id or '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        self.partitions = partitions
+        self.lease = lease
+
+        # Naive UTC expiry of the most recently renewed leases
+        self.held_until = None
+
+    def mine(self, nodes):
+        """
+        The partitions this instance owns, given the sorted ids of the live nodes
+        """
+        if self.node_id not in nodes:
+            return []
+
+        index = nodes.index(self.node_id)
+        partitions = [p for p in xrange(self.partitions) if p % len(nodes) == index]
+
+        # Records from before coordination was turned on have no partition
+        if 0 in partitions:
+            partitions.append(None)
+        return partitions
+
+    def assign(self, reminder, utcnow=None):
+        """
+        Place a new reminder in a random partition, leased to this instance
+        """
+        if utcnow is None:
+            utcnow = datetime.datetime.utcnow()
+
+        reminder['partition'] = random.randrange(self.partitions)
+        reminder['lease'] = {
+            'owner': self.node_id,
+            'expires': utcnow + datetime.timedelta(seconds=self.lease),
+        }
+
+    def holds_leases(self, utcnow=None):
+        if utcnow is None:
+            utcnow = datetime.datetime.utcnow()
+        return self.held_until is not None and utcnow < self.held_until
+
+
+_epoch = datetime.datetime(1970, 1, 1)
+
+# Channel and timezone names shared by every Reminder that uses them. intern()
+# only takes byte strings, and channel names are usually unicode
+_interned = {}
+
+
+def _intern(name):
+    return _interned.setdefault(name, name)
+
+
+class Reminder(object):
+    """
+    The compact in-memory form of a scheduled reminder. 'when' is UTC seconds since
+    the epoch, weekday repeats are kept as their mask, and channel and timezone
+    names are interned. The channel of a fan-out reminder is a tuple of targets.
+    The message is None until it is needed, so reminders loaded in bulk don't
+    hold it; firing fetches it with the rest of the batch. ``anchor`` is only set
+    on a snoozed repeating reminder, and holds the epoch seconds of the occurrence
+    it was snoozed from, which its rule keeps repeating from.
+
+    from_doc and to_doc are the only conversions to and from the stored document.
+    """
+
+    __slots__ = ('_id', 'when', 'channel', 'message', 'repeat', 'timezone', 'partition', 'anchor')
+
+    def __init__(self, _id, when, channel, message=None, repeat=None, timezone=None, partition=None,
+                 anchor=None):
+        self._id = _id
+        self.when = when
+        self.channel = channel
+        self.message = message
+        self.repeat = repeat
+        self.timezone = timezone
+        self.partition = partition
+        self.anchor = anchor
+
+    @classmethod
+    def from_doc(cls, doc, message=True):
+        repeat = doc.get('repeat')
+        if repeat is not None and not isinstance(repeat, basestring):
+            repeat = repeat_mask(repeat)
+
+        channel = doc.get('channel')
+        if isinstance(channel, list):
+            channel = tuple(_intern(target) for target in channel)
+        else:
+            channel = _intern(channel)
+
+        return cls(doc['_id'],
+                   (_utc_naive(doc['when']) - _epoch).total_seconds(),
+                   channel,
+                   doc.get('message') if message else None,
+                   repeat,
+                   _intern(doc.get('timezone')),
+                   doc.get('partition'),
+                   doc.get('anchor'))
+
+    def to_doc(self):
+        doc = {'_id': self._id, 'when': self.utc, 'channel': self.channel}
+        if isinstance(self.channel, tuple):
+            doc['channel'] = list(self.channel)
+        for field in ('message', 'repeat', 'timezone', 'partition', 'anchor'):
+            value = getattr(self, field)
+            if value is not None:
+                doc[field] = value
+        return doc
+
+    @property
+    def utc(self):
+        """
+        'when' as a naive UTC datetime
+        """
+        return _epoch + datetime.timedelta(seconds=self.when)
+
+
+def _log_failure(failure, message, *args):
+    logger.error(message + ': %s', *(args + (failure.getTraceback(),)))
+
+
+_store = ReminderStore()
+_delivery = DeliveryQueue(rate=getattr(settings, 'REMINDERS_FLOOD_RATE', 1),
+                          burst=getattr(settings, 'REMINDERS_FLOOD_BURST', 4),
+                          line_limit=getattr(settings, 'REMINDERS_LINE_LIMIT', 400))
+_scheduler = Scheduler(tolerance=getattr(settings, 'REMINDERS_FIRE_TOLERANCE', 1))
+
+
+def _metrics_sink():
+    """
+    The sink named by settings.REMINDERS_METRICS_SINK: None, 'statsd' or any object
+    with incr, timing and gauge methods
+    """
+    sink = getattr(settings, 'REMINDERS_METRICS_SINK', None)
+    if sink == 'statsd':
+        return StatsdSink(host=getattr(settings, 'REMINDERS_STATSD_HOST', 'localhost'),
+                          port=getattr(settings, 'REMINDERS_STATSD_PORT', 8125),
+                          prefix=getattr(settings, 'REMINDERS_STATSD_PREFIX', 'helga.reminders'))
+    return sink
+
+
+_metrics = Metrics(sink=_metrics_sink())
+_profiler = Profiler(sample_rate=getattr(settings, 'REMINDERS_PROFILE_SAMPLE_RATE', 0.1),
+                     path=getattr(settings, 'REMINDERS_PROFILE_PATH', 'reminders.prof'),
+                     interval=getattr(settings, 'REMINDERS_PROFILE_INTERVAL', 300))
+
+# Only set when several instances share the database, see Coordinator
+_coordinator = None
+if getattr(settings, 'REMINDERS_COORDINATE', False):
+    _coordinator = Coordinator(node_id=getattr(settings, 'REMINDERS_NODE_ID', None),
+                               partitions=getattr(settings, 'REMINDERS_PARTITIONS', 64),
+                               lease=getattr(settings, 'REMINDERS_LEASE_SECONDS', 30))
+
+# Only reminders due before this naive UTC datetime are held by the scheduler. The
+# periodic refill moves it forward and loads whatever falls into the new window
+_horizon_end = None
+_refill = None
+
+# Write-through Reminder records for everything held by the scheduler, keyed by
+# _id, so firing a reminder only reads back messages that were not kept
+_cache = {}
+
+
+def _horizon():
+    """
+    The scheduling window, from settings.REMINDERS_HORIZON_HOURS
+    """
+    return datetime.timedelta(hours=getattr(settings, 'REMINDERS_HORIZON_HOURS', 6))
+
+
+def _history_ttl():
+    """
+    How long fired and stale reminders are kept, from settings.REMINDERS_HISTORY_DAYS.
+    Zero turns history off
+    """
+    return datetime.timedelta(days=getattr(settings, 'REMINDERS_HISTORY_DAYS', 7))
+
+
+def _history_entries(reminder, delivered, archived):
+    """
+    The reminders_history records of a Reminder leaving the reminders collection,
+    one for each target. ``delivered`` is when it fired, or None if it was dropped
+    as stale
+    """
+    return [{
+        '_id': objectid.ObjectId(),
+        'reminder_id': reminder._id,
+        'channel': target,
+        'message': reminder.message,
+        'when': reminder.utc,
+        'delivered': delivered,
+        'archived': archived,
+    } for target in _targets(reminder.channel)]
+
+
+def _utc_naive(when):
+    if when.tzinfo is not None:
+        when = when.astimezone(pytz.UTC).replace(tzinfo=None)
+    return when
+
+
+def _schedule_reminder(reminder, delay, client):
+    """
+    Hand a Reminder to the scheduler if it is due inside the loaded horizon. Anything
+    later stays in the database until the refill reaches it
+    """
+    if _horizon_end is not None and reminder.utc >= _horizon_end:
+        _forget_reminder(reminder._id)
+        return
+
+    _cache[reminder._id] = reminder
+    _scheduler.schedule_batch(reminder._id, delay, _do_reminders, client)
+
+
+def _schedule_reminders(batch, client):
+    """
+    Schedule a batch of (Reminder, delay) pairs with a single scheduler update
+    """
+    entries = []
+    for reminder, delay in batch:
+        if _horizon_end is not None and reminder.utc >= _horizon_end:
+            _forget_reminder(reminder._id)
+            continue
+
+        _cache[reminder._id] = reminder
+        entries.append((reminder._id, delay))
+
+    _scheduler.schedule_batches(entries, _do_reminders, client)
+
+
+def _forget_reminder(reminder_id):
+    """
+    Drop a reminder from the scheduler and the document cache
+    """
+    _scheduler.cancel(reminder_id)
+    _cache.pop(reminder_id, None)
+
+
+@smokesignal.on('signon')
+def init_reminders(client):
+    global _coordinator, _horizon_end, _refill
+
+    if not _store.backend.available:
+        logger.warning('Cannot auto schedule reminders. No database connection')
+        return
+
+    logger.info("Initializing any scheduled reminders")
+
+    if getattr(settings, 'REMINDERS_PROFILE', False) and not _profiler.enabled:
+        _profiler.start()
+
+    _store.ensure_indexes().addErrback(_log_failure, 'Could not create reminder indexes')
+
+    if _refill is not None and _refill.running:
+        _refill.stop()
+
+    load, interval = load_reminders, _horizon().total_seconds() / 2
+
+    if _coordinator is not None:
+        if _store.backend.leases:
+            # Leases must be renewed well before they run out
+            load, interval = claim_reminders, _coordinator.lease / 2.0
+        else:
+            # Without leases nothing could ever be claimed or fired, so run uncoordinated
+            logger.warning('The reminders backend cannot coordinate instances. Scheduling everything here')
+            _coordinator = None
+
+    _horizon_end = None
+    load(client)
+
+    _refill = task.LoopingCall(load, client)
+    _refill.start(interval, now=False).addErrback(_log_failure, 'Reminder refill stopped')
+
+
+def load_reminders(client):
+    """
+    Schedule every reminder due before the end of the next horizon window. The first
+    load also picks up anything overdue; later loads only query the newly uncovered
+    range of 'when'
+    """
+    global _horizon_end
+
+    utcnow = datetime.datetime.utcnow()
+    window_end = utcnow + _horizon()
+    start = _horizon_end
+
+    # Move the horizon up front so reminders set while the query runs are scheduled
+    d = _store.due(window_end, start)
+    _horizon_end = window_end
+
+    d.addCallbacks(_schedule_loaded, _load_failed, callbackArgs=(utcnow, client), errbackArgs=(start, window_end))
+    d.addErrback(_log_failure, 'Could not load reminders')
+    return d
+
+
+def _load_failed(failure, start, end):
+    """
+    Put the horizon back to where the failed load started, so the next refill
+    queries the same window again rather than skipping it
+    """
+    global _horizon_end
+
+    if _horizon_end == end:
+        _horizon_end = start
+    return failure
+
+
+def claim_reminders(client):
+    """
+    The coordinated counterpart of load_reminders. Heartbeat, hand off or renew the
+    leases on everything already scheduled, then claim and schedule whatever is due
+    inside the horizon in this instance's partitions
+    """
+    global _horizon_end
+
+    utcnow = datetime.datetime.utcnow()
+    window_end = utcnow + _horizon()
+    expires = utcnow + datetime.timedelta(seconds=_coordinator.lease)
+    _horizon_end = window_end
+
+    d = _store.heartbeat(_coordinator.node_id, expires, utcnow)
+    d.addCallback(_renew_leases, utcnow, expires)
+    d.addCallback(lambda partitions: _store.claim(_coordinator.node_id, partitions, window_end, utcnow, expires))
+    d.addCallback(_schedule_loaded, utcnow, client)
+    d.addErrback(_log_failure, 'Could not claim reminders')
+    return d
+
+
+def _renew_leases(nodes, utcnow, expires):
+    """
+    Keep the leases on scheduled reminders in our partitions. Anything in another
+    instance's partitions is released, unless it is due before that instance could
+    claim it, in which case we keep it and fire it ourselves
+    """
+    partitions = _coordinator.mine(nodes)
+    handoff = utcnow + datetime.timedelta(seconds=_coordinator.lease)
+    keep = []
+    release = []
+
+    for reminder_id, reminder in _cache.items():
+        if reminder.partition in partitions or reminder.utc < handoff:
+            keep.append(reminder_id)
+        else:
+            _forget_reminder(reminder_id)
+            release.append(reminder_id)
+
+    if release:
+        d = _store.release(_coordinator.node_id, release)
+    else:
+        d = defer.succeed(None)
+
+    d.addCallback(lambda _: _store.renew(_coordinator.node_id, keep, expires))
+    d.addCallback(_leases_renewed, keep, expires)
+    d.addCallback(lambda _: partitions)
+    return d
+
+
+def _leases_renewed(held, kept, expires):
+    """
+    Stop scheduling anything whose lease we no longer hold, because it was deleted
+    or another instance took it over
+    """
+    held = set(held)
+    lost = [reminder_id for reminder_id in kept if reminder_id not in held]
+
+    for reminder_id in lost:
+        _forget_reminder(reminder_id)
+
+    if lost:
+        logger.info('Lost the leases on %d reminders', len(lost))
+
+    _coordinator.held_until = expires
+
+
+def _seconds_until(when, utcnow):
+    now = utcnow
+    if when.tzinfo is not None:
+        now = now.replace(tzinfo=pytz.UTC).astimezone(when.tzinfo)
+
+    return (when - now).total_seconds()
+
+
+def _schedule_loaded(reminders, utcnow, client):
+    """
+    Schedule freshly loaded reminders. Anything overdue is caught up in memory
+    first: repeats move to their next occurrence and stale one-shots are dropped,
+    and all of those corrections are committed with one bulk update
+    """
+    started = time.time()
+    overdue = []
+    removed = []
+    history = []
+    archive = bool(_history_ttl())
+
+    for reminder in reminders:
+        if reminder['_id'] in _scheduler:
+            continue
+
+        delay = _seconds_until(reminder['when'], utcnow)
+
+        if delay < 0:
+            if 'repeat' in reminder:
+                overdue.append(reminder)
+                continue
+            elif delay >= -60:  # if it's only 1 minute late
+                delay = 0
+            else:
+                removed.append(reminder['_id'])
+                if archive:
+                    history.extend(_history_entries(Reminder.from_doc(reminder), None, utcnow))
+                continue
+
+        _schedule_reminder(Reminder.from_doc(reminder, message=False), delay, client)
+
+    updates = []
+    for reminder, occurrence in zip(overdue, next_occurrences(overdue, utcnow.replace(tzinfo=pytz.UTC))):
+        if occurrence is None:
+            continue
+
+        reminder['when'] = occurrence
+        fields = {'when': occurrence}
+        if reminder.get('anchor') is not None:
+            reminder['anchor'] = fields['anchor'] = None
+        updates.append((reminder['_id'], fields))
+        _schedule_reminder(Reminder.from_doc(reminder, message=False),
+                           _seconds_until(reminder['when'], utcnow), client)
+
+    _metrics.incr('rescheduled', len(updates))
+    _metrics.incr('stale_dropped', len(removed))
+    _metrics.gauge('pending', len(_scheduler))
+
+    if not updates and not removed:
+        return
+
+    def caught_up(result):
+        logger.info('Caught up %d overdue repeating reminders and removed %d stale reminders in %.3fs',
+                    len(updates), len(removed), time.time() - started)
+        return result
+
+    return _store.bulk_update(updates, removed, history).addCallback(caught_up)
+
+
+def readable_time_delta(seconds):
+    """
+    Convert a number of seconds into readable days, hours, and minutes
+    """
+    days = seconds // 86400
+    seconds -= days * 86400
+    hours = seconds // 3600
+    seconds -= hours * 3600
+    minutes = seconds // 60
+
+    m_suffix = 's' if minutes != 1 else ''
+    h_suffix = 's' if hours != 1 else ''
+    d_suffix = 's' if days != 1 else ''
+
+    retval = u'{0} minute{1}'.format(minutes, m_suffix)
+
+    if hours != 0:
+        retval = u'{0} hour{1} and {2}'.format(hours, h_suffix, retval)
+
+    if days != 0:
+        retval = u'{0} day{1}, {2}'.format(days, d_suffix, retval)
+
+    return retval
+
+
+def repeat_mask(repeat):
+    """
+    Normalize a stored repeat schedule to a 7-bit weekday mask, where bit 0 is Monday.
+    Older records store a list of weekday numbers instead
+    """
+    if isinstance(repeat, (int, long)):
+        return repeat
+    return sum(1 << dow for dow in set(repeat))
+
+
+def repeat_days(repeat):
+    """
+    The weekday numbers in a stored repeat schedule
+    """
+    mask = repeat_mask(repeat)
+    return [dow for dow in xrange(7) if mask & (1 << dow)]
+
+
+def _local(timezone, date, time):
+    return timezone.localize(datetime.datetime.combine(date, time))
+
+
+class WeekdayRule(object):
+    """
+    Repeats at the same wall clock time on the days of the week in a 7-bit mask.
+    Stored as the mask itself
+    """
+
+    def __init__(self, mask):
+        self.mask = mask
+
+    def matches(self, local):
+        return bool(self.mask & (1 << local.weekday()))
+
+    def next(self, when, after, timezone):
+        if not self.mask:
+            return None
+
+        time = when.astimezone(timezone).time()
+        date = after.astimezone(timezone).date()
+
+        # Later today if today is a repeat day, otherwise the next repeat day
+        occurrence = _local(timezone, date, time)
+        if not self.matches(date) or occurrence <= after:
+            date += datetime.timedelta(days=_day_deltas[date.weekday()][self.mask])
+            occurrence = _local(timezone, date, time)
+
+        return occurrence.astimezone(pytz.UTC)
+
+    def describe(self):
+        return u'every {0}'.format(','.join(days_of_week_lookup[day] for day in repeat_days(self.mask)))
+
+
+class IntervalRule(object):
+    """
+    Repeats every ``seconds``, counted from the reminder's first 'when'. Stored as
+    'every <seconds>'
+    """
+
+    def __init__(self, seconds):
+        if seconds < 60:
+            raise ValueError('Intervals must be at least a minute')
+        self.seconds = seconds
+
+    def matches(self, local):
+        return True
+
+    def next(self, when, after, timezone):
+        periods = int((after - when).total_seconds() // self.seconds) + 1
+        return when + datetime.timedelta(seconds=self.seconds * max(periods, 1))
+
+    def describe(self):
+        for unit in ('d', 'h', 'm'):
+            if not self.seconds % in_seconds_map[unit]:
+                return u'every {0}{1}'.format(self.seconds // in_seconds_map[unit], unit)
+        return u'every {0}s'.format(self.seconds)
+
+
+class CronRule(object):
+    """
+    A cron style 'minute hour day-of-month month day-of-week' rule, evaluated on
+    the wall clock of the reminder's timezone. Stored as the five fields. Each field
+    is kept sorted so the next matching value is a bisect away, and days that can't
+    match are skipped whole.
+    """
+
+    # Days of the week count from Sunday, which can also be 7
+    bounds = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, spec):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError('Cron rules have five fields')
+
+        self.spec = ' '.join(fields)
+        self.minutes, self.hours, self.days, self.months, weekdays = [
+            self._field(field, low, high) for field, (low, high) in zip(fields, self.bounds)]
+
+        # Python counts days of the week from Monday
+        self.weekdays = set((day - 1) % 7 for day in weekdays)
+        self.day_set = set(self.days)
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _field(field, low, high):
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            if part == '*':
+                start, end = low, high
+            else:
+                start, _, end = part.partition('-')
+                start = int(start)
+                end = int(end) if end else (high if step else start)
+
+            step = int(step) if step else 1
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError('{0} is out of range'.format(field))
+            values.update(xrange(start, end + 1, step))
+        return sorted(values)
+
+    def _day_matches(self, date):
+        in_month = date.day in self.day_set
+        in_week = date.weekday() in self.weekdays
+
+        # Like cron, restricting both day fields matches either of them
+        if self.any_day:
+            return in_week
+        if self.any_weekday:
+            return in_month
+        return in_month or in_week
+
+    def matches(self, local):
+        return (local.minute in self.minutes and local.hour in self.hours and
+                local.month in self.months and self._day_matches(local))
+
+    def next(self, when, after, timezone):
+        local = after.astimezone(timezone).replace(tzinfo=None, second=0, microsecond=0)
+        local += datetime.timedelta(minutes=1)
+
+        # Enough to find a February 29th, and to give up on February 30th
+        for _ in xrange(20000):
+            if local.month not in self.months:
+                i = bisect.bisect_left(self.months, local.month)
+                year = local.year + (i == len(self.months))
+                local = datetime.datetime(year, self.months[i % len(self.months)], 1)
+                continue
+
+            if not self._day_matches(local):
+                local = datetime.datetime.combine(local.date() + datetime.timedelta(days=1), datetime.time())
+                continue
+
+            i = bisect.bisect_left(self.hours, local.hour)
+            if i == len(self.hours):
+                local = datetime.datetime.combine(local.date() + datetime.timedelta(days=1), datetime.time())
+                continue
+            if self.hours[i] != local.hour:
+                local = local.replace(hour=self.hours[i], minute=0)
+
+            i = bisect.bisect_left(self.minutes, local.minute)
+            if i == len(self.minutes):
+                local = local.replace(minute=0) + datetime.timedelta(hours=1)
+                continue
+
+            return timezone.localize(local.replace(minute=self.minutes[i])).astimezone(pytz.UTC)
+
+        return None
+
+    def describe(self):
+        return u'cron {0}'.format(self.spec)
+
+
+@_lru_cache(maxsize=256)
+def _compile_rule(spec):
+    if spec.startswith('every '):
+        return IntervalRule(int(spec[6:]))
+    return CronRule(spec)
+
+
+def compile_rule(repeat):
+    """
+    The recurrence rule for a stored repeat. Weekday masks and the lists older
+    records store are WeekdayRules, and strings are compiled once and cached
+    """
+    if isinstance(repeat, basestring):
+        return _compile_rule(repeat)
+    return WeekdayRule(repeat_mask(repeat))
+
+
+def next_occurrence(reminder, now=None):
+    """
+    Calculate the next occurrence of a repeatable reminder, after both now and its
+    current 'when'. Day and time based rules work from the wall clock in the
+    timezone the reminder was set in, so they stay put across daylight saving
+    changes. Records from before timezones were stored repeat in UTC.
+
+    A snoozed reminder repeats from its 'anchor', the occurrence it was snoozed
+    from, rather than from the time it was snoozed to
+    """
+    if now is None:
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
+
+    when = reminder['when']
+    naive = when.tzinfo is None
+    if naive:
+        when = when.replace(tzinfo=pytz.UTC)
+
+    start = when
+    if reminder.get('anchor') is not None:
+        start = (_epoch + datetime.timedelta(seconds=reminder['anchor'])).replace(tzinfo=pytz.UTC)
+
+    timezone = _timezone(reminder.get('timezone', 'UTC'))
+    occurrence = compile_rule(reminder['repeat']).next(start, max(now, when, start), timezone)
+
+    if occurrence is None:
+        logger.error('Reminder %s will never repeat again', reminder.get('_id'))
+        return
+
+    return occurrence.replace(tzinfo=None) if naive else occurrence
+
+
+def next_occurrences(reminders, now=None):
+    """
+    Calculate next_occurrence for a batch of repeating reminders against a single now
+    """
+    if now is None:
+        now = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
+    return [next_occurrence(reminder, now) for reminder in reminders]
+
+
+def _do_reminder(reminder_id, client):
+    _do_reminders([reminder_id], client)
+
+
+@_profiler.profiled
+def _do_reminders(reminder_ids, client):
+    """
+    Fire a batch of due reminders. Repeating reminders are moved to their next
+    occurrence and one-shots are removed, with every change sent to the database
+    in a single bulk write
+    """
+    if _coordinator is not None and not _coordinator.holds_leases():
+        # Another instance may already have taken these over
+        logger.warning('Not firing reminders %s, their leases could not be renewed', reminder_ids)
+        for reminder_id in reminder_ids:
+            _forget_reminder(reminder_id)
+        return defer.succeed(None)
+
+    # Reminders loaded in bulk don't keep their message, so fetch those with anything
+    # that dropped out of the cache
+    missing = [reminder_id for reminder_id in reminder_ids
+               if reminder_id not in _cache or _cache[reminder_id].message is None]
+
+    if missing:
+        d = _store.get_many(missing)
+    else:
+        d = defer.succeed([])
+
+    d.addCallback(_fire_reminders, reminder_ids, client)
+    d.addErrback(_log_failure, 'Could not fire reminders %s', reminder_ids)
+    return d
+
+
+def _fire_reminders(fetched, reminder_ids, client):
+    fetched = dict((rec['_id'], rec) for rec in fetched)
+    utcnow = datetime.datetime.utcnow()
+    fired = 0
+    repeats = []
+    updates = []
+    removed = []
+    history = []
+    archive = bool(_history_ttl())
+    archive_repeats = archive and getattr(settings, 'REMINDERS_HISTORY_REPEATS', False)
+
+    for reminder_id in reminder_ids:
+        if reminder_id in fetched:
+            reminder = Reminder.from_doc(fetched[reminder_id])
+        else:
+            reminder = _cache.get(reminder_id)
+
+        if reminder is None or reminder.message is None:
+            logger.error('Tried to locate reminder %s, but it returned None', reminder_id)
+            _forget_reminder(reminder_id)
+            continue
+
+        for target in _targets(reminder.channel):
+            _delivery.put(client, target, reminder.message)
+        fired += 1
+        _metrics.fire_lag((utcnow - reminder.utc).total_seconds())
+
+        # Repeats fire again and again, so they are only archived when asked for
+        if archive_repeats or (archive and reminder.repeat is None):
+            history.extend(_history_entries(reminder, utcnow, utcnow))
+
+        if reminder.repeat is not None:
+            repeats.append(reminder)
+        else:
+            _forget_reminder(reminder_id)
+            removed.append(reminder_id)
+
+    _delivery.flush()
+
+    # Figure out the next time for everything that repeats. Delays are measured from
+    # the new absolute 'when' so time spent firing never accumulates
+    utcnow = datetime.datetime.utcnow()
+    for reminder, occurrence in zip(repeats, next_occurrences([r.to_doc() for r in repeats])):
+        if occurrence is None:
+            _forget_reminder(reminder._id)
+            continue
+
+        reminder.when = (occurrence - _epoch).total_seconds()
+        fields = {'when': occurrence}
+        if reminder.anchor is not None:
+            reminder.anchor = fields['anchor'] = None
+        updates.append((reminder._id, fields))
+        _schedule_reminder(reminder, _seconds_until(occurrence, utcnow), client)
+
+    _metrics.incr('fired', fired)
+    _metrics.incr('rescheduled', len(updates))
+    _metrics.gauge('pending', len(_scheduler))
+    _metrics.gauge('delivery_depth', _delivery.depth)
+    _metrics.gauge('delivery_lag', int(round(_delivery.lag * 1000)))
+
+    if updates or removed or history:
+        return _store.bulk_update(updates, removed, history)
+
+
+def _insert_reminder(reminder, delay, client):
+    """
+    Store a new reminder and schedule it once the database has it
+    """
+    if _coordinator is not None:
+        _coordinator.assign(reminder)
+
+    return _store.insert(reminder).addCallback(_reminder_saved, reminder, delay, client)
+
+
+def _insert_reminders(batch, client):
+    """
+    Store a batch of new (reminder, delay) pairs with one insert and schedule them
+    together once the database has them
+    """
+    for reminder, delay in batch:
+        reminder['_id'] = objectid.ObjectId()
+        if _coordinator is not None:
+            _coordinator.assign(reminder)
+
+    d = _store.insert_many([reminder for reminder, delay in batch])
+    return d.addCallback(_reminders_saved, batch, client)
+
+
+def _reminders_saved(inserted, batch, client):
+    """
+    Schedule a freshly stored batch in one pass and summarize it in one reply.
+    Timers count down to the stored 'when', so the insert doesn't make them late
+    """
+    utcnow = datetime.datetime.utcnow()
+    _schedule_reminders([(Reminder.from_doc(reminder), _seconds_until(reminder['when'], utcnow))
+                         for reminder, delay in batch], client)
+    soonest = min(delay for reminder, delay in batch)
+    return u'{0} reminders set, the first for {1} from now'.format(
+        len(batch), readable_time_delta(int(soonest)))
+
+
+def _reminder_saved(reminder_id, reminder, delay, client):
+    """
+    Schedule a newly stored reminder and build the confirmation reply. The timer
+    counts down to the stored 'when', so the insert doesn't make it late
+    """
+    reminder['_id'] = reminder_id
+    _schedule_reminder(Reminder.from_doc(reminder), _seconds_until(reminder['when'], datetime.datetime.utcnow()),
+                       client)
+    return u'Reminder set for {0} from now'.format(readable_time_delta(int(delay)))
 
-import pytz
-import smokesignal
 
-from bson import objectid
-from twisted.internet import reactor
+# The command grammar. Helga splits commands on whitespace, so each pattern
+# matches a single argument
+_in_pattern = re.compile(r'^(\d+)([a-zA-Z])$')
+_at_pattern = re.compile(r'^(\d{1,2}):(\d{2})$')
+_repeat_pattern = re.compile(r'^(?:Su|Sa|Tu|Th|M|W|F)+$')
+_day_pattern = re.compile(r'Su|Sa|Tu|Th|M|W|F')
+_id_pattern = re.compile(r'^[0-9a-fA-F]{24}$')
+_page_pattern = re.compile(r'^\d+$')
+_ordinals_pattern = re.compile(r'^(?:\d{1,2}(?:st|nd|rd|th),?)+$')
 
-from helga import log, settings
-from helga.db import db
-from helga.plugins import command, random_ack
+# pytz zone names are case insensitive
+_zone_names = dict((name.lower(), name) for name in pytz.all_timezones)
 
 
-logger = log.getLogger(__name__)
+class ParseError(ValueError):
+    """
+    A command that doesn't fit the grammar. ``reply`` explains why to the user
+    """
 
+    def __init__(self, reply):
+        super(ParseError, self).__init__(reply)
+        self.reply = reply
 
-in_seconds_map = {
-    'm': 60,
-    'h': 3600,
-    'd': 86400,
-}
 
-# This is how python datetime does it
-days_of_week = {
-    'M':  0,
-    'Tu': 1,
-    'W':  2,
-    'Th': 3,
-    'F':  4,
-    'Sa': 5,
-    'Su': 6,
-}
-days_of_week_lookup = dict((v, k) for k, v in days_of_week.iteritems())
+@_lru_cache(maxsize=64)
+def _timezone(name):
+    return pytz.timezone(name)
 
-_scheduled = set()
 
+def _parse_channel(args, channel):
+    """
+    Split an optional leading 'on <channel>' or 'on <target>,<target>,...' off args.
+    The '#' of a single channel is optional. In a list of targets, names without a
+    '#' are nicks. A list comes back as a list of its distinct targets
+    """
+    if len(args) > 1 and args[0] == 'on':
+        targets = []
+        for target in args[1].split(','):
+            if target and target not in targets:
+                targets.append(target)
 
-@smokesignal.on('signon')
-def init_reminders(client):
-    global _scheduled
+        if len(targets) > 1:
+            return targets, args[2:]
 
-    if db is None:
-        logger.warning('Cannot auto schedule reminders. No database connection')
-        return
+        target = targets[0] if targets else args[1]
+        if not target.startswith('#'):
+            target = '#{0}'.format(target)
+        return target, args[2:]
+    return channel, args
 
-    now = datetime.datetime.utcnow()
-    logger.info("Initializing any scheduled reminders")
 
-    for reminder in db.reminders.find():
-        if reminder['_id'] in _scheduled:
-            continue
+def _parse_in_args(args, channel):
+    """
+    Parse '##(m|h|d) [on <channel>] <message>' into (seconds, channel, message)
+    """
+    match = _in_pattern.match(args[0]) if args else None
 
-        if reminder['when'].tzinfo is not None:
-            now = now.replace(tzinfo=pytz.UTC).astimezone(reminder['when'].tzinfo)
+    if match is None or match.group(2) not in in_seconds_map:
+        raise ParseError(u"Sorry I didn't understand '{0}'. You must specify m,h,d. Ex: 12m".format(
+            args[0] if args else u''))
 
-        diff = reminder['when'] - now
-        delay = (diff.days * 24 * 3600) + diff.seconds
+    channel, args = _parse_channel(args[1:], channel)
+    return int(match.group(1)) * in_seconds_map[match.group(2)], channel, ' '.join(args)
 
-        if delay < 0:
-            logger.warning("Event has already happened :(")
-            if 'repeat' in reminder:
-                reminder['when'], _ = next_occurrence(reminder)
-                db.reminders.save(reminder)
 
-                diff = reminder['when'] - now
-                delay = (diff.days * 24 * 3600) + diff.seconds
-                logger.info('Reminder delayed until next occurrence: %s seconds from now', delay)
-            elif delay >= -60:  # if it's only 1 minute late
-                logger.info("Reminder is only a little late. Go now!")
-                delay = 0
-            else:
-                logger.info("Removing stale, non-repeating reminder")
-                db.reminders.remove(reminder['_id'])
-                continue
+def _parse_at_args(args, channel):
+    """
+    Parse '<HH>:<MM> [<timezone>] [on <channel>] <message> [repeat <rule>]' into
+    (hour, minute, tzinfo, channel, message, stored repeat or None)
+    """
+    hh, mm = _parse_time(args[0] if args else u'')
+    timezone, args = _parse_timezone(args[1:])
+    repeat, args = _parse_repeat(args, hh, mm)
+    channel, args = _parse_channel(args, channel)
+    return hh, mm, timezone, channel, ' '.join(args), repeat
 
-        _scheduled.add(reminder['_id'])
-        reactor.callLater(delay, _do_reminder, reminder['_id'], client)
 
+def _parse_time(arg):
+    """
+    Parse '<HH>:<MM>' into (hour, minute)
+    """
+    match = _at_pattern.match(arg)
+    hh, mm = map(int, match.groups()) if match else (None, None)
 
-def readable_time_delta(seconds):
+    if match is None or hh > 23 or mm > 59:
+        raise ParseError(u"Sorry I didn't understand '{0}'. Times must be <HH>:<MM>. Ex: 13:00".format(arg))
+
+    return hh, mm
+
+
+def _parse_timezone(args):
     """
-    Convert a number of seconds into readable days, hours, and minutes
+    Split an optional leading timezone off args, returning (tzinfo, args). The
+    default is settings.TIMEZONE
     """
-    days = seconds // 86400
-    seconds -= days * 86400
-    hours = seconds // 3600
-    seconds -= hours * 3600
-    minutes = seconds // 60
+    if args and args[0].lower() in _zone_names:
+        return _timezone(_zone_names[args[0].lower()]), args[1:]
+    return _timezone(getattr(settings, 'TIMEZONE', 'US/Eastern')), args
 
-    m_suffix = 's' if minutes != 1 else ''
-    h_suffix = 's' if hours != 1 else ''
-    d_suffix = 's' if days != 1 else ''
 
-    retval = u'{0} minute{1}'.format(minutes, m_suffix)
+def _parse_repeat(args, hh, mm):
+    """
+    Split a trailing repeat rule off args, returning (repeat, args). The repeat is
+    in its stored form: a weekday mask for 'repeat <days_of_week>', 'every <seconds>'
+    for 'repeat every ##(m|h|d)', or five cron fields for 'repeat hourly',
+    'repeat 1st,15th' and 'repeat cron <m> <h> <dom> <mon> <dow>'. Hourly and
+    monthly repeats happen at the reminder's minute and time
+    """
+    if len(args) > 6 and args[-7:-5] == ['repeat', 'cron']:
+        repeat, args = ' '.join(args[-5:]), args[:-7]
+    elif len(args) > 2 and args[-3:-1] == ['repeat', 'every']:
+        match = _in_pattern.match(args[-1])
+        if match is None or match.group(2) not in in_seconds_map:
+            raise ParseError(u"I didn't understand 'every {0}'. Ex: every 15m".format(args[-1]))
+        repeat, args = 'every {0}'.format(int(match.group(1)) * in_seconds_map[match.group(2)]), args[:-3]
+    elif len(args) > 1 and args[-2] == 'repeat':
+        sched, args = args[-1], args[:-2]
+
+        if sched == 'hourly':
+            repeat = '{0} * * * *'.format(mm)
+        elif _ordinals_pattern.match(sched):
+            repeat = '{0} {1} {2} * *'.format(mm, hh, ','.join(re.findall(r'\d+', sched)))
+        elif _repeat_pattern.match(sched):
+            return repeat_mask(days_of_week[day] for day in _day_pattern.findall(sched)), args
+        else:
+            raise ParseError(u"I didn't understand '{0}'. You must use any of M,Tu,W,Th,F,Sa,Su, hourly, "
+                             u"every ##(m|h|d), days of the month or cron. Ex: MWF, every 15m, 1st,15th".format(sched))
+    else:
+        return None, args
 
-    if hours != 0:
-        retval = u'{0} hour{1} and {2}'.format(hours, h_suffix, retval)
+    try:
+        compile_rule(repeat)
+    except ValueError:
+        raise ParseError(u"I didn't understand the repeat '{0}'".format(repeat))
+    return repeat, args
 
-    if days != 0:
-        retval = u'{0} day{1}, {2}'.format(days, d_suffix, retval)
 
-    return retval
+def _parse_bulk_args(args):
+    """
+    Split '<in|at> <args>; <in|at> <args>; ...' into a list of (command, args)
+    """
+    specs = [spec.split() for spec in ' '.join(args).split(';')]
+    specs = [(spec[0], spec[1:]) for spec in specs if spec]
+
+    if not specs:
+        raise ParseError(u'Sorry, there were no reminders. Ex: bulk in 2h lunch; at 17:00 go home')
 
+    for number, (cmd, spec) in enumerate(specs, 1):
+        if cmd not in ('in', 'at'):
+            raise ParseError(u"Reminder {0}: Sorry, each reminder must start with 'in' or 'at'".format(number))
 
-def next_occurrence(reminder):
+    return specs
+
+
+def _parse_id(arg):
     """
-    Calculate the next occurrence of a repeatable reminder
+    Parse a reminder hash into its ObjectId
     """
-    now = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
-    now_dow = now.weekday()
+    if not _id_pattern.match(arg):
+        raise ParseError(u"Invalid ID format '{0}'".format(arg))
+    return objectid.ObjectId(arg)
+
 
-    # Start/end dow starting from tomorrow
-    start_dow = now_dow + 1
-    end_dow = start_dow + 7
+def _parse_snooze_args(args):
+    """
+    Parse '<id> ##(m|h|d)' into (reminder id, seconds)
+    """
+    if len(args) != 2:
+        raise ParseError(u'Sorry, snooze takes a reminder id and a delay. Ex: snooze <id> 10m')
 
-    # Modded range from tomorrow until 1 week from now. Normalizes
-    # wraparound values that span into next week
-    dow_iter = imap(lambda x: x % 7, xrange(start_dow, end_dow))
+    reminder_id = _parse_id(args[0])
+    match = _in_pattern.match(args[1])
 
-    # Filter out any days that aren't in the schedule
-    dow_iter = ifilter(lambda x: x in reminder['repeat'], dow_iter)
+    if match is None or match.group(2) not in in_seconds_map:
+        raise ParseError(u"Sorry I didn't understand '{0}'. You must specify m,h,d. Ex: 10m".format(args[1]))
 
-    # Get the first one. That's the next day of week
-    try:
-        next_dow = next(dow_iter)
-    except StopIteration:  # How?
-        logger.exception("Somehow, we didn't get a next day of week?")
-        _scheduled.discard(reminder['_id'])
-        return
+    return reminder_id, int(match.group(1)) * in_seconds_map[match.group(2)]
 
-    # Get the real day delta. Take the next day of the week. if that day of
-    # the week is before the current day of the week, add a week. Normalize
-    # this value by subtracting the starting point. Example:
-    # Now = 3, Next = 1, Delta = (1 + 7) - 3 = 5
-    day_delta = next_dow
-    if next_dow <= now_dow:
-        day_delta += 7
-    day_delta -= now_dow
 
-    # Update the record
-    return reminder['when'] + datetime.timedelta(days=day_delta), day_delta
+def _parse_move_args(args):
+    """
+    Parse '<id> <HH>:<MM> [<timezone>]' into (reminder id, hour, minute, tzinfo)
+    """
+    if len(args) not in (2, 3):
+        raise ParseError(u'Sorry, move takes a reminder id and a time. Ex: move <id> 17:30')
 
+    reminder_id = _parse_id(args[0])
+    hh, mm = _parse_time(args[1])
+    timezone, rest = _parse_timezone(args[2:])
 
-def _do_reminder(reminder_id, client):
-    global _scheduled
+    if rest:
+        raise ParseError(u"Sorry, I don't know the timezone '{0}'".format(rest[0]))
 
-    reminder = db.reminders.find_one(reminder_id)
-    if not reminder:
-        logger.error('Tried to locate reminder %s, but it returned None', reminder_id)
-        _scheduled.discard(reminder_id)
-        return
+    return reminder_id, hh, mm, timezone
 
-    client.msg(reminder['channel'], reminder['message'])
 
-    # If this repeats, figure out the next time
-    if 'repeat' in reminder:
-        # Update the record
-        reminder['when'], day_delta = next_occurrence(reminder)
-        db.reminders.save(reminder)
+def _parse_list_args(args, channel):
+    """
+    Parse the arguments of 'reminders list [channel] [page N]' into (channel, page)
+    """
+    page = 1
 
-        _scheduled.add(reminder_id)
-        reactor.callLater(day_delta * 86400, _do_reminder, reminder_id, client)
-    else:
-        _scheduled.discard(reminder_id)
-        db.reminders.remove(reminder_id)
+    if len(args) >= 2 and args[-2] == 'page':
+        if _page_pattern.match(args[-1]):
+            page = max(int(args[-1]), 1)
+        args = args[:-2]
+
+    return (args[0] if args else channel), page
 
 
 def in_reminder(client, channel, nick, args):
@@ -184,40 +2108,37 @@ def in_reminder(client, channel, nick, args):
         <sduncan> helga in 12h on bots submit timesheet
 
     Note that the '#' char for specifying the channel is entirely optional.
-    """
-    global _scheduled
 
-    amount, quantity = int(args[0][:-1]), args[0][-1]
+    Several channels and nicks can be given as a comma separated list, in which case
+    names without a '#' are nicks. The reminder is delivered to all of them:
+
+        <sduncan> helga in 30m on #work,#ops,sduncan deploy freeze starts
+    """
+    try:
+        reminder, delay = _new_in_reminder(channel, nick, args)
+    except ParseError as e:
+        return e.reply
 
-    # Handle ability to specify the channel
-    if args[1] == 'on':
-        target_channel = args[2]
-        message = ' '.join(args[3:])
+    return _insert_reminder(reminder, delay, client)
 
-        # Make sure channel is formatted correctly
-        if not target_channel.startswith('#'):
-            target_channel = '#{0}'.format(target_channel)
-    else:
-        target_channel = channel
-        message = ' '.join(args[1:])
 
-    if quantity not in in_seconds_map:
-        return u"Sorry I didn't understand '{0}'. You must specify m,h,d. Ex: 12m".format(args[0])
+def _new_in_reminder(channel, nick, args):
+    """
+    Build the document for an 'in' reminder, returning (reminder, delay)
+    """
+    seconds, target_channel, message = _parse_in_args(args, channel)
 
-    seconds = amount * in_seconds_map[quantity]
     utcnow = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
     delta = datetime.timedelta(seconds=seconds)
 
-    id = db.reminders.insert({
+    reminder = {
         'when': utcnow + delta,
         'message': message,
         'channel': target_channel,
         'creator': nick,
-    })
+    }
 
-    _scheduled.add(id)
-    reactor.callLater(seconds, _do_reminder, id, client)
-    return u'Reminder set for {0} from now'.format(readable_time_delta(seconds))
+    return reminder, seconds
 
 
 def at_reminder(client, channel, nick, args):
@@ -231,6 +2152,10 @@ def at_reminder(client, channel, nick, args):
     of any of the following days: M, Tu, W, Th, F, Sa, Su. For example, 'repeat MWF'
     will repeat a reminder at the same time every Monday, Wednesday, and Friday.
 
+    Other repeats are 'repeat hourly' at the reminder's minute, 'repeat every 15m' (or
+    h or d), 'repeat 1st,15th' at the reminder's time on those days of the month, and
+    'repeat cron <minute> <hour> <day of month> <month> <day of week>'.
+
     A full example of how one would use this:
 
         <sduncan> helga at 13:00 EST standup time repeat MTuWThF
@@ -246,137 +2171,630 @@ def at_reminder(client, channel, nick, args):
 
     Note that the '#' char for specifying the channel is entirely optional.
     """
-    global _scheduled
-
-    now = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
+    try:
+        reminder, delay = _new_at_reminder(channel, nick, args)
+    except ParseError as e:
+        return e.reply
 
-    # Parse the time it should go off, and the minute offset of the day
-    hh, mm = map(int, args[0].split(':'))
+    return _insert_reminder(reminder, delay, client)
 
-    # Strip time from args
-    args = args[1:]
 
-    # Default timezone
-    timezone = pytz.timezone(getattr(settings, 'TIMEZONE', 'US/Eastern'))
+def _new_at_reminder(channel, nick, args):
+    """
+    Build the document for an 'at' reminder, returning (reminder, delay)
+    """
+    hh, mm, timezone, target_channel, message, repeat = _parse_at_args(args, channel)
 
-    try:
-        # If there was a timezone passed in
-        timezone = pytz.timezone(args[0])
-    except pytz.UnknownTimeZoneError:
-        pass
-    else:
-        # If so, remove it from args
-        args = args[1:]
+    now = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
+    when = _next_time(hh, mm, timezone, now)
 
-    local_now = now.astimezone(timezone)
-    local_next = local_now.replace(hour=hh, minute=mm)
+    # Start on the first time the rule allows, judged in the reminder's timezone
+    if repeat is not None:
+        rule = compile_rule(repeat)
+        if not rule.matches(when):
+            when = rule.next(when, when, timezone)
 
-    if local_next <= local_now:
-        local_next += datetime.timedelta(days=1)
+        if when is None:
+            raise ParseError(u"Sorry, '{0}' never happens".format(rule.describe()))
 
     reminder = {
-        'when': local_next.astimezone(pytz.UTC),
-        'channel': channel,
-        'message': ' '.join(args),
+        'when': when.astimezone(pytz.UTC),
+        'timezone': timezone.zone,
+        'channel': target_channel,
+        'message': message,
         'creator': nick,
     }
 
-    # Check for 'repeat' arg
-    try:
-        repeat = args[-2] == 'repeat'
-    except IndexError:
-        repeat = False
+    if repeat is not None:
+        reminder['repeat'] = repeat
+
+    return reminder, (reminder['when'] - now).total_seconds()
 
-    if repeat:
-        # If repeating, strip off the last two for the message
-        sched = args[-1]
-        reminder['message'] = ' '.join(args[:-2])
-        repeat_days = sorted([v for k, v in days_of_week.iteritems() if k in sched])
 
-        if not repeat_days:
-            return u"I didn't understand '{0}'. You must use any of M,Tu,W,Th,F,Sa,Su. Ex: MWF".format(sched)
+def _next_time(hh, mm, timezone, now):
+    """
+    The first <HH>:<MM> on the wall clock in timezone that is after now
+    """
+    date = now.astimezone(timezone).date()
+    when = _local(timezone, date, datetime.time(hh, mm))
+
+    if when <= now:
+        when = _local(timezone, date + datetime.timedelta(days=1), datetime.time(hh, mm))
+
+    return when
 
-        reminder['repeat'] = repeat_days
 
-        for attempt in xrange(7):
-            if reminder['when'].weekday() in repeat_days:
-                break
-            reminder['when'] += datetime.timedelta(days=1)
+def bulk_reminders(client, channel, nick, args):
+    """
+    Create several 'in' and 'at' reminders at once, separated by semicolons:
+
+        <sduncan> helga reminders bulk at 09:30 standup repeat MTuWThF; in 2h on #ops deploy; at 17:00 wrap up
+
+    Either every reminder is set or, if any of them can't be understood, none are.
+    They are stored with a single insert and answered with a single reply.
+    """
+    new = {'in': _new_in_reminder, 'at': _new_at_reminder}
+    batch = []
 
-    # Handle ability to specify the channel
-    if reminder['message'].startswith('on'):
-        parts = reminder['message'].split(' ')
-        chan = parts[1]
-        reminder['message'] = ' '.join(parts[2:])
+    try:
+        specs = _parse_bulk_args(args)
+        for number, (cmd, spec) in enumerate(specs, 1):
+            try:
+                batch.append(new[cmd](channel, nick, spec))
+            except ParseError as e:
+                raise ParseError(u'Reminder {0}: {1}'.format(number, e.reply))
+    except ParseError as e:
+        return e.reply
 
-        # Make sure channel is formatted correctly
-        if not chan.startswith('#'):
-            chan = '#{0}'.format(chan)
-        reminder['channel'] = chan
+    return _insert_reminders(batch, client)
 
-    id = db.reminders.insert(reminder)
 
-    diff = reminder['when'] - now
-    delay = (diff.days * 24 * 3600) + diff.seconds
+def list_reminders(client, nick, channel, page=1):
+    """
+    Send one page of a channel's reminders to nick, soonest first. Only the fields
+    needed for the listing are read, and each reminder goes out as its own line
+    through the flood-controlled delivery queue
+    """
+    size = getattr(settings, 'REMINDERS_LIST_PAGE_SIZE', 10)
 
-    _scheduled.add(id)
-    reactor.callLater(delay, _do_reminder, id, client)
-    return u'Reminder set for {0} from now'.format(readable_time_delta(delay))
+    # Ask for one extra to find out whether there is another page
+    d = _store.for_channel(channel, skip=(page - 1) * size, limit=size + 1)
+    return d.addCallback(_send_reminder_list, client, nick, channel, page, size)
 
 
-def list_reminders(client, nick, channel):
+def _send_reminder_list(records, client, nick, channel, page, size):
     reminders = []
 
-    for reminder in db.reminders.find({'channel': channel}):
+    for reminder in records[:size]:
         about = u"[{0}] At {1}: '{2}'"
         when = reminder['when'].strftime('%m/%d/%y %H:%M UTC')
 
         about = about.format(str(reminder['_id']), when, reminder['message'])
 
         if 'repeat' in reminder:
-            days = [days_of_week_lookup[value] for value in reminder['repeat']]
-            about = u'{0} (Repeat every {1})'.format(about, ','.join(days))
+            about = u'{0} (Repeat {1})'.format(about, compile_rule(reminder['repeat']).describe())
+
+        if isinstance(reminder.get('channel'), list):
+            about = u'{0} (To {1})'.format(about, u', '.join(reminder['channel']))
 
         reminders.append(about)
 
     if not reminders:
-        client.msg(nick, u'There are no reminders for channel: {0}'.format(channel))
+        if page > 1:
+            reminders.append(u'There is no page {0} of reminders for channel: {1}'.format(page, channel))
+        else:
+            reminders.append(u'There are no reminders for channel: {0}'.format(channel))
+    else:
+        header = u'{0}, here are the reminders for channel: {1}'.format(nick, channel)
+        if page > 1 or len(records) > size:
+            header = u'{0} (page {1})'.format(header, page)
+        reminders.insert(0, header)
+
+        if len(records) > size:
+            reminders.append(u"Use 'reminders list {0} page {1}' to see more".format(channel, page + 1))
+
+    for line in reminders:
+        _delivery.put(client, nick, line, coalesce=False)
+    _delivery.flush()
+
+
+def history_reminders(client, nick, channel):
+    """
+    Send the most recent deliveries on a channel to nick, newest first. This only
+    reads the reminders_history collection, never the reminders being scheduled
+    """
+    size = getattr(settings, 'REMINDERS_LIST_PAGE_SIZE', 10)
+    d = _store.history(channel, size)
+    return d.addCallback(_send_history, client, nick, channel)
+
+
+def _send_history(entries, client, nick, channel):
+    if not entries:
+        lines = [u'There is no reminder history for channel: {0}'.format(channel)]
     else:
-        reminders.insert(0,  u'{0}, here are the reminders for channel: {1}'.format(nick, channel))
-        client.msg(nick, '\n'.join(reminders))
+        lines = [u'{0}, here are the latest reminders for channel: {1}'.format(nick, channel)]
+
+    for entry in entries:
+        if entry['delivered'] is None:
+            about = u"[{0}] Dropped, was due {1}: '{2}'"
+            when = entry['when']
+        else:
+            about = u"[{0}] Delivered {1}: '{2}'"
+            when = entry['delivered']
+        when = when.strftime('%m/%d/%y %H:%M UTC')
+        lines.append(about.format(str(entry['reminder_id']), when, entry['message']))
+
+    for line in lines:
+        _delivery.put(client, nick, line, coalesce=False)
+    _delivery.flush()
 
 
 def delete_reminder(channel, id):
-    try:
-        id = objectid.ObjectId(id)
-    except objectid.InvalidId:
+    if not _id_pattern.match(id):
         return u"Invalid ID format '{0}'".format(id)
 
-    rec = db.reminders.find_one({'_id': id})
+    id = objectid.ObjectId(id)
+    return _store.get(id).addCallback(_delete_found, id)
 
-    if rec is not None:
-        db.reminders.remove(rec['_id'])
-        return random_ack()
-    else:
+
+def _delete_found(rec, id):
+    if rec is None:
         return u"No reminder found with id '{0}'".format(id)
 
+    _forget_reminder(rec['_id'])
+    return _store.remove(rec['_id']).addCallback(lambda _: random_ack())
+
+
+def snooze_reminder(client, args):
+    """
+    Push a stored reminder back to some number of minutes, hours, or days from now:
+
+        <sduncan> helga reminders snooze 54f529958973817f30dead5a 10m
+    """
+    try:
+        reminder_id, seconds = _parse_snooze_args(args)
+    except ParseError as e:
+        return e.reply
+
+    utcnow = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
+    when = utcnow + datetime.timedelta(seconds=seconds)
+
+    if reminder_id in _cache:
+        d = defer.succeed(_cache[reminder_id])
+    else:
+        d = _store.get(reminder_id).addCallback(lambda doc: doc and Reminder.from_doc(doc, message=False))
+
+    return d.addCallback(_snooze_found, reminder_id, when, seconds, client)
+
+
+def _snooze_found(reminder, reminder_id, when, delay, client):
+    """
+    Snooze only the pending occurrence. A repeating reminder keeps the occurrence
+    it was snoozed from as its anchor, so later occurrences keep their time
+    """
+    if reminder is None:
+        return u"No reminder found with id '{0}'".format(reminder_id)
+
+    fields = {'when': when}
+    if reminder.repeat is not None:
+        fields['anchor'] = reminder.when if reminder.anchor is None else reminder.anchor
+
+    return _move_reminder(reminder_id, fields, delay, client)
+
+
+def move_reminder(client, args):
+    """
+    Move a stored reminder to the next <HH>:<MM>, in the given timezone or
+    settings.TIMEZONE:
+
+        <sduncan> helga reminders move 54f529958973817f30dead5a 17:30 US/Eastern
+
+    A repeating reminder carries on repeating from its new time.
+    """
+    try:
+        reminder_id, hh, mm, timezone = _parse_move_args(args)
+    except ParseError as e:
+        return e.reply
+
+    utcnow = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
+    when = _next_time(hh, mm, timezone, utcnow).astimezone(pytz.UTC)
+
+    # Moving replaces any snooze, so the rule repeats from the new time
+    return _move_reminder(reminder_id, {'when': when, 'anchor': None}, (when - utcnow).total_seconds(), client)
+
+
+def _move_reminder(reminder_id, fields, delay, client):
+    """
+    Set a stored reminder's 'when', and whatever else is in ``fields``, with a
+    single atomic update, then move its pending timer rather than adding another.
+    ``delay`` is how far off 'when' was when the command was given, which is what
+    the reply reports
+    """
+    if _coordinator is not None and reminder_id not in _cache:
+        # Whoever holds the lease loses it at their next renewal and stops scheduling
+        # the old time. The reminder is then claimed again at its new one
+        fields['lease'] = None
+
+    return _store.update(reminder_id, fields).addCallback(_reminder_moved, reminder_id, delay, client)
+
+
+def _reminder_moved(doc, reminder_id, delay, client):
+    if doc is None:
+        return u"No reminder found with id '{0}'".format(reminder_id)
+
+    moved = Reminder.from_doc(doc, message=False)
+
+    reminder = _cache.get(reminder_id)
+    if reminder is not None:
+        reminder.when = moved.when
+        reminder.anchor = moved.anchor
+    elif _coordinator is None:
+        reminder = moved
+
+    # The timer counts from now, after the database round trip
+    if reminder is not None:
+        _schedule_reminder(reminder, _seconds_until(moved.utc, datetime.datetime.utcnow()), client)
+
+    return u'Reminder rescheduled for {0} from now'.format(readable_time_delta(int(delay)))
+
+
+def diagnose():
+    """
+    Check the query plan of each query the plugin relies on and warn about any
+    that would scan the whole reminders collection
+    """
+    return _store.explain().addCallback(_report_plans)
+
+
+def _report_plans(plans):
+    unindexed = sorted(name for name, indexed in plans.iteritems() if not indexed)
+
+    for name in unindexed:
+        logger.warning('Reminder query %s is not using an index', name)
+
+    if not unindexed:
+        return u'All reminder queries are using an index'
+    return u'Reminder queries not using an index: {0}'.format(', '.join(unindexed))
+
+
+def stats():
+    """
+    Summarize how reminders have been firing since startup
+    """
+    counters = _metrics.counters
+    parts = [u'{0} pending, {1} fired, {2} rescheduled, {3} stale dropped, {4} waiting to send'.format(
+        len(_scheduler), counters['fired'], counters['rescheduled'], counters['stale_dropped'], _delivery.depth)]
+
+    histogram = _metrics.lag_histogram()
+    if histogram:
+        parts.append(u'Fire lag {0}, max {1:.1f}s'.format(
+            u', '.join(u'{0}: {1}'.format(label, count) for label, count in histogram), _metrics.max_lag))
+
+    if _delivery.depth or _delivery.last_lag:
+        parts.append(u'Delivery lag {0:.1f}s, last line waited {1:.1f}s'.format(_delivery.lag, _delivery.last_lag))
+
+    if _metrics.timings:
+        parts.append(u'DB calls/avg ms/max ms {0}'.format(u', '.join(
+            u'{0} {1}/{2:.1f}/{3:.1f}'.format(name[3:], calls, total * 1000 / calls, slowest * 1000)
+            for name, (calls, total, slowest) in sorted(_metrics.timings.iteritems()))))
+
+    return u'. '.join(parts)
+
+
+def profile(client, nick, args):
+    """
+    Turn profiling on, optionally with a new sample rate, or off, or report on it.
+    Only operators may change it
+    """
+    if args and nick not in client.operators:
+        return u'Sorry {0}, only operators can change profiling'.format(nick)
+
+    if args and args[0] == 'on':
+        try:
+            sample_rate = float(args[1]) if len(args) > 1 else None
+        except ValueError:
+            return u"I didn't understand the sample rate '{0}'. Ex: 0.1".format(args[1])
+        _profiler.start(sample_rate)
+    elif args and args[0] == 'off':
+        _profiler.stop()
+        return u'Profiling off. {0} samples written to {1}'.format(_profiler.samples, _profiler.path)
+
+    if not _profiler.enabled:
+        return u'Profiling is off'
+
+    return u'Profiling {0:.0%} of calls, {1} samples so far, written to {2} every {3}s'.format(
+        _profiler.sample_rate, _profiler.samples, _profiler.path, _profiler.interval)
+
+
+def _respond_later(client, channel, response):
+    """
+    Plain responses go straight back to helga. Deferred responses are sent to the
+    channel once the database has acknowledged the change
+    """
+    if not isinstance(response, defer.Deferred):
+        return response
+
+    def send(response):
+        if response:
+            client.msg(channel, response)
+
+    def failed(failure):
+        _log_failure(failure, 'Reminder command failed')
+        client.msg(channel, u'Sorry, I could not reach the reminders database')
+
+    response.addCallbacks(send, failed)
+    raise ResponseNotReady
+
 
 @command('reminders', aliases=['in', 'at'],
          help="Schedule reminders. Usage: helga ("
               "in ##(m|h|d) [on <channel>] <message>|"
-              "at <HH>:<MM> [<timezone>] [on <channel>] <message> [repeat <days_of_week]|"
-              "list [channel]|"
-              "delete <id>). "
+              "at <HH>:<MM> [<timezone>] [on <channel>] <message> [repeat <rule>]|"
+              "list [channel] [page <n>]|"
+              "history [channel]|"
+              "delete <id>|"
+              "snooze <id> ##(m|h|d)|"
+              "move <id> <HH>:<MM> [<timezone>]|"
+              "bulk <in or at reminder>; <in or at reminder>...|"
+              "diagnose|"
+              "stats|"
+              "profile [on [<sample rate>]|off]). "
               "Ex: 'helga in 12h take out the trash' or 'helga at 13:00 EST standup time repeat MTuWThF'")
+@_profiler.profiled
 def reminders(client, channel, nick, message, cmd, args):
     if cmd == 'in':
-        return in_reminder(client, channel, nick, args)
+        return _respond_later(client, channel, in_reminder(client, channel, nick, args))
     elif cmd == 'at':
-        return at_reminder(client, channel, nick, args)
+        return _respond_later(client, channel, at_reminder(client, channel, nick, args))
     elif cmd == 'reminders':
         if args[0] == 'list':
             client.me(channel, u'whispers to {0}'.format(nick))
-            list_reminders(client, nick, (args[1] if len(args) >= 2 else channel))
+            d = list_reminders(client, nick, *_parse_list_args(args[1:], channel))
+            d.addErrback(_log_failure, 'Could not list reminders')
+            return None
+        elif args[0] == 'history':
+            client.me(channel, u'whispers to {0}'.format(nick))
+            d = history_reminders(client, nick, args[1] if len(args) > 1 else channel)
+            d.addErrback(_log_failure, 'Could not show reminder history')
             return None
         elif args[0] == 'delete':
-            return delete_reminder(channel, args[1])
+            return _respond_later(client, channel, delete_reminder(channel, args[1]))
+        elif args[0] == 'snooze':
+            return _respond_later(client, channel, snooze_reminder(client, args[1:]))
+        elif args[0] == 'move':
+            return _respond_later(client, channel, move_reminder(client, args[1:]))
+        elif args[0] == 'bulk':
+            return _respond_later(client, channel, bulk_reminders(client, channel, nick, args[1:]))
+        elif args[0] == 'diagnose':
+            return _respond_later(client, channel, diagnose())
+        elif args[0] == 'stats':
+            return stats()
+        elif args[0] == 'profile':
+            return profile(client, nick, args[1:])
+
+
+# Fields a stored reminder may have. Leases only mean something to the running
+# instances, so they are left out of exports
+reminder_fields = ('_id', 'when', 'channel', 'message', 'creator', 'repeat', 'timezone', 'partition', 'anchor')
+
+json_time_format = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def validate_reminder(doc):
+    """
+    Check a reminder document against the schema in_reminder and at_reminder
+    produce, and return a copy with _id as an ObjectId and 'when' as a naive UTC
+    datetime. Raises ValueError describing the first problem found
+    """
+    unknown = set(doc) - set(reminder_fields) - set(['lease'])
+    if unknown:
+        raise ValueError('unknown fields {0}'.format(', '.join(sorted(unknown))))
+
+    for field in ('when', 'channel', 'message'):
+        if field not in doc:
+            raise ValueError('missing {0}'.format(field))
+
+    reminder = dict((field, doc[field]) for field in reminder_fields if field in doc)
+
+    if '_id' in reminder and not isinstance(reminder['_id'], objectid.ObjectId):
+        if not objectid.ObjectId.is_valid(reminder['_id']):
+            raise ValueError('_id is not an ObjectId')
+        reminder['_id'] = objectid.ObjectId(reminder['_id'])
+
+    when = reminder['when']
+    if isinstance(when, basestring):
+        try:
+            when = datetime.datetime.strptime(when, json_time_format)
+        except ValueError:
+            raise ValueError('when is not a {0} time'.format(json_time_format))
+    if not isinstance(when, datetime.datetime):
+        raise ValueError('when is not a time')
+    reminder['when'] = _utc_naive(when)
+
+    for field in ('message', 'creator', 'timezone'):
+        if field in reminder and not isinstance(reminder[field], basestring):
+            raise ValueError('{0} is not a string'.format(field))
+
+    channel = reminder['channel']
+    if isinstance(channel, list):
+        if not channel or not all(isinstance(target, basestring) for target in channel):
+            raise ValueError('channel is not a list of targets')
+        if len(set(channel)) < len(channel):
+            raise ValueError('channel repeats a target')
+    elif not isinstance(channel, basestring):
+        raise ValueError('channel is not a string')
+
+    if 'timezone' in reminder and reminder['timezone'] not in pytz.all_timezones_set:
+        raise ValueError('unknown timezone {0}'.format(reminder['timezone']))
+
+    if 'partition' in reminder and not isinstance(reminder['partition'], (int, long, type(None))):
+        raise ValueError('partition is not a number')
+
+    if 'anchor' in reminder and not isinstance(reminder['anchor'], (int, long, float, type(None))):
+        raise ValueError('anchor is not a number')
+
+    if 'repeat' in reminder:
+        repeat = reminder['repeat']
+        if isinstance(repeat, (int, long)):
+            valid = 0 < repeat < 128
+        elif isinstance(repeat, list):
+            valid = bool(repeat) and all(isinstance(day, (int, long)) and 0 <= day < 7 for day in repeat)
+        else:
+            valid = isinstance(repeat, basestring)
+
+        try:
+            if not valid:
+                raise ValueError
+            rule = compile_rule(repeat)
+        except ValueError:
+            raise ValueError('repeat {0!r} is not a valid rule'.format(repeat))
+
+        when = reminder['when'].replace(tzinfo=pytz.UTC)
+        if rule.next(when, when, _timezone(reminder.get('timezone', 'UTC'))) is None:
+            raise ValueError('repeat {0!r} never happens'.format(repeat))
+
+    return reminder
+
+
+def dump_reminder(doc):
+    """
+    A stored reminder as one line of JSON
+    """
+    doc = dict((field, doc[field]) for field in reminder_fields if field in doc)
+    doc['_id'] = str(doc['_id'])
+    doc['when'] = _utc_naive(doc['when']).strftime(json_time_format)
+    return json.dumps(doc, sort_keys=True)
+
+
+def load_reminder(line):
+    """
+    A reminder from one line of JSON written by dump_reminder
+    """
+    try:
+        doc = json.loads(line)
+    except ValueError:
+        raise ValueError('not JSON')
+
+    if not isinstance(doc, dict):
+        raise ValueError('not a JSON object')
+    return validate_reminder(doc)
+
+
+def export_reminders(backend, out, batch_size=1000):
+    """
+    Write every stored reminder to ``out`` as JSON Lines, reading ``batch_size``
+    at a time. Returns the number written
+    """
+    count = 0
+    for doc in backend.scan(batch_size):
+        out.write(dump_reminder(doc) + '\n')
+        count += 1
+    return count
+
+
+def import_reminders(backend, lines, batch_size=1000, rebuild=False, utcnow=None, errors=None):
+    """
+    Insert reminders from JSON Lines, ``batch_size`` at a time. Reminders that are
+    already stored are left alone. Invalid lines are skipped and reported to
+    ``errors``, if given, with their line number.
+
+    With ``rebuild``, repeating reminders whose 'when' has passed are moved to
+    their next occurrence after ``utcnow``, and those that will never repeat again
+    are skipped.
+
+    Returns (inserted, skipped)
+    """
+    if utcnow is None:
+        utcnow = datetime.datetime.utcnow()
+    now = utcnow.replace(tzinfo=pytz.UTC)
+
+    inserted = skipped = 0
+    batch = []
+
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+
+        try:
+            reminder = load_reminder(line)
+        except ValueError as e:
+            skipped += 1
+            if errors is not None:
+                errors.write('line {0}: {1}\n'.format(number, e))
+            continue
+
+        if rebuild and 'repeat' in reminder and reminder['when'] < utcnow:
+            reminder['when'] = next_occurrence(reminder, now)
+            if reminder['when'] is None:
+                skipped += 1
+                if errors is not None:
+                    errors.write('line {0}: will never repeat again\n'.format(number))
+                continue
+
+        batch.append(reminder)
+        if len(batch) >= batch_size:
+            inserted += backend.insert_many(batch)
+            batch = []
+
+    if batch:
+        inserted += backend.insert_many(batch)
+
+    return inserted, skipped
+
+
+def main(argv=None):
+    """
+    The helga-reminders console script. Streams the reminders stored by the backend
+    in settings.REMINDERS_BACKEND out to JSON Lines and back in
+    """
+    # The memory backend would start empty and be thrown away on exit
+    stored = sorted(name for name in backends if name != 'memory')
+
+    parser = argparse.ArgumentParser(prog='helga-reminders',
+                                     description='Export and import helga reminders as JSON Lines')
+    parser.add_argument('--backend', choices=stored,
+                        help='where reminders are stored (default: settings.REMINDERS_BACKEND)')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='reminders read or inserted per database call')
+    subparsers = parser.add_subparsers(dest='action')
+
+    export = subparsers.add_parser('export', help='write every reminder out')
+    export.add_argument('file', nargs='?', default='-', help='where to write them (default: stdout)')
+
+    load = subparsers.add_parser('import', help='store reminders from a previous export')
+    load.add_argument('file', nargs='?', default='-', help='where to read them (default: stdin)')
+    load.add_argument('--rebuild-when', action='store_true',
+                      help='move repeating reminders that have passed to their next occurrence')
+
+    args = parser.parse_args(argv)
+    name = args.backend or getattr(settings, 'REMINDERS_BACKEND', 'mongo')
+    if name not in stored:
+        parser.error('the {0} backend does not store reminders between runs, use --backend'.format(name))
+
+    backend = backends[name]()
+
+    if not backend.available:
+        sys.stderr.write('No database connection\n')
+        return 1
+
+    backend.ensure_indexes()
+
+    if args.action == 'export':
+        out = sys.stdout if args.file == '-' else open(args.file, 'w')
+        try:
+            count = export_reminders(backend, out, args.batch_size)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        sys.stderr.write('Exported {0} reminders\n'.format(count))
+        return 0
+
+    lines = sys.stdin if args.file == '-' else open(args.file)
+    try:
+        inserted, skipped = import_reminders(backend, lines, args.batch_size,
+                                             rebuild=args.rebuild_when, errors=sys.stderr)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+    sys.stderr.write('Imported {0} reminders, skipped {1}\n'.format(inserted, skipped))
+    return 1 if skipped else 0
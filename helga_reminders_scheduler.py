@@ -0,0 +1,264 @@
+"""
+The scheduling core of helga-reminders: a heap of due items driven by a single
+timer from a clock. Nothing here depends on an event loop. A clock is anything
+with ``seconds()`` and ``callLater(delay, func, *args, **kwargs)``, where the call
+returned has ``active()``, ``cancel()`` and ``getTime()``. That is exactly what
+Twisted's reactor and ``twisted.internet.task.Clock`` provide, so TwistedClock
+only defers importing the reactor. AsyncioClock adapts an asyncio event loop, or
+any loop with the same ``time()`` and ``call_at()``, such as uvloop's.
+"""
+import heapq
+import itertools
+import logging
+
+try:
+    import asyncio
+except ImportError:  # Python 2
+    asyncio = None
+
+
+logger = logging.getLogger(__name__)
+
+# Marker for heap entries that have been cancelled
+_REMOVED = object()
+
+
+class TwistedClock(object):
+    """
+    The Twisted reactor as a clock. The reactor is only imported when first used
+    """
+
+    @property
+    def reactor(self):
+        from twisted.internet import reactor
+        return reactor
+
+    def seconds(self):
+        return self.reactor.seconds()
+
+    def callLater(self, delay, func, *args, **kwargs):
+        return self.reactor.callLater(delay, func, *args, **kwargs)
+
+
+class AsyncioClock(object):
+    """
+    An asyncio event loop as a clock. Times come from the loop's monotonic
+    ``time()``. Without a loop, the current asyncio event loop is used
+    """
+
+    def __init__(self, loop=None):
+        if loop is None:
+            if asyncio is None:
+                raise RuntimeError('asyncio is not available on this version of Python')
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+
+    def seconds(self):
+        return self.loop.time()
+
+    def callLater(self, delay, func, *args, **kwargs):
+        return AsyncioCall(self.loop, self.loop.time() + max(delay, 0), func, args, kwargs)
+
+
+class AsyncioCall(object):
+    """
+    A timer on an asyncio loop, with the interface of Twisted's DelayedCall that
+    the Scheduler uses
+    """
+
+    def __init__(self, loop, time, func, args, kwargs):
+        self.time = time
+        self.called = False
+        self.cancelled = False
+        self._handle = loop.call_at(time, self._run, func, args, kwargs)
+
+    def _run(self, func, args, kwargs):
+        self.called = True
+        func(*args, **kwargs)
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        self.cancelled = True
+        self._handle.cancel()
+
+    def getTime(self):
+        return self.time
+
+
+_twisted = TwistedClock()
+
+
+class Scheduler(object):
+    """
+    Keeps every pending reminder in a single heap ordered by deadline and arms
+    exactly one clock timer for the earliest of them. Scheduling, cancelling
+    and rescheduling are all O(log n); cancelled entries are left in the heap
+    and skipped when they surface, with a periodic compaction to keep the heap
+    from filling up with them.
+
+    Usage mirrors ``clock.callLater`` with an extra key, which is used to
+    find the entry again later::
+
+        scheduler.schedule(reminder_id, 60, _do_reminder, reminder_id, client)
+        scheduler.reschedule(reminder_id, 120)
+        scheduler.cancel(reminder_id)
+
+    Entries added with ``schedule_batch`` are collected when they come due, along
+    with anything else due within ``tolerance`` seconds, and passed as one list of
+    keys to a single ``func(keys, *args)`` call per distinct func and args.
+    """
+
+    def __init__(self, clock=None, tolerance=0):
+        self.clock = clock
+        self.tolerance = tolerance
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._timer = None
+
+    @property
+    def _clock(self):
+        return self.clock or _twisted
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def schedule(self, key, delay, func, *args, **kwargs):
+        """
+        Schedule ``func(*args, **kwargs)`` to run ``delay`` seconds from now. Any
+        existing entry for ``key`` is replaced
+        """
+        self._push(key, delay, func, args, kwargs, False)
+
+    def schedule_batch(self, key, delay, func, *args):
+        """
+        Schedule ``key`` to be passed to ``func(keys, *args)`` ``delay`` seconds from
+        now, together with every other batch entry due at the same time. Any existing
+        entry for ``key`` is replaced
+        """
+        self._push(key, delay, func, args, {}, True)
+
+    def schedule_batches(self, entries, func, *args):
+        """
+        schedule_batch for many (key, delay) entries at once. The heap is rebuilt
+        rather than pushed to when the batch is large, and the timer is armed once
+        """
+        now = self._clock.seconds()
+        for key, delay in entries:
+            self.cancel(key)
+
+        added = []
+        for key, delay in entries:
+            entry = [now + max(delay, 0), next(self._counter), key, func, args, {}, True]
+            self._entries[key] = entry
+            added.append(entry)
+
+        if len(added) > len(self._heap):
+            self._heap.extend(added)
+            heapq.heapify(self._heap)
+        else:
+            for entry in added:
+                heapq.heappush(self._heap, entry)
+
+        self._arm()
+
+    def reschedule(self, key, delay):
+        """
+        Move an existing entry so that it runs ``delay`` seconds from now. Returns
+        False if nothing is scheduled for ``key``
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+
+        self._push(key, delay, *entry[3:])
+        return True
+
+    def cancel(self, key):
+        """
+        Cancel the entry for ``key`` if there is one. Returns True if an entry was cancelled
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+
+        entry[2] = _REMOVED
+
+        # Rebuild once cancelled entries make up most of the heap
+        if len(self._heap) > 2 * len(self._entries) + 32:
+            self._heap = [e for e in self._heap if e[2] is not _REMOVED]
+            heapq.heapify(self._heap)
+
+        return True
+
+    def _push(self, key, delay, func, args, kwargs, batch):
+        self.cancel(key)
+
+        deadline = self._clock.seconds() + max(delay, 0)
+        entry = [deadline, next(self._counter), key, func, args, kwargs, batch]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        self._arm()
+
+    def _arm(self):
+        """
+        Make sure the single timer is set for the earliest live deadline
+        """
+        heap = self._heap
+        while heap and heap[0][2] is _REMOVED:
+            heapq.heappop(heap)
+
+        if not heap:
+            if self._timer is not None and self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+            return
+
+        deadline = heap[0][0]
+
+        if self._timer is not None and self._timer.active():
+            # An earlier timer will re-arm when it runs
+            if self._timer.getTime() <= deadline:
+                return
+            self._timer.cancel()
+
+        delay = max(deadline - self._clock.seconds(), 0)
+        self._timer = self._clock.callLater(delay, self._run)
+
+    def _run(self):
+        self._timer = None
+        cutoff = self._clock.seconds() + self.tolerance
+        heap = self._heap
+        calls = []
+        batches = {}
+
+        # Collect everything due before running any of it, so that callbacks which
+        # reschedule themselves are not picked up again in this pass
+        while heap and heap[0][0] <= cutoff:
+            entry = heapq.heappop(heap)
+            if entry[2] is _REMOVED:
+                continue
+
+            key, func, args, kwargs, batch = entry[2:]
+            del self._entries[key]
+
+            if not batch:
+                calls.append((key, func, args, kwargs))
+            elif (func, args) in batches:
+                batches[func, args].append(key)
+            else:
+                keys = batches[func, args] = [key]
+                calls.append((keys, func, (keys,) + args, {}))
+
+        for key, func, args, kwargs in calls:
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception('Scheduled call for %s failed', key)
+
+        self._arm()
@@ -23,7 +23,7 @@ setup(
     author_email="shaun.duncan@gmail.com",
     url="https://github.com/shaunduncan/helga-reminders",
     packages=find_packages(),
-    py_modules=['helga_reminders'],
+    py_modules=['helga_reminders', 'helga_reminders_scheduler'],
     include_package_data=True,
     install_requires=[
         'pytz',
@@ -33,5 +33,8 @@ setup(
         helga_plugins=[
             'reminders = helga_reminders:reminders',
         ],
+        console_scripts=[
+            'helga-reminders = helga_reminders:main',
+        ],
     ),
 )
@@ -1,95 +1,221 @@
 # -*- coding: utf8 -*-
 import datetime
+import pstats
+import time
+
+from StringIO import StringIO
 
 import pytest
 import pytz
 
+from bson import objectid
 from freezegun import freeze_time
+from helga.plugins import ResponseNotReady
 from mock import Mock, patch
+from pymongo import DeleteMany, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from twisted.internet import defer
+from twisted.internet.task import Clock
 
 import helga_reminders as reminders
 
 
+# Run database calls on the test thread rather than in the pool
+reminders._store = reminders.ReminderStore(inline=True)
+
+
+def result_of(d):
+    results = []
+    d.addBoth(results.append)
+    return results[0]
+
+
 class TestDoReminder(object):
 
     def setup(self):
-        reminders._scheduled.add(1)
-        self.rec = {'channel': '#bots', 'message': 'some message'}
+        reminders._scheduler = reminders.Scheduler(clock=Clock())
+        reminders._scheduler.schedule(1, 60, Mock())
+        reminders._delivery = reminders.DeliveryQueue(clock=Clock())
+        reminders._cache.clear()
         self.now = datetime.datetime(day=11, month=12, year=2013)  # A wednesday
+        self.rec = {'_id': 1, 'when': self.now, 'channel': '#bots', 'message': 'some message'}
         self.client = Mock()
 
     @patch('helga_reminders.db')
     def test_do_reminder_simple(self, db):
-        db.reminders.find_one.return_value = self.rec
+        db.reminders.find.return_value = [self.rec]
         reminders._do_reminder(1, self.client)
 
-        assert 1 not in reminders._scheduled
-        db.reminders.remove.assert_called_with(1)
+        assert 1 not in reminders._scheduler
+        db.reminders.find.assert_called_with({'_id': {'$in': [1]}})
+        db.reminders.bulk_write.assert_called_with([DeleteMany({'_id': {'$in': [1]}})], ordered=False)
         self.client.msg.assert_called_with('#bots', 'some message')
 
     @patch('helga_reminders.db')
-    @patch('helga_reminders.reactor')
-    def test_do_reminder_reschedules_same_week(self, reactor, db):
+    @patch('helga_reminders._scheduler')
+    def test_do_reminder_reschedules_same_week(self, scheduler, db):
         self.rec['when'] = self.now
         self.rec['repeat'] = [0, 2, 4]  # M, W, F
-        db.reminders.find_one.return_value = self.rec
+        db.reminders.find.return_value = [self.rec]
 
         with freeze_time(self.now):
             reminders._do_reminder(1, self.client)
 
-        rec_upd = self.rec.copy()
-        rec_upd['when'] = datetime.datetime(day=13, month=12, year=2013)
+        when = datetime.datetime(day=13, month=12, year=2013)
 
-        db.reminders.save.assert_called_with(rec_upd)
-        reactor.callLater.assert_called_with(48 * 3600, reminders._do_reminder, 1, self.client)
+        db.reminders.bulk_write.assert_called_with([UpdateOne({'_id': 1}, {'$set': {'when': when}})], ordered=False)
+        scheduler.schedule_batch.assert_called_with(1, 48 * 3600, reminders._do_reminders, self.client)
 
     @patch('helga_reminders.db')
-    @patch('helga_reminders.reactor')
-    def test_do_reminder_reschedules_next_week(self, reactor, db):
+    @patch('helga_reminders._scheduler')
+    def test_do_reminder_reschedules_next_week(self, scheduler, db):
         self.rec['when'] = datetime.datetime(day=13, month=12, year=2013)
         self.rec['repeat'] = [0, 2, 4]  # M, W, F
-        db.reminders.find_one.return_value = self.rec
+        db.reminders.find.return_value = [self.rec]
 
         with freeze_time(self.rec['when']):
             reminders._do_reminder(1, self.client)
 
-        rec_upd = self.rec.copy()
-        rec_upd['when'] = datetime.datetime(day=16, month=12, year=2013)
+        when = datetime.datetime(day=16, month=12, year=2013)
 
-        db.reminders.save.assert_called_with(rec_upd)
-        reactor.callLater.assert_called_with(72 * 3600, reminders._do_reminder, 1, self.client)
+        db.reminders.bulk_write.assert_called_with([UpdateOne({'_id': 1}, {'$set': {'when': when}})], ordered=False)
+        scheduler.schedule_batch.assert_called_with(1, 72 * 3600, reminders._do_reminders, self.client)
 
-    @patch('helga_reminders._scheduled')
     @patch('helga_reminders.db')
-    def test_scheduled_discarded_with_no_record(self, db, scheduled):
-        db.reminders.find_one.return_value = None
+    def test_scheduled_discarded_with_no_record(self, db):
+        db.reminders.find.return_value = []
         reminders._do_reminder(1, Mock())
-        scheduled.discard.assert_called_with(1)
+        assert 1 not in reminders._scheduler
+        assert not db.reminders.bulk_write.called
+
+    @patch('helga_reminders.db')
+    def test_fires_from_cache(self, db):
+        reminders._cache[1] = reminders.Reminder.from_doc(self.rec)
+        reminders._do_reminder(1, self.client)
+
+        assert not db.reminders.find.called
+        assert 1 not in reminders._cache
+        db.reminders.bulk_write.assert_called_with([DeleteMany({'_id': {'$in': [1]}})], ordered=False)
+        self.client.msg.assert_called_with('#bots', 'some message')
+
+    @patch('helga_reminders.db')
+    @patch('helga_reminders._scheduler')
+    def test_repeat_stays_cached(self, scheduler, db):
+        self.rec['when'] = self.now
+        self.rec['repeat'] = [0, 2, 4]
+        reminders._cache[1] = reminders.Reminder.from_doc(self.rec)
+
+        with freeze_time(self.now):
+            reminders._do_reminder(1, self.client)
+
+        assert not db.reminders.find.called
+        assert reminders._cache[1].utc == datetime.datetime(day=13, month=12, year=2013)
+
+    @patch('helga_reminders.db')
+    @patch('helga_reminders._scheduler')
+    def test_batch_uses_single_bulk_write(self, scheduler, db):
+        repeat = {'_id': 2, 'channel': '#bots', 'message': 'standup', 'when': self.now, 'repeat': [0, 2, 4]}
+        other = {'_id': 3, 'when': self.now, 'channel': '#foo', 'message': 'lunch'}
+        reminders._cache[1] = reminders.Reminder.from_doc(self.rec)
+        db.reminders.find.return_value = [repeat, other]
+
+        with freeze_time(self.now):
+            reminders._do_reminders([1, 2, 3], self.client)
+
+        db.reminders.find.assert_called_once_with({'_id': {'$in': [2, 3]}})
+        db.reminders.bulk_write.assert_called_once_with([
+            UpdateOne({'_id': 2}, {'$set': {'when': datetime.datetime(day=13, month=12, year=2013)}}),
+            DeleteMany({'_id': {'$in': [1, 3]}}),
+        ], ordered=False)
+        self.client.msg.assert_any_call('#bots', 'some message | standup')
+        self.client.msg.assert_any_call('#foo', 'lunch')
 
     @patch('helga_reminders.db')
     def test_handles_unicode(self, db):
         client = Mock()
         snowman = u'☃'
         reminder = {
+            '_id': 1,
+            'when': datetime.datetime(day=13, month=12, year=2013),
             'channel': snowman,
             'message': snowman,
         }
-        db.reminders.find_one.return_value = reminder
+        db.reminders.find.return_value = [reminder]
         reminders._do_reminder(1, client)
         client.msg.assert_called_with(snowman, snowman)
 
 
+class TestReminderRecord(object):
+
+    def setup(self):
+        self.now = datetime.datetime(2013, 12, 13, 12, 30, 15, 123456)
+        self.doc = {
+            '_id': objectid.ObjectId(),
+            'when': self.now,
+            'channel': u'#bots',
+            'message': u'standup',
+            'creator': 'me',
+            'repeat': [0, 2, 4],
+            'timezone': 'US/Eastern',
+            'partition': 3,
+        }
+
+    def test_round_trip(self):
+        reminder = reminders.Reminder.from_doc(self.doc)
+
+        assert reminder.when == 1386937815.123456
+        assert reminder.repeat == 21
+
+        del self.doc['creator']
+        assert reminder.to_doc() == dict(self.doc, repeat=21)
+
+    def test_aware_when(self):
+        reminder = reminders.Reminder.from_doc(dict(self.doc, when=pytz.UTC.localize(self.now)))
+        assert reminder.utc == self.now
+
+    def test_compact(self):
+        first = reminders.Reminder.from_doc(self.doc)
+        second = reminders.Reminder.from_doc(dict(self.doc, channel=u''.join([u'#', u'bots'])), message=False)
+
+        assert not hasattr(first, '__dict__')
+        assert second.channel is first.channel
+        assert second.timezone is first.timezone
+        assert second.message is None
+        assert 'message' not in second.to_doc()
+
+    def test_fetches_messages_not_kept(self):
+        backend = reminders.MemoryBackend()
+        backend.insert(self.doc)
+        client = Mock()
+
+        with patch.object(reminders, '_store', reminders.ReminderStore(backend, inline=True)), \
+                patch.object(reminders, '_scheduler', reminders.Scheduler(clock=Clock())), \
+                patch.object(reminders, '_delivery', reminders.DeliveryQueue(clock=Clock())), \
+                patch.object(reminders, '_cache', {}), \
+                patch.object(backend, 'get_many', wraps=backend.get_many) as get_many:
+            reminders._schedule_reminder(reminders.Reminder.from_doc(self.doc, message=False), 0, client)
+
+            with freeze_time(self.now):
+                reminders._scheduler._clock.advance(0)
+
+            get_many.assert_called_once_with([self.doc['_id']])
+            client.msg.assert_called_with('#bots', 'standup')
+
+            # The repeat keeps the message it fetched
+            assert reminders._cache[self.doc['_id']].message == 'standup'
+
+
 class TestInReminder(object):
 
     def setup(self):
-        reminders._scheduled.clear()
+        reminders._scheduler = reminders.Scheduler(clock=Clock())
         self.client = Mock()
         self.now = datetime.datetime(day=13, month=12, year=2013)
 
     @pytest.mark.parametrize('channel', ['#foo', 'foo'])
     def test_in_reminder_for_different_channel(self, channel):
         with patch('helga_reminders.db') as db:
-            with patch('helga_reminders.reactor'):
+            with patch('helga_reminders._scheduler'):
                 db.reminders.insert.return_value = 1
 
                 with freeze_time(self.now):
@@ -101,8 +227,8 @@ class TestInReminder(object):
                 assert inserted['message'] == 'this is the message'
 
     @patch('helga_reminders.db')
-    @patch('helga_reminders.reactor')
-    def test_in_reminder_for_minutes(self, reactor, db):
+    @patch('helga_reminders._scheduler')
+    def test_in_reminder_for_minutes(self, scheduler, db):
         db.reminders.insert.return_value = 1
 
         with freeze_time(self.now):
@@ -112,11 +238,11 @@ class TestInReminder(object):
 
         assert inserted['message'] == 'this is the message'
         assert inserted['channel'] == '#bots'
-        assert reactor.callLater.call_args[0] == (12 * 60, reminders._do_reminder, 1, self.client)
+        assert scheduler.schedule_batch.call_args[0] == (1, 12 * 60, reminders._do_reminders, self.client)
 
     @patch('helga_reminders.db')
-    @patch('helga_reminders.reactor')
-    def test_in_reminder_for_hours(self, reactor, db):
+    @patch('helga_reminders._scheduler')
+    def test_in_reminder_for_hours(self, scheduler, db):
         db.reminders.insert.return_value = 1
 
         with freeze_time(self.now):
@@ -126,11 +252,11 @@ class TestInReminder(object):
 
         assert inserted['message'] == 'this is the message'
         assert inserted['channel'] == '#bots'
-        assert reactor.callLater.call_args[0] == (12 * 3600, reminders._do_reminder, 1, self.client)
+        assert scheduler.schedule_batch.call_args[0] == (1, 12 * 3600, reminders._do_reminders, self.client)
 
     @patch('helga_reminders.db')
-    @patch('helga_reminders.reactor')
-    def test_in_reminder_for_days(self, reactor, db):
+    @patch('helga_reminders._scheduler')
+    def test_in_reminder_for_days(self, scheduler, db):
         db.reminders.insert.return_value = 1
 
         with freeze_time(self.now):
@@ -140,7 +266,21 @@ class TestInReminder(object):
 
         assert inserted['message'] == 'this is the message'
         assert inserted['channel'] == '#bots'
-        assert reactor.callLater.call_args[0] == (12 * 24 * 3600, reminders._do_reminder, 1, self.client)
+        assert scheduler.schedule_batch.call_args[0] == (1, 12 * 24 * 3600, reminders._do_reminders, self.client)
+
+    @patch('helga_reminders.db')
+    @patch('helga_reminders._scheduler')
+    def test_in_reminder_counts_from_stored_time(self, scheduler, db):
+        with freeze_time(self.now) as frozen:
+            def slow_insert(reminder):
+                frozen.tick(datetime.timedelta(seconds=5))
+                return 1
+
+            db.reminders.insert.side_effect = slow_insert
+            resp = result_of(reminders.in_reminder(self.client, '#bots', 'me', ['12m', 'message']))
+
+        assert resp == 'Reminder set for 12 minutes from now'
+        assert scheduler.schedule_batch.call_args[0] == (1, 12 * 60 - 5, reminders._do_reminders, self.client)
 
     def test_in_reminder_for_unknown(self):
         resp = reminders.in_reminder(self.client, '#bots', 'me', ['12x', 'this', 'is', 'the', 'message'])
@@ -157,12 +297,12 @@ class TestAtReminder(object):
 
         self.tz = pytz.timezone('US/Eastern')
 
-        reminders._scheduled.clear()
+        reminders._scheduler = reminders.Scheduler(clock=Clock())
 
     @pytest.mark.parametrize('channel', ['#foo', 'foo'])
     def test_using_different_channel_and_with_repeat(self, channel):
         with patch('helga_reminders.db') as db:
-            with patch('helga_reminders.reactor'):
+            with patch('helga_reminders._scheduler'):
                 args = ['13:00', 'on', channel, 'test', 'message', 'repeat', 'MWF']
                 db.reminders.insert.return_value = 1
 
@@ -177,7 +317,7 @@ class TestAtReminder(object):
     @pytest.mark.parametrize('channel', ['#foo', 'foo'])
     def test_using_different_channel(self, channel):
         with patch('helga_reminders.db') as db:
-            with patch('helga_reminders.reactor'):
+            with patch('helga_reminders._scheduler'):
                 args = ['13:00', 'on', channel, 'this is a message']
                 db.reminders.insert.return_value = 1
 
@@ -192,7 +332,7 @@ class TestAtReminder(object):
     @pytest.mark.parametrize('channel', ['#foo', 'foo'])
     def test_using_different_channel_when_timezone_present(self, channel):
         with patch('helga_reminders.db') as db:
-            with patch('helga_reminders.reactor'):
+            with patch('helga_reminders._scheduler'):
                 args = ['13:00', 'EST', 'on', '#foo', 'this is a message']
                 db.reminders.insert.return_value = 1
 
@@ -205,8 +345,8 @@ class TestAtReminder(object):
                 assert rec['message'] == 'this is a message'
 
     @patch('helga_reminders.db')
-    @patch('helga_reminders.reactor')
-    def test_no_tz_no_repeat_in_future(self, reactor, db):
+    @patch('helga_reminders._scheduler')
+    def test_no_tz_no_repeat_in_future(self, scheduler, db):
         args = ['13:00', 'this is a message']
         db.reminders.insert.return_value = 1
 
@@ -224,11 +364,11 @@ class TestAtReminder(object):
         assert when == expect
         assert rec['channel'] == '#bots'
         assert rec['message'] == 'this is a message'
-        reactor.callLater.assert_called_with(1*3600, reminders._do_reminder, 1, self.client)
+        scheduler.schedule_batch.assert_called_with(1, 1*3600, reminders._do_reminders, self.client)
 
     @patch('helga_reminders.db')
-    @patch('helga_reminders.reactor')
-    def test_no_tz_no_repeat_in_past(self, reactor, db):
+    @patch('helga_reminders._scheduler')
+    def test_no_tz_no_repeat_in_past(self, scheduler, db):
         args = ['6:00', 'this is a message']
         db.reminders.insert.return_value = 1
 
@@ -246,11 +386,11 @@ class TestAtReminder(object):
         assert when == expect
         assert rec['channel'] == '#bots'
         assert rec['message'] == 'this is a message'
-        reactor.callLater.assert_called_with(18*3600, reminders._do_reminder, 1, self.client)
+        scheduler.schedule_batch.assert_called_with(1, 18*3600, reminders._do_reminders, self.client)
 
     @patch('helga_reminders.db')
-    @patch('helga_reminders.reactor')
-    def test_tz_no_repeat_in_future(self, reactor, db):
+    @patch('helga_reminders._scheduler')
+    def test_tz_no_repeat_in_future(self, scheduler, db):
         args = ['13:00', 'US/Central', 'this is a message']
         db.reminders.insert.return_value = 1
 
@@ -268,11 +408,11 @@ class TestAtReminder(object):
         assert when == expect
         assert rec['channel'] == '#bots'
         assert rec['message'] == 'this is a message'
-        reactor.callLater.assert_called_with(1*3600, reminders._do_reminder, 1, self.client)
+        scheduler.schedule_batch.assert_called_with(1, 1*3600, reminders._do_reminders, self.client)
 
     @patch('helga_reminders.db')
-    @patch('helga_reminders.reactor')
-    def test_tz_no_repeat_in_past(self, reactor, db):
+    @patch('helga_reminders._scheduler')
+    def test_tz_no_repeat_in_past(self, scheduler, db):
         args = ['6:00', 'US/Central', 'this is a message']
         db.reminders.insert.return_value = 1
 
@@ -290,11 +430,11 @@ class TestAtReminder(object):
         assert when == expect
         assert rec['channel'] == '#bots'
         assert rec['message'] == 'this is a message'
-        reactor.callLater.assert_called_with(18*3600, reminders._do_reminder, 1, self.client)
+        scheduler.schedule_batch.assert_called_with(1, 18*3600, reminders._do_reminders, self.client)
 
     @patch('helga_reminders.db')
-    @patch('helga_reminders.reactor')
-    def test_tz_repeat_in_future(self, reactor, db):
+    @patch('helga_reminders._scheduler')
+    def test_tz_repeat_in_future(self, scheduler, db):
         args = ['13:00', 'US/Central', 'this is a message', 'repeat', 'MWF']
         db.reminders.insert.return_value = 1
 
@@ -311,12 +451,12 @@ class TestAtReminder(object):
         assert when == expect
         assert rec['channel'] == '#bots'
         assert rec['message'] == 'this is a message'
-        assert rec['repeat'] == [0, 2, 4]
-        reactor.callLater.assert_called_with(1*3600, reminders._do_reminder, 1, self.client)
+        assert rec['repeat'] == 0b10101  # M, W, F
+        scheduler.schedule_batch.assert_called_with(1, 1*3600, reminders._do_reminders, self.client)
 
     @patch('helga_reminders.db')
-    @patch('helga_reminders.reactor')
-    def test_tz_repeat_in_past(self, reactor, db):
+    @patch('helga_reminders._scheduler')
+    def test_tz_repeat_in_past(self, scheduler, db):
         args = ['6:00', 'US/Central', 'this is a message', 'repeat', 'MWF']
         db.reminders.insert.return_value = 1
 
@@ -333,23 +473,96 @@ class TestAtReminder(object):
         assert when == expect
         assert rec['channel'] == '#bots'
         assert rec['message'] == 'this is a message'
-        assert rec['repeat'] == [0, 2, 4]
-        reactor.callLater.assert_called_with(42*3600, reminders._do_reminder, 1, self.client)
+        assert rec['repeat'] == 0b10101  # M, W, F
+        scheduler.schedule_batch.assert_called_with(1, 42*3600, reminders._do_reminders, self.client)
 
     @patch('helga_reminders.db')
-    @patch('helga_reminders.reactor')
-    def test_invalid_days_returns_warning(self, reactor, db):
+    @patch('helga_reminders._scheduler')
+    def test_repeat_days_are_local(self, scheduler, db):
+        args = ['23:00', 'US/Eastern', 'this is a message', 'repeat', 'M']
+        db.reminders.insert.return_value = 1
+
+        # Sunday 20:00 in New York is already Monday in UTC
+        with freeze_time(datetime.datetime(day=16, month=12, year=2013, hour=1, second=30, microsecond=250000)):
+            reminders.at_reminder(self.client, '#bots', 'me', args)
+
+        rec = db.reminders.insert.call_args[0][0]
+        when = rec['when'].astimezone(self.tz).replace(tzinfo=None)
+
+        assert when == datetime.datetime(day=16, month=12, year=2013, hour=23)
+        assert rec['timezone'] == 'US/Eastern'
+        scheduler.schedule_batch.assert_called_with(1, 27 * 3600 - 30.25, reminders._do_reminders, self.client)
+
+    @patch('helga_reminders.db')
+    @patch('helga_reminders._scheduler')
+    def test_invalid_days_returns_warning(self, scheduler, db):
         # Invalid chars
         args = ['6:00', 'US/Central', 'this is a message', 'repeat', 'XYZ']
         assert "I didn't understand" in reminders.at_reminder(self.client, '#bots', 'me', args)
         assert not db.reminders.insert.called
-        assert not reactor.callLater.called
+        assert not scheduler.schedule_batch.called
 
         # No chars
         args = ['6:00', 'US/Central', 'this is a message', 'repeat', '']
         assert "I didn't understand" in reminders.at_reminder(self.client, '#bots', 'me', args)
         assert not db.reminders.insert.called
-        assert not reactor.callLater.called
+        assert not scheduler.schedule_batch.called
+
+
+class TestBulkReminders(object):
+
+    def setup(self):
+        self.backend = reminders.MemoryBackend()
+        self.client = Mock()
+        self.now = datetime.datetime(day=13, month=12, year=2013, hour=12)
+
+    def bulk(self, command):
+        with patch.object(reminders, '_store', reminders.ReminderStore(self.backend, inline=True)), \
+                patch.object(reminders, '_scheduler', reminders.Scheduler(clock=Clock())), \
+                patch.object(reminders, '_cache', {}), \
+                patch.object(reminders.settings, 'TIMEZONE', 'UTC', create=True), \
+                patch.object(self.backend, 'insert_many', wraps=self.backend.insert_many) as insert_many, \
+                freeze_time(self.now):
+            resp = reminders.bulk_reminders(self.client, '#bots', 'me', command.split())
+            if isinstance(resp, defer.Deferred):
+                resp = result_of(resp)
+            return resp, insert_many, reminders._scheduler
+
+    def test_stores_with_one_insert(self):
+        resp, insert_many, scheduler = self.bulk(
+            'at 13:30 standup repeat MTuWThF; in 2h on ops deploy; at 17:00 wrap up ;')
+
+        assert resp == '3 reminders set, the first for 1 hour and 30 minutes from now'
+        assert insert_many.call_count == 1
+
+        docs = list(self.backend.scan())
+        assert sorted((doc['channel'], doc['message']) for doc in docs) == [
+            ('#bots', 'standup'), ('#bots', 'wrap up'), ('#ops', 'deploy')]
+        assert [doc['repeat'] for doc in docs if 'repeat' in doc] == [31]
+        assert all(doc['_id'] in scheduler for doc in docs)
+        assert len(scheduler._clock.getDelayedCalls()) == 1
+
+    @pytest.mark.parametrize('command,reply', [
+        ('', 'Sorry, there were no reminders'),
+        ('in 2h lunch; later go home', "Reminder 2: Sorry, each reminder must start with 'in' or 'at'"),
+        ('in 2h lunch; in 2x go home', "Reminder 2: Sorry I didn't understand '2x'"),
+        ('at 12:00 x repeat cron 0 0 30 2 *', "Reminder 1: Sorry, 'cron 0 0 30 2 *' never happens"),
+    ])
+    def test_all_or_nothing(self, command, reply):
+        resp, insert_many, scheduler = self.bulk(command)
+
+        assert resp.startswith(reply)
+        assert not insert_many.called
+        assert len(scheduler) == 0
+
+    def test_subcommand(self):
+        with patch('helga_reminders.bulk_reminders') as bulk_reminders:
+            bulk_reminders.return_value = 'ok'
+            resp = reminders.reminders(self.client, '#bots', 'me', 'message', 'reminders',
+                                       ['bulk', 'in', '2h', 'lunch'])
+
+        assert resp == 'ok'
+        bulk_reminders.assert_called_with(self.client, '#bots', 'me', ['in', '2h', 'lunch'])
 
 
 class TestReadableTime(object):
@@ -387,6 +600,16 @@ class TestListReminders(object):
             'when': datetime.datetime(year=2013, month=12, day=11, hour=13, minute=15, tzinfo=pytz.UTC),
             'message': 'Standup Time!',
         }
+        self.db_patch = patch('helga_reminders.db')
+        self.db = self.db_patch.start()
+        self.results = self.db.reminders.find.return_value.sort.return_value.skip.return_value.limit
+        reminders._delivery = reminders.DeliveryQueue(clock=Clock(), burst=100)
+
+    def teardown(self):
+        self.db_patch.stop()
+
+    def lines(self, client):
+        return [c[0][1] for c in client.msg.call_args_list]
 
     @patch('helga_reminders.list_reminders')
     def test_list_reponds_via_privmsg(self, list_reminders):
@@ -394,7 +617,7 @@ class TestListReminders(object):
 
         assert reminders.reminders(client, '#all', 'sduncan', 'reminders list', 'reminders', ['list']) is None
         client.me.assert_called_with('#all', 'whispers to sduncan')
-        list_reminders.assert_called_with(client, 'sduncan', '#all')
+        list_reminders.assert_called_with(client, 'sduncan', '#all', 1)
 
     @patch('helga_reminders.list_reminders')
     def test_list_reponds_via_privmsg_for_specific_chan(self, list_reminders):
@@ -403,51 +626,103 @@ class TestListReminders(object):
         assert reminders.reminders(client, '#all', 'sduncan', 'reminders list #bots',
                                    'reminders', ['list', '#bots']) is None
         client.me.assert_called_with('#all', 'whispers to sduncan')
-        list_reminders.assert_called_with(client, 'sduncan', '#bots')
-
-    @patch('helga_reminders.db')
-    def test_list_no_results(self, db):
+        list_reminders.assert_called_with(client, 'sduncan', '#bots', 1)
+
+    @pytest.mark.parametrize('args,expect', [
+        ([], ('#all', 1)),
+        (['#bots'], ('#bots', 1)),
+        (['page', '3'], ('#all', 3)),
+        (['#bots', 'page', '2'], ('#bots', 2)),
+        (['#bots', 'page', 'x'], ('#bots', 1)),
+        (['#bots', 'page', '0'], ('#bots', 1)),
+    ])
+    def test_parse_list_args(self, args, expect):
+        assert reminders._parse_list_args(args, '#all') == expect
+
+    def test_list_no_results(self):
         client = Mock()
-        db.reminders.find.return_value = []
+        self.results.return_value = []
         reminders.list_reminders(client, 'sduncan', '#bots')
 
         client.msg.assert_called_with('sduncan', "There are no reminders for channel: #bots")
 
-    @patch('helga_reminders.db')
-    def test_simple(self, db):
+    def test_projected_sorted_query(self):
+        self.results.return_value = []
+        reminders.list_reminders(Mock(), 'sduncan', '#bots', page=3)
+
+        self.db.reminders.find.assert_called_with(
+            {'channel': '#bots'}, {'_id': True, 'when': True, 'channel': True, 'message': True, 'repeat': True})
+        self.db.reminders.find.return_value.sort.assert_called_with('when', 1)
+        self.db.reminders.find.return_value.sort.return_value.skip.assert_called_with(20)
+        self.results.assert_called_with(11)
+
+    def test_simple(self):
         client = Mock()
-        client.msg = client
 
-        db.reminders.find.return_value = [self.rec]
+        self.results.return_value = [self.rec]
         reminders.list_reminders(client, 'sduncan', '#bots')
 
-        client.msg.assert_called_with(
-            'sduncan',
-            "sduncan, here are the reminders for channel: #bots\n"
-            "[{0}] At 12/11/13 13:15 UTC: 'Standup Time!'".format(self.rec['_id'])
-        )
+        assert self.lines(client) == [
+            "sduncan, here are the reminders for channel: #bots",
+            "[{0}] At 12/11/13 13:15 UTC: 'Standup Time!'".format(self.rec['_id']),
+        ]
 
-    @patch('helga_reminders.db')
-    def test_with_repeats(self, db):
+    def test_with_repeats(self):
         client = Mock()
-        client.msg = client
 
         self.rec['repeat'] = [0, 2, 4]
-        db.reminders.find.return_value = [self.rec]
+        self.results.return_value = [self.rec]
+        reminders.list_reminders(client, 'sduncan', '#bots')
+
+        assert self.lines(client) == [
+            "sduncan, here are the reminders for channel: #bots",
+            "[{0}] At 12/11/13 13:15 UTC: 'Standup Time!' (Repeat every M,W,F)".format(self.rec['_id']),
+        ]
+
+    @patch('helga_reminders.settings.REMINDERS_LIST_PAGE_SIZE', 2, create=True)
+    def test_more_pages(self):
+        client = Mock()
+
+        self.results.return_value = [self.rec] * 3
         reminders.list_reminders(client, 'sduncan', '#bots')
 
-        client.msg.assert_called_with(
-            'sduncan',
-            "sduncan, here are the reminders for channel: #bots\n"
-            "[{0}] At 12/11/13 13:15 UTC: 'Standup Time!' (Repeat every M,W,F)".format(self.rec['_id'])
-        )
+        lines = self.lines(client)
+        assert len(lines) == 4
+        assert lines[0] == "sduncan, here are the reminders for channel: #bots (page 1)"
+        assert lines[-1] == "Use 'reminders list #bots page 2' to see more"
+
+    def test_past_last_page(self):
+        client = Mock()
+        self.results.return_value = []
+        reminders.list_reminders(client, 'sduncan', '#bots', page=2)
+
+        client.msg.assert_called_with('sduncan', "There is no page 2 of reminders for channel: #bots")
+
+    def test_rate_limited(self):
+        client = Mock()
+        reminders._delivery = reminders.DeliveryQueue(clock=Clock(), burst=2)
+
+        self.results.return_value = [self.rec] * 5
+        reminders.list_reminders(client, 'sduncan', '#bots')
+
+        assert client.msg.call_count == 2
+        assert reminders._delivery.depth == 4
 
 
 class TestInitReminders(object):
 
-    @patch('helga_reminders.reactor')
+    def setup(self):
+        self.task_patch = patch('helga_reminders.task')
+        self.task = self.task_patch.start()
+
+    def teardown(self):
+        self.task_patch.stop()
+        reminders._horizon_end = None
+        reminders._refill = None
+
+    @patch('helga_reminders._scheduler')
     @patch('helga_reminders.db')
-    def test_ignores_scheduled_reminder(self, db, reactor):
+    def test_ignores_scheduled_reminder(self, db, scheduler):
         records = [
             {
                 '_id': 1234567890,
@@ -456,13 +731,13 @@ class TestInitReminders(object):
         ]
         db.reminders.find.return_value = records
 
-        with patch.object(reminders, '_scheduled', set([1234567890])):
-            reminders.init_reminders(Mock())
-            assert not reactor.callLater.called
+        scheduler.__contains__.return_value = True
+        reminders.init_reminders(Mock())
+        assert not scheduler.schedule_batch.called
 
-    @patch('helga_reminders.reactor')
+    @patch('helga_reminders._scheduler')
     @patch('helga_reminders.db')
-    def test_schedules_reminder(self, db, reactor):
+    def test_schedules_reminder(self, db, scheduler):
         records = [
             {
                 '_id': 1234567890,
@@ -473,10 +748,9 @@ class TestInitReminders(object):
 
         with freeze_time(records[0]['when']):
             client = Mock()
-            with patch.object(reminders, '_scheduled', set()):
-                reminders.init_reminders(client)
-                assert 1234567890 in reminders._scheduled
-                reactor.callLater.assert_called_with(0, reminders._do_reminder, 1234567890, client)
+            scheduler.__contains__.return_value = False
+            reminders.init_reminders(client)
+            scheduler.schedule_batch.assert_called_with(1234567890, 0, reminders._do_reminders, client)
 
     @patch('helga_reminders.db')
     def test_with_stale_reminder(self, db):
@@ -490,14 +764,15 @@ class TestInitReminders(object):
 
         with freeze_time(records[0]['when'] + datetime.timedelta(days=1)):
             client = Mock()
-            with patch.object(reminders, '_scheduled', set()):
+            with patch.object(reminders, '_scheduler', reminders.Scheduler(clock=Clock())):
                 reminders.init_reminders(client)
-                assert 1234567890 not in reminders._scheduled
-                db.reminders.remove.assert_called_with(1234567890)
+                assert 1234567890 not in reminders._scheduler
+                db.reminders.bulk_write.assert_called_with([DeleteMany({'_id': {'$in': [1234567890]}})],
+                                                           ordered=False)
 
-    @patch('helga_reminders.reactor')
+    @patch('helga_reminders._scheduler')
     @patch('helga_reminders.db')
-    def test_with_late_reminder(self, db, reactor):
+    def test_with_late_reminder(self, db, scheduler):
         records = [
             {
                 '_id': 1234567890,
@@ -508,14 +783,14 @@ class TestInitReminders(object):
 
         with freeze_time(records[0]['when'] + datetime.timedelta(seconds=60)):
             client = Mock()
-            with patch.object(reminders, '_scheduled', set()):
-                reminders.init_reminders(client)
-                assert 1234567890 in reminders._scheduled
-                reactor.callLater.assert_called_with(0, reminders._do_reminder, 1234567890, client)
+            scheduler.__contains__.return_value = False
+            reminders.init_reminders(client)
+            scheduler.schedule_batch.assert_called_with(1234567890, 0, reminders._do_reminders, client)
 
-    @patch('helga_reminders.reactor')
+    @patch('helga_reminders.settings.REMINDERS_HORIZON_HOURS', 48, create=True)
+    @patch('helga_reminders._scheduler')
     @patch('helga_reminders.db')
-    def test_with_repeated_reminder(self, db, reactor):
+    def test_with_repeated_reminder(self, db, scheduler):
         records = [
             {
                 '_id': 1234567890,
@@ -527,16 +802,153 @@ class TestInitReminders(object):
 
         with freeze_time(records[0]['when'] + datetime.timedelta(seconds=300)):
             client = Mock()
-            with patch.object(reminders, '_scheduled', set()):
-                reminders.init_reminders(client)
-                assert 1234567890 in reminders._scheduled
-                # It's 300 seconds, late. Should be 1 day from that point
-                reactor.callLater.assert_called_with(86400 - 300, reminders._do_reminder, 1234567890, client)
-                db.reminders.save.assert_called_with({
-                    '_id': 1234567890,
-                    'when': datetime.datetime(day=14, month=12, year=2013),
-                    'repeat': range(7),
-                })
+            scheduler.__contains__.return_value = False
+            reminders.init_reminders(client)
+            # It's 300 seconds, late. Should be 1 day from that point
+            scheduler.schedule_batch.assert_called_with(1234567890, 86400 - 300, reminders._do_reminders, client)
+            db.reminders.bulk_write.assert_called_with([
+                UpdateOne({'_id': 1234567890}, {'$set': {'when': datetime.datetime(day=14, month=12, year=2013)}}),
+            ], ordered=False)
+
+
+    @patch('helga_reminders.settings.REMINDERS_HORIZON_HOURS', 48, create=True)
+    @patch('helga_reminders._scheduler')
+    @patch('helga_reminders.db')
+    def test_bulk_catch_up(self, db, scheduler):
+        now = datetime.datetime(day=13, month=12, year=2013)
+        records = [
+            {'_id': 1, 'when': now - datetime.timedelta(minutes=5), 'repeat': 0b1111111},
+            {'_id': 2, 'when': now - datetime.timedelta(days=2)},
+            {'_id': 3, 'when': now - datetime.timedelta(hours=2), 'repeat': 0b1111111},
+            {'_id': 4, 'when': now - datetime.timedelta(hours=1)},
+            {'_id': 5, 'when': now + datetime.timedelta(hours=1)},
+        ]
+        db.reminders.find.return_value = records
+        scheduler.__contains__.return_value = False
+
+        with freeze_time(now):
+            reminders.init_reminders(Mock())
+
+        db.reminders.bulk_write.assert_called_once_with([
+            UpdateOne({'_id': 1}, {'$set': {'when': now + datetime.timedelta(hours=23, minutes=55)}}),
+            UpdateOne({'_id': 3}, {'$set': {'when': now + datetime.timedelta(hours=22)}}),
+            DeleteMany({'_id': {'$in': [2, 4]}}),
+        ], ordered=False)
+        assert not db.reminders.save.called
+        assert not db.reminders.remove.called
+        assert scheduler.schedule_batch.call_count == 3
+
+    @patch('helga_reminders._scheduler')
+    @patch('helga_reminders.db')
+    def test_loads_only_horizon(self, db, scheduler):
+        db.reminders.find.return_value = []
+        now = datetime.datetime(day=13, month=12, year=2013)
+
+        with freeze_time(now):
+            reminders.init_reminders(Mock())
+
+        db.reminders.find.assert_called_with({'when': {'$lt': now + datetime.timedelta(hours=6)}})
+        assert reminders._horizon_end == now + datetime.timedelta(hours=6)
+
+    @patch('helga_reminders._scheduler')
+    @patch('helga_reminders.db')
+    def test_starts_refill(self, db, scheduler):
+        client = Mock()
+        db.reminders.find.return_value = []
+
+        reminders.init_reminders(client)
+
+        self.task.LoopingCall.assert_called_with(reminders.load_reminders, client)
+        self.task.LoopingCall.return_value.start.assert_called_with(3 * 3600, now=False)
+
+    @patch('helga_reminders.claim_reminders')
+    def test_coordinated_refill_renews_leases(self, claim_reminders):
+        client = Mock()
+
+        with patch.object(reminders, '_coordinator', reminders.Coordinator(lease=30)), \
+                patch.object(reminders, '_store', reminders.ReminderStore(reminders.MemoryBackend(), inline=True)):
+            reminders.init_reminders(client)
+
+        claim_reminders.assert_called_with(client)
+        self.task.LoopingCall.assert_called_with(claim_reminders, client)
+        self.task.LoopingCall.return_value.start.assert_called_with(15, now=False)
+
+    def test_coordination_off_without_leases(self):
+        client = Mock()
+        store = reminders.ReminderStore(reminders.SQLiteBackend(':memory:'), inline=True)
+
+        with patch.object(reminders, '_coordinator', reminders.Coordinator()), \
+                patch.object(reminders, '_store', store), \
+                patch.object(reminders, '_scheduler', reminders.Scheduler(clock=Clock())), \
+                patch.object(reminders, '_delivery', reminders.DeliveryQueue(clock=Clock())), \
+                patch.object(reminders, '_cache', {}):
+            reminders.init_reminders(client)
+            assert reminders._coordinator is None
+
+            assert result_of(reminders.in_reminder(client, '#bots', 'me', ['1m', 'hello'])) == \
+                'Reminder set for 1 minute from now'
+            reminders._scheduler._clock.advance(60)
+
+        self.task.LoopingCall.assert_called_with(reminders.load_reminders, client)
+        client.msg.assert_called_with('#bots', 'hello')
+
+    @patch('helga_reminders._scheduler')
+    @patch('helga_reminders.db')
+    def test_refill_queries_next_window(self, db, scheduler):
+        client = Mock()
+        now = datetime.datetime(day=13, month=12, year=2013)
+        records = [
+            {
+                '_id': 1234567890,
+                'when': now + datetime.timedelta(hours=8),
+            }
+        ]
+        db.reminders.find.return_value = records
+        scheduler.__contains__.return_value = False
+        reminders._horizon_end = now + datetime.timedelta(hours=6)
+
+        with freeze_time(now + datetime.timedelta(hours=3)):
+            reminders.load_reminders(client)
+
+        db.reminders.find.assert_called_with({'when': {
+            '$gte': now + datetime.timedelta(hours=6),
+            '$lt': now + datetime.timedelta(hours=9),
+        }})
+        scheduler.schedule_batch.assert_called_with(1234567890, 5 * 3600, reminders._do_reminders, client)
+
+    def test_failed_refill_is_retried(self):
+        now = datetime.datetime(day=13, month=12, year=2013)
+        backend = reminders.MemoryBackend()
+        id = backend.insert({'when': now + datetime.timedelta(hours=8), 'channel': '#bots', 'message': 'hi'})
+        reminders._horizon_end = now + datetime.timedelta(hours=6)
+
+        with patch.object(reminders, '_store', reminders.ReminderStore(backend, inline=True)), \
+                patch.object(reminders, '_scheduler', reminders.Scheduler(clock=Clock())), \
+                patch.object(reminders, '_cache', {}):
+            with patch.object(backend, 'due', Mock(side_effect=Exception)), \
+                    freeze_time(now + datetime.timedelta(hours=3)):
+                reminders.load_reminders(Mock())
+
+            assert reminders._horizon_end == now + datetime.timedelta(hours=6)
+
+            with freeze_time(now + datetime.timedelta(hours=4)):
+                reminders.load_reminders(Mock())
+
+            assert id in reminders._scheduler
+            assert reminders._horizon_end == now + datetime.timedelta(hours=10)
+
+    @patch('helga_reminders._scheduler')
+    def test_schedule_reminder_beyond_horizon(self, scheduler):
+        now = datetime.datetime(day=13, month=12, year=2013)
+        reminders._horizon_end = now
+
+        for when in (now, now.replace(tzinfo=pytz.UTC)):
+            reminders._schedule_reminder(reminders.Reminder.from_doc({'_id': 1, 'when': when}), 0, Mock())
+            assert not scheduler.schedule_batch.called
+
+        earlier = reminders.Reminder.from_doc({'_id': 1, 'when': now - datetime.timedelta(seconds=1)})
+        reminders._schedule_reminder(earlier, 0, Mock())
+        assert scheduler.schedule_batch.called
 
 
 class TestNextOccurrence(object):
@@ -555,23 +967,88 @@ class TestNextOccurrence(object):
         with freeze_time(reminder['when']):
             for repeat, expect_delta in (past, today, future):
                 reminder['repeat'] = [repeat]
-                next_time, next_delta = reminders.next_occurrence(reminder)
-                assert expect_delta == next_delta
+                next_time = reminders.next_occurrence(reminder)
                 assert next_time == reminder['when'] + datetime.timedelta(days=expect_delta)
 
-    @patch('helga_reminders._scheduled')
-    @patch('__builtin__.next')
-    def test_when_no_next_dow(self, _next, scheduled):
-        _next.side_effect = StopIteration
+    def test_next_occurrence_with_mask(self):
+        reminder = {
+            '_id': 1,
+            'when': datetime.datetime(day=13, month=8, year=2014),  # A wednesday
+            'repeat': 0b0100001,  # M, Sa
+        }
+        now = reminder['when'].replace(tzinfo=pytz.UTC)
+
+        assert reminders.next_occurrence(reminder, now) == reminder['when'] + datetime.timedelta(days=3)
+
+    def test_keeps_local_time_across_dst(self):
+        tz = pytz.timezone('US/Eastern')
+        reminder = {
+            '_id': 1,
+            'when': tz.localize(datetime.datetime(2014, 10, 31, 13)).astimezone(pytz.UTC),  # A friday, EDT
+            'timezone': 'US/Eastern',
+            'repeat': 0b0000001,  # M
+        }
+
+        next_time = reminders.next_occurrence(reminder, reminder['when'])
+
+        assert next_time.astimezone(tz).replace(tzinfo=None) == datetime.datetime(2014, 11, 3, 13)
+        assert next_time - reminder['when'] == datetime.timedelta(days=3, hours=1)
 
+    def test_catches_up_from_stale_when(self):
+        reminder = {
+            '_id': 1,
+            'when': datetime.datetime(2014, 8, 1, 9, 30),  # A friday
+            'repeat': 0b0011111,  # Weekdays
+        }
+        now = datetime.datetime(2014, 8, 13, 10, tzinfo=pytz.UTC)  # The next wednesday, after 9:30
+
+        assert reminders.next_occurrence(reminder, now) == datetime.datetime(2014, 8, 14, 9, 30)
+
+    def test_later_today(self):
+        reminder = {'_id': 1, 'when': datetime.datetime(2014, 8, 11, 9, 30), 'repeat': 0b0000100}
+        now = datetime.datetime(2014, 8, 13, 8, tzinfo=pytz.UTC)  # Wednesday, before 9:30
+
+        assert reminders.next_occurrence(reminder, now) == datetime.datetime(2014, 8, 13, 9, 30)
+
+    @pytest.mark.parametrize('dow', range(7))
+    def test_day_delta_table(self, dow):
+        for mask in xrange(1, 128):
+            days = reminders.repeat_days(mask)
+            expect = min((day - dow - 1) % 7 + 1 for day in days)
+            assert reminders._day_deltas[dow][mask] == expect
+
+    def test_next_occurrences(self):
+        now = datetime.datetime(day=13, month=8, year=2014, tzinfo=pytz.UTC)
+        batch = [
+            {'_id': 1, 'when': now, 'repeat': [0]},
+            {'_id': 2, 'when': now, 'repeat': 0b0010000},
+        ]
+
+        assert reminders.next_occurrences(batch, now) == [
+            now + datetime.timedelta(days=5),
+            now + datetime.timedelta(days=2),
+        ]
+
+    def test_repeat_mask(self):
+        assert reminders.repeat_mask([0, 2, 4]) == 0b10101
+        assert reminders.repeat_mask(0b10101) == 0b10101
+        assert reminders.repeat_days([4, 0, 2]) == [0, 2, 4]
+        assert reminders.repeat_days(0b1100000) == [5, 6]
+
+    @patch('helga_reminders._scheduler')
+    def test_when_no_next_dow(self, scheduler):
         reminder = {
             '_id': 1,
             'when': datetime.datetime(day=13, month=8, year=2014),
-            'repeat': range(7),
+            'repeat': [],
         }
 
         assert reminders.next_occurrence(reminder) is None
-        scheduled.discard.assert_called_with(1)
+        assert not scheduler.cancel.called
+
+    def test_no_next_occurrence_without_id(self):
+        reminder = {'when': datetime.datetime(day=13, month=8, year=2014), 'repeat': '0 9 30 2 *'}
+        assert reminders.next_occurrence(reminder) is None
 
 
 class TestDeleteReminder(object):
@@ -580,7 +1057,7 @@ class TestDeleteReminder(object):
     def test_no_found_record(self, db):
         id = '54f529958973817f30dead5a'
         db.reminders.find_one.return_value = None
-        retval = reminders.delete_reminder('#bots', id)
+        retval = result_of(reminders.delete_reminder('#bots', id))
         assert retval == "No reminder found with id '{0}'".format(id)
 
     @patch('helga_reminders.db')
@@ -590,6 +1067,18 @@ class TestDeleteReminder(object):
         reminders.delete_reminder('#bots', id)
         db.reminders.remove.assert_called_with(id)
 
+    @patch('helga_reminders._scheduler')
+    @patch('helga_reminders.db')
+    def test_delete_invalidates_cache(self, db, scheduler):
+        id = objectid.ObjectId('54f529958973817f30dead5a')
+        db.reminders.find_one.return_value = {'_id': id}
+        reminders._cache[id] = {'_id': id}
+
+        reminders.delete_reminder('#bots', str(id))
+
+        assert id not in reminders._cache
+        scheduler.cancel.assert_called_with(id)
+
     def test_invalid_id(self):
         resp = reminders.delete_reminder('#bots', 'xyz')
         assert resp == "Invalid ID format 'xyz'"
@@ -613,18 +1102,1425 @@ class TestReminderSubcommand(object):
     def test_list_reminders(self, list_reminder):
         client = Mock()
         reminders.reminders(client, '#bots', 'me', 'message', 'reminders', ['list'])
-        list_reminder.assert_called_with(client, 'me', '#bots')
+        list_reminder.assert_called_with(client, 'me', '#bots', 1)
         client.me.assert_called_with('#bots', 'whispers to me')
 
     @patch('helga_reminders.list_reminders')
     def test_list_reminders_with_channel(self, list_reminder):
         client = Mock()
         reminders.reminders(client, '#bots', 'me', 'message', 'reminders', ['list', '#blah'])
-        list_reminder.assert_called_with(client, 'me', '#blah')
+        list_reminder.assert_called_with(client, 'me', '#blah', 1)
         client.me.assert_called_with('#bots', 'whispers to me')
 
+    @patch('helga_reminders._scheduler')
+    @patch('helga_reminders.db')
+    def test_replies_once_stored(self, db, scheduler):
+        client = Mock()
+        db.reminders.insert.return_value = 1
+
+        with pytest.raises(ResponseNotReady):
+            reminders.reminders(client, '#bots', 'me', 'message', 'in', ['12m', 'foo'])
+
+        client.msg.assert_called_with('#bots', 'Reminder set for 12 minutes from now')
+
+    @patch('helga_reminders.db')
+    def test_replies_on_failure(self, db):
+        client = Mock()
+        db.reminders.insert.side_effect = Exception
+
+        with pytest.raises(ResponseNotReady):
+            reminders.reminders(client, '#bots', 'me', 'message', 'in', ['12m', 'foo'])
+
+        client.msg.assert_called_with('#bots', 'Sorry, I could not reach the reminders database')
+
+    def test_invalid_replies_immediately(self):
+        resp = reminders.reminders(Mock(), '#bots', 'me', 'message', 'in', ['12x', 'foo'])
+        assert resp.startswith("Sorry I didn't understand '12x'")
+
+    @patch('helga_reminders._store')
+    def test_diagnose(self, store):
+        client = Mock()
+        store.explain.return_value = defer.succeed({'due': True, 'for_channel': False, 'get_many': False})
+
+        with pytest.raises(ResponseNotReady):
+            reminders.reminders(client, '#bots', 'me', 'message', 'reminders', ['diagnose'])
+
+        client.msg.assert_called_with('#bots', 'Reminder queries not using an index: for_channel, get_many')
+
+    @patch('helga_reminders._store')
+    def test_diagnose_all_indexed(self, store):
+        store.explain.return_value = defer.succeed({'due': True})
+        assert result_of(reminders.diagnose()) == 'All reminder queries are using an index'
+
     @patch('helga_reminders.delete_reminder')
     def test_delete_reminder(self, delete_reminder):
         client = Mock()
         reminders.reminders(client, '#bots', 'me', 'message', 'reminders', ['delete', '1'])
         delete_reminder.assert_called_with('#bots', '1')
+
+    @patch('helga_reminders.snooze_reminder')
+    def test_snooze_reminder(self, snooze_reminder):
+        client = Mock()
+        snooze_reminder.return_value = 'snoozed'
+        resp = reminders.reminders(client, '#bots', 'me', 'message', 'reminders', ['snooze', '1', '10m'])
+        snooze_reminder.assert_called_with(client, ['1', '10m'])
+        assert resp == 'snoozed'
+
+    @patch('helga_reminders.move_reminder')
+    def test_move_reminder(self, move_reminder):
+        client = Mock()
+        reminders.reminders(client, '#bots', 'me', 'message', 'reminders', ['move', '1', '17:30'])
+        move_reminder.assert_called_with(client, ['1', '17:30'])
+
+
+class TestDeliveryQueue(object):
+
+    def setup(self):
+        self.clock = Clock()
+        self.client = Mock()
+        self.queue = reminders.DeliveryQueue(clock=self.clock, rate=1, burst=2, line_limit=20)
+
+    def test_coalesces_same_channel(self):
+        self.queue.put(self.client, '#bots', 'one')
+        self.queue.put(self.client, '#foo', 'two')
+        self.queue.put(self.client, '#bots', 'three')
+
+        assert not self.client.msg.called
+        self.queue.flush()
+
+        self.client.msg.assert_any_call('#bots', 'one | three')
+        self.client.msg.assert_any_call('#foo', 'two')
+        assert self.client.msg.call_count == 2
+        assert self.queue.depth == 0
+
+    def test_no_coalesce(self):
+        self.queue.put(self.client, '#bots', 'one', coalesce=False)
+        self.queue.put(self.client, '#bots', 'two', coalesce=False)
+        self.queue.flush()
+
+        assert self.client.msg.call_count == 2
+
+    def test_respects_line_limit(self):
+        for message in ('aaaaaaaa', 'bbbbbbbb', 'cccccccc'):
+            self.queue.put(self.client, '#bots', message)
+        self.queue.flush()
+
+        assert [c[0] for c in self.client.msg.call_args_list] == [
+            ('#bots', 'aaaaaaaa | bbbbbbbb'),
+            ('#bots', 'cccccccc'),
+        ]
+
+    def test_rate_limits_channel(self):
+        for message in ('a' * 15, 'b' * 15, 'c' * 15, 'd' * 15):
+            self.queue.put(self.client, '#bots', message)
+        self.queue.flush()
+
+        # Burst of two, then one per second
+        assert self.client.msg.call_count == 2
+        assert self.queue.depth == 2
+
+        self.clock.advance(0.5)
+        assert self.queue.lag == 0.5
+
+        self.clock.advance(0.5)
+        assert self.client.msg.call_count == 3
+        assert self.queue.last_lag == 1
+
+        self.clock.advance(1)
+        assert self.client.msg.call_count == 4
+        assert self.queue.depth == 0
+        assert self.queue.lag == 0
+
+    def test_other_channels_not_throttled(self):
+        for message in ('a' * 15, 'b' * 15, 'c' * 15):
+            self.queue.put(self.client, '#bots', message)
+        self.queue.put(self.client, '#foo', 'hello')
+        self.queue.flush()
+
+        self.client.msg.assert_any_call('#foo', 'hello')
+        assert self.queue.depth == 1
+
+
+class TestReminderStore(object):
+
+    @patch('helga_reminders.db')
+    def test_inline(self, db):
+        db.reminders.find.return_value = iter([{'_id': 1}])
+        store = reminders.ReminderStore(inline=True)
+        assert result_of(store.get_many([1])) == [{'_id': 1}]
+        db.reminders.find.assert_called_with({'_id': {'$in': [1]}})
+
+    @patch('helga_reminders.reactor')
+    @patch('helga_reminders.threads')
+    def test_runs_in_pool_with_timeout(self, threads, reactor):
+        store = reminders.ReminderStore(reminders.MongoBackend())
+        store._pool = Mock()
+
+        with patch.object(reminders.settings, 'REMINDERS_DB_TIMEOUTS', {'for_channel': 3}, create=True):
+            store.for_channel('#bots')
+
+        assert threads.deferToThreadPool.call_args[0] == (
+            reactor, store._pool, store.backend.for_channel, '#bots', 0, 0)
+        threads.deferToThreadPool.return_value.addTimeout.assert_called_with(3, reactor)
+
+    @patch('helga_reminders.threads')
+    def test_non_blocking_backend_runs_inline(self, threads):
+        store = reminders.ReminderStore(reminders.MemoryBackend())
+        assert result_of(store.for_channel('#bots')) == []
+        assert not threads.deferToThreadPool.called
+
+    def test_timeouts(self):
+        store = reminders.ReminderStore()
+
+        with patch.object(reminders.settings, 'REMINDERS_DB_TIMEOUTS', {'due': 3}, create=True):
+            assert store.timeout('due') == 3
+            assert store.timeout('get') == 10
+
+    @pytest.mark.parametrize('operation', ['insert', 'insert_many', 'save', 'remove', 'update', 'bulk_update'])
+    def test_writes_never_time_out(self, operation):
+        store = reminders.ReminderStore()
+
+        with patch.object(reminders.settings, 'REMINDERS_DB_TIMEOUTS', {operation: 3}, create=True):
+            assert store.timeout(operation) is None
+
+    @pytest.mark.parametrize('name,backend', [
+        ('mongo', reminders.MongoBackend),
+        ('memory', reminders.MemoryBackend),
+        ('sqlite', reminders.SQLiteBackend),
+    ])
+    def test_backend_from_settings(self, name, backend):
+        with patch.object(reminders.settings, 'REMINDERS_BACKEND', name, create=True):
+            assert isinstance(reminders.ReminderStore().backend, backend)
+
+    @patch('helga_reminders.db')
+    def test_mongo_bulk_update(self, db):
+        reminders.MongoBackend().bulk_update([(1, {'when': 'now'})], [2, 3])
+        db.reminders.bulk_write.assert_called_with([
+            UpdateOne({'_id': 1}, {'$set': {'when': 'now'}}),
+            DeleteMany({'_id': {'$in': [2, 3]}}),
+        ], ordered=False)
+
+
+    @patch('helga_reminders.db')
+    def test_mongo_update(self, db):
+        db.reminders.find_one_and_update.return_value = {'_id': 1, 'when': 'later'}
+        assert reminders.MongoBackend().update(1, {'when': 'later'}) == {'_id': 1, 'when': 'later'}
+        db.reminders.find_one_and_update.assert_called_with(
+            {'_id': 1}, {'$set': {'when': 'later'}}, return_document=ReturnDocument.AFTER)
+
+    @patch('helga_reminders.db')
+    def test_mongo_insert_many_skips_duplicates(self, db):
+        db.reminders.insert_many.side_effect = BulkWriteError({
+            'nInserted': 1, 'writeErrors': [{'code': 11000, 'errmsg': 'duplicate key'}]})
+        docs = [{'message': 'one'}, {'message': 'two'}]
+
+        assert reminders.MongoBackend().insert_many(docs) == 1
+        assert all(isinstance(doc['_id'], objectid.ObjectId) for doc in docs)
+        db.reminders.insert_many.assert_called_with(docs, ordered=False)
+
+        db.reminders.insert_many.side_effect = BulkWriteError({
+            'nInserted': 0, 'writeErrors': [{'code': 121, 'errmsg': 'validation failed'}]})
+        with pytest.raises(BulkWriteError):
+            reminders.MongoBackend().insert_many(docs)
+
+    @patch('helga_reminders.db')
+    def test_mongo_bulk_update_archives_history(self, db):
+        reminders.MongoBackend().bulk_update([], [1], [{'_id': 2}])
+        db.reminders.bulk_write.assert_called_with([DeleteMany({'_id': {'$in': [1]}})], ordered=False)
+        db.reminders_history.insert_many.assert_called_with([{'_id': 2}], ordered=False)
+
+    @patch('helga_reminders.db')
+    def test_mongo_ensure_indexes(self, db):
+        reminders.MongoBackend().ensure_indexes()
+        db.reminders.create_index.assert_any_call('when')
+        db.reminders.create_index.assert_any_call([('channel', 1), ('when', 1)])
+        db.reminders.create_index.assert_any_call('creator')
+        db.reminders_history.create_index.assert_any_call('archived', expireAfterSeconds=7 * 86400)
+        db.reminders_history.create_index.assert_any_call([('channel', 1), ('archived', -1)])
+
+    @patch('helga_reminders.db')
+    def test_mongo_explain(self, db):
+        indexed = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}
+        scan = {'stage': 'SORT', 'inputStage': {'stage': 'COLLSCAN'}}
+
+        def explain(query):
+            plan = scan if 'channel' in query else indexed
+            cursor = Mock()
+            cursor.explain.return_value = {'queryPlanner': {'winningPlan': plan}}
+            cursor.sort.return_value = cursor
+            return cursor
+
+        db.reminders.find.side_effect = explain
+        assert reminders.MongoBackend().explain() == {'due': True, 'for_channel': False, 'get_many': True}
+
+    def test_sqlite_explain(self, tmpdir):
+        backend = reminders.SQLiteBackend(str(tmpdir.join('reminders.sqlite')))
+        backend.ensure_indexes()
+        assert backend.explain() == {'due': True, 'for_channel': True, 'get_many': True}
+
+        backend._execute('DROP INDEX reminders_when')
+        backend = reminders.SQLiteBackend(backend.path)
+        assert backend.explain() == {'due': False, 'for_channel': True, 'get_many': True}
+
+
+@pytest.fixture
+def plugin():
+    """
+    Run the plugin against a fresh memory backend, scheduler, delivery queue and
+    reminder cache, and return the backend
+    """
+    backend = reminders.MemoryBackend()
+
+    patch.object(reminders, '_store', reminders.ReminderStore(backend, inline=True)).start()
+    patch.object(reminders, '_scheduler', reminders.Scheduler(clock=Clock())).start()
+    patch.object(reminders, '_delivery', reminders.DeliveryQueue(clock=Clock())).start()
+    patch.object(reminders, '_cache', {}).start()
+    patch.object(reminders, '_horizon_end', None).start()
+
+    yield backend
+    patch.stopall()
+
+
+@pytest.fixture
+def frozen():
+    with freeze_time(datetime.datetime(day=13, month=12, year=2013, hour=12)):
+        yield
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request):
+    if request.param == 'memory':
+        return reminders.MemoryBackend()
+
+    backend = reminders.SQLiteBackend(':memory:')
+    backend.ensure_indexes()
+    return backend
+
+
+class TestBackends(object):
+
+    def setup(self):
+        self.now = datetime.datetime(day=13, month=12, year=2013, hour=12)
+
+    def reminder(self, **kwargs):
+        reminder = {
+            'when': self.now,
+            'channel': '#bots',
+            'message': u'standup \u2603',
+            'creator': 'me',
+        }
+        reminder.update(kwargs)
+        return reminder
+
+    def test_insert_and_get(self, backend):
+        reminder = self.reminder(repeat=[0, 2, 4], when=self.now.replace(tzinfo=pytz.UTC))
+        id = backend.insert(reminder)
+
+        assert isinstance(id, objectid.ObjectId)
+        assert backend.get(id) == dict(reminder, _id=id, when=self.now)
+        assert backend.get(objectid.ObjectId()) is None
+
+    def test_get_many(self, backend):
+        ids = [backend.insert(self.reminder()) for _ in xrange(3)]
+        found = backend.get_many(ids[:2] + [objectid.ObjectId()])
+
+        assert sorted(doc['_id'] for doc in found) == sorted(ids[:2])
+        assert backend.get_many([]) == []
+
+    def test_due(self, backend):
+        hour = datetime.timedelta(hours=1)
+        ids = [backend.insert(self.reminder(when=self.now + i * hour)) for i in xrange(4)]
+
+        assert [doc['_id'] for doc in backend.due(self.now + 2 * hour)] == ids[:2]
+        assert [doc['_id'] for doc in backend.due(self.now + 3 * hour, self.now + hour)] == ids[1:3]
+
+    def test_for_channel(self, backend):
+        id = backend.insert(self.reminder())
+        backend.insert(self.reminder(channel='#other'))
+
+        assert backend.for_channel('#bots') == [
+            {'_id': id, 'when': self.now, 'channel': '#bots', 'message': u'standup \u2603'}]
+
+    def test_for_channel_fan_out(self, backend):
+        hour = datetime.timedelta(hours=1)
+        fan_out = backend.insert(self.reminder(channel=['#bots', '#ops', 'me']))
+        single = backend.insert(self.reminder(when=self.now + hour))
+
+        assert [doc['_id'] for doc in backend.for_channel('#bots')] == [fan_out, single]
+        assert [doc['channel'] for doc in backend.for_channel('me')] == [['#bots', '#ops', 'me']]
+
+        later = self.now + 2 * hour
+        backend.bulk_update([(fan_out, {'when': later, 'channel': ['#ops']})], [])
+        assert [doc['when'] for doc in backend.for_channel('#ops')] == [later]
+        assert backend.for_channel('me') == []
+
+        backend.remove(fan_out)
+        assert backend.for_channel('#ops') == []
+
+    def test_for_channel_pages(self, backend):
+        hour = datetime.timedelta(hours=1)
+        ids = [backend.insert(self.reminder(when=self.now - i * hour)) for i in xrange(5)][::-1]
+
+        assert [doc['_id'] for doc in backend.for_channel('#bots', limit=2)] == ids[:2]
+        assert [doc['_id'] for doc in backend.for_channel('#bots', skip=2, limit=2)] == ids[2:4]
+        assert [doc['_id'] for doc in backend.for_channel('#bots', skip=4)] == ids[4:]
+
+    def test_save_and_remove(self, backend):
+        reminder = self.reminder()
+        id = backend.insert(reminder)
+
+        reminder['message'] = 'changed'
+        backend.save(reminder)
+        assert backend.get(id)['message'] == 'changed'
+
+        backend.remove(id)
+        assert backend.get(id) is None
+
+    def test_bulk_update(self, backend):
+        keep, drop = backend.insert(self.reminder()), backend.insert(self.reminder())
+        later = self.now + datetime.timedelta(days=1)
+
+        backend.bulk_update([(keep, {'when': later})], [drop])
+
+        assert backend.get(keep)['when'] == later
+        assert backend.get(drop) is None
+
+    def test_update(self, backend):
+        id = backend.insert(self.reminder(channel=['#bots', '#ops']))
+        later = self.now + datetime.timedelta(days=1)
+
+        doc = backend.update(id, {'when': later.replace(tzinfo=pytz.UTC)})
+
+        assert doc == dict(self.reminder(channel=['#bots', '#ops']), _id=id, when=later)
+        assert backend.get(id) == doc
+        assert [d['_id'] for d in backend.for_channel('#ops')] == [id]
+        assert backend.update(objectid.ObjectId(), {'when': later}) is None
+
+    def test_insert_many(self, backend):
+        existing = self.reminder()
+        backend.insert(existing)
+        batch = [self.reminder(message='one'), dict(existing, message='changed'), self.reminder(message='two')]
+
+        assert backend.insert_many(batch) == 2
+        assert backend.get(batch[0]['_id'])['message'] == 'one'
+        assert backend.get(existing['_id'])['message'] == u'standup \u2603'
+
+    def test_insert_many_keeps_existing_targets(self, backend):
+        existing = self.reminder(channel=['#a', '#b'])
+        backend.insert(existing)
+
+        assert backend.insert_many([dict(existing, channel=['#z'])]) == 0
+        assert [doc['_id'] for doc in backend.for_channel('#a')] == [existing['_id']]
+        assert backend.for_channel('#z') == []
+
+    def test_scan(self, backend):
+        ids = sorted(backend.insert(self.reminder(message=str(i))) for i in xrange(5))
+
+        assert [doc['_id'] for doc in backend.scan(batch_size=2)] == ids
+        assert list(backend.scan(batch_size=5))[0] == dict(self.reminder(message='0'), _id=ids[0])
+
+    def history(self, days_ago, channel='#bots', delivered=True):
+        archived = self.now - datetime.timedelta(days=days_ago)
+        return {
+            '_id': objectid.ObjectId(),
+            'reminder_id': objectid.ObjectId(),
+            'channel': channel,
+            'message': u'standup \u2603',
+            'when': archived,
+            'delivered': archived if delivered else None,
+            'archived': archived,
+        }
+
+    def test_history(self, backend):
+        keep = backend.insert(self.reminder())
+        entries = [self.history(2), self.history(1, delivered=False), self.history(0, channel='#other')]
+
+        with freeze_time(self.now):
+            backend.bulk_update([], [keep], entries)
+
+            assert backend.get(keep) is None
+            assert backend.history('#bots', 10) == entries[1::-1]
+            assert backend.history('#bots', 1) == entries[1:2]
+
+    def test_history_expires(self, backend):
+        with freeze_time(self.now), \
+                patch.object(reminders.settings, 'REMINDERS_HISTORY_DAYS', 3, create=True):
+            backend.bulk_update([], [], [self.history(4)])
+            backend.bulk_update([], [], [self.history(2)])
+
+            assert [entry['archived'] for entry in backend.history('#bots', 10)] == [
+                self.now - datetime.timedelta(days=2)]
+
+    def test_memory_history_expires_as_it_is_written(self):
+        backend = reminders.MemoryBackend()
+
+        with freeze_time(self.now), \
+                patch.object(reminders.settings, 'REMINDERS_HISTORY_DAYS', 3, create=True):
+            backend.bulk_update([], [], [self.history(4)])
+            backend.bulk_update([], [], [self.history(2)])
+
+        assert [entry['archived'] for entry in backend.archive] == [self.now - datetime.timedelta(days=2)]
+
+    def test_end_to_end(self, backend):
+        store = reminders.ReminderStore(backend, inline=True)
+        client = Mock()
+
+        with patch.object(reminders, '_store', store), \
+                patch.object(reminders, '_delivery', reminders.DeliveryQueue(clock=Clock())):
+            with patch.object(reminders, '_scheduler', reminders.Scheduler(clock=Clock())):
+                with freeze_time(self.now):
+                    result_of(reminders.in_reminder(client, '#bots', 'me', ['1m', 'hello']))
+
+                assert len(backend.for_channel('#bots')) == 1
+                assert len(reminders._scheduler) == 1
+
+                reminders._cache.clear()
+                reminders._scheduler._clock.advance(60)
+
+        client.msg.assert_called_with('#bots', 'hello')
+        assert backend.for_channel('#bots') == []
+
+
+class TestCoordination(object):
+
+    @pytest.fixture(autouse=True)
+    def setup_plugin(self, plugin):
+        self.now = datetime.datetime(day=13, month=12, year=2013, hour=12)
+        self.backend = plugin
+        self.coordinator = reminders.Coordinator(node_id='a', partitions=4, lease=30)
+        self.client = Mock()
+
+        patch.object(reminders, '_coordinator', self.coordinator).start()
+
+    def reminder(self, partition, minutes=10, lease=None):
+        return self.backend.insert({
+            'when': self.now + datetime.timedelta(minutes=minutes),
+            'channel': '#bots',
+            'message': 'standup',
+            'partition': partition,
+            'lease': lease,
+        })
+
+    def test_partitions_split_between_nodes(self):
+        assert self.coordinator.mine(['a']) == [0, 1, 2, 3, None]
+        assert self.coordinator.mine(['a', 'b']) == [0, 2, None]
+        assert self.coordinator.mine(['0', 'a']) == [1, 3]
+        assert self.coordinator.mine(['b']) == []
+
+    def test_assign(self):
+        reminder = {}
+        self.coordinator.assign(reminder, self.now)
+
+        assert reminder['partition'] in xrange(4)
+        assert reminder['lease'] == {'owner': 'a', 'expires': self.now + datetime.timedelta(seconds=30)}
+
+    def test_claims_are_exclusive(self):
+        ids = [self.reminder(partition) for partition in xrange(4)]
+        expires = self.now + datetime.timedelta(seconds=30)
+        end = self.now + datetime.timedelta(hours=1)
+
+        first = self.backend.claim('a', [0, 1, 2, 3, None], end, self.now, expires)
+        second = self.backend.claim('b', [0, 1, 2, 3, None], end, self.now, expires)
+
+        assert sorted(doc['_id'] for doc in first) == ids
+        assert second == []
+
+    def test_expired_leases_are_taken_over(self):
+        expired = {'owner': 'dead', 'expires': self.now - datetime.timedelta(seconds=1)}
+        live = {'owner': 'b', 'expires': self.now + datetime.timedelta(seconds=1)}
+        taken = self.reminder(0, lease=expired)
+        self.reminder(0, lease=live)
+
+        claimed = self.backend.claim('a', [0], self.now + datetime.timedelta(hours=1), self.now,
+                                     self.now + datetime.timedelta(seconds=30))
+
+        assert [doc['_id'] for doc in claimed] == [taken]
+        assert claimed[0]['lease']['owner'] == 'a'
+
+    @patch('helga_reminders._horizon')
+    def test_claim_reminders(self, horizon):
+        horizon.return_value = datetime.timedelta(hours=1)
+        self.backend.heartbeat('b', self.now + datetime.timedelta(seconds=30), self.now)
+        ours, theirs = self.reminder(0), self.reminder(1)
+
+        with freeze_time(self.now):
+            result_of(reminders.claim_reminders(self.client))
+
+        assert ours in reminders._scheduler
+        assert theirs not in reminders._scheduler
+        assert self.coordinator.held_until == self.now + datetime.timedelta(seconds=30)
+
+    @patch('helga_reminders._horizon')
+    def test_hands_off_reminders_in_other_partitions(self, horizon):
+        horizon.return_value = datetime.timedelta(hours=1)
+        lease = {'owner': 'a', 'expires': self.now}
+        soon, later = self.reminder(1, minutes=0, lease=dict(lease)), self.reminder(1, lease=dict(lease))
+        self.backend.heartbeat('b', self.now + datetime.timedelta(seconds=30), self.now)
+
+        for reminder_id in (soon, later):
+            reminder = reminders.Reminder.from_doc(self.backend.get(reminder_id))
+            reminders._schedule_reminder(reminder, 0, self.client)
+
+        with freeze_time(self.now):
+            result_of(reminders.claim_reminders(self.client))
+
+        # Due before b could claim it, so we keep it and fire it
+        assert soon in reminders._scheduler
+        assert self.backend.get(soon)['lease']['owner'] == 'a'
+        assert later not in reminders._scheduler
+        assert self.backend.get(later)['lease'] is None
+
+    @patch('helga_reminders._horizon')
+    def test_forgets_lost_leases(self, horizon):
+        horizon.return_value = datetime.timedelta(hours=1)
+        lost = self.reminder(0, lease={'owner': 'b', 'expires': self.now + datetime.timedelta(minutes=5)})
+        reminders._schedule_reminder(reminders.Reminder.from_doc(self.backend.get(lost)), 600, self.client)
+
+        with freeze_time(self.now):
+            result_of(reminders.claim_reminders(self.client))
+
+        assert lost not in reminders._scheduler
+
+    def test_does_not_fire_without_leases(self):
+        reminder_id = self.reminder(0)
+        reminder = reminders.Reminder.from_doc(self.backend.get(reminder_id))
+        reminders._schedule_reminder(reminder, 0, self.client)
+
+        reminders._do_reminders([reminder_id], self.client)
+
+        assert not self.client.msg.called
+        assert reminder_id not in reminders._scheduler
+        assert self.backend.get(reminder_id) is not None
+
+    @patch('helga_reminders.db')
+    def test_mongo_claim(self, db):
+        db.reminders.find_one_and_update.side_effect = [{'_id': 1}, {'_id': 2}, None]
+        expires = self.now + datetime.timedelta(seconds=30)
+
+        claimed = reminders.MongoBackend().claim('a', [0, None], self.now, self.now, expires)
+
+        assert claimed == [{'_id': 1}, {'_id': 2}]
+        (query, update), kwargs = db.reminders.find_one_and_update.call_args
+        assert query['partition'] == {'$in': [0, None]}
+        assert update == {'$set': {'lease': {'owner': 'a', 'expires': expires}}}
+        assert kwargs == {'return_document': ReturnDocument.AFTER}
+
+    @patch('helga_reminders.db')
+    def test_mongo_heartbeat(self, db):
+        db.reminder_nodes.find.return_value.sort.return_value = [{'_id': 'a'}, {'_id': 'b'}]
+        expires = self.now + datetime.timedelta(seconds=30)
+
+        assert reminders.MongoBackend().heartbeat('a', expires, self.now) == ['a', 'b']
+        db.reminder_nodes.update_one.assert_called_with({'_id': 'a'}, {'$set': {'expires': expires}}, upsert=True)
+
+
+class TestMetrics(object):
+
+    def setup(self):
+        self.sink = reminders.MemorySink()
+        self.metrics = reminders.Metrics(sink=self.sink)
+
+    def test_lag_histogram(self):
+        for seconds in (-0.5, 0.05, 0.3, 0.3, 2, 1000):
+            self.metrics.fire_lag(seconds)
+
+        assert self.metrics.lag_histogram() == [('<0.1s', 2), ('<0.5s', 2), ('<5s', 1), ('>=300s', 1)]
+        assert self.metrics.max_lag == 1000
+        assert self.sink.sent[-1] == ('timing', 'fire_lag', 1000000)
+
+    def test_forwards_to_sink(self):
+        self.metrics.incr('fired', 3)
+        self.metrics.incr('stale_dropped', 0)
+        self.metrics.timing('db.due', 0.25)
+        self.metrics.gauge('pending', 7)
+
+        assert self.metrics.counters['fired'] == 3
+        assert self.metrics.timings == {'db.due': [1, 0.25, 0.25]}
+        assert self.sink.sent == [('incr', 'fired', 3), ('timing', 'db.due', 250), ('gauge', 'pending', 7)]
+
+    def test_failing_sink_is_ignored(self):
+        self.metrics.sink = Mock(incr=Mock(side_effect=Exception))
+        self.metrics.incr('fired')
+        assert self.metrics.counters['fired'] == 1
+
+    @patch('helga_reminders.socket')
+    def test_statsd_sink(self, socket):
+        sink = reminders.StatsdSink(host='stats', prefix='helga')
+        sink.incr('fired')
+        sink.timing('fire_lag', 12.3)
+        sink.gauge('pending', 4)
+
+        sent = [call[0] for call in socket.socket.return_value.sendto.call_args_list]
+        assert sent == [('helga.fired:1|c', ('stats', 8125)),
+                        ('helga.fire_lag:12|ms', ('stats', 8125)),
+                        ('helga.pending:4|g', ('stats', 8125))]
+
+    def test_records_fires(self):
+        backend = reminders.MemoryBackend()
+        now = datetime.datetime(day=11, month=12, year=2013, hour=12)
+        once = backend.insert({'when': now, 'channel': '#bots', 'message': 'once'})
+        daily = backend.insert({'when': now, 'channel': '#bots', 'message': 'daily', 'repeat': 127})
+
+        with patch.object(reminders, '_metrics', self.metrics), \
+                patch.object(reminders, '_store', reminders.ReminderStore(backend, inline=True)), \
+                patch.object(reminders, '_scheduler', reminders.Scheduler(clock=Clock())), \
+                patch.object(reminders, '_delivery', reminders.DeliveryQueue(clock=Clock())), \
+                patch.object(reminders, '_cache', {}):
+            with freeze_time(now + datetime.timedelta(seconds=2)):
+                reminders._do_reminders([once, daily], Mock())
+
+        assert self.metrics.counters == {'fired': 2, 'rescheduled': 1}
+        assert self.metrics.lag_histogram() == [('<5s', 2)]
+        assert sorted(self.metrics.timings) == ['db.bulk_update', 'db.get_many']
+        assert ('incr', 'fired', 2) in self.sink.sent
+        assert ('gauge', 'pending', 1) in self.sink.sent
+        assert ('gauge', 'delivery_depth', 0) in self.sink.sent
+        assert ('gauge', 'delivery_lag', 0) in self.sink.sent
+
+    def test_records_delivery_backlog(self):
+        clock = Clock()
+        delivery = reminders.DeliveryQueue(clock=clock, rate=1, burst=1)
+        for i in xrange(3):
+            delivery.put(Mock(), '#bots', str(i), coalesce=False)
+        clock.advance(2)
+
+        with patch.object(reminders, '_metrics', self.metrics), \
+                patch.object(reminders, '_delivery', delivery), \
+                patch.object(reminders, '_scheduler', reminders.Scheduler(clock=Clock())):
+            reminders._fire_reminders([], [], Mock())
+            response = reminders.stats()
+
+        assert ('gauge', 'delivery_depth', 2) in self.sink.sent
+        assert ('gauge', 'delivery_lag', 2000) in self.sink.sent
+        assert response.endswith(u'2 waiting to send. Delivery lag 2.0s, last line waited 2.0s')
+
+    @patch('helga_reminders._scheduler')
+    @patch('helga_reminders.db')
+    def test_records_stale_reminders(self, db, scheduler):
+        now = datetime.datetime(day=13, month=12, year=2013)
+        db.reminders.find.return_value = [{'_id': 1, 'when': now - datetime.timedelta(hours=1)}]
+        scheduler.__contains__.return_value = False
+
+        with patch.object(reminders, '_metrics', self.metrics):
+            reminders._schedule_loaded(db.reminders.find.return_value, now, Mock())
+
+        assert self.metrics.counters['stale_dropped'] == 1
+
+    def test_stats(self):
+        self.metrics.incr('fired', 5)
+        self.metrics.incr('rescheduled', 2)
+        self.metrics.fire_lag(0.2)
+        self.metrics.timing('db.due', 0.004)
+        self.metrics.timing('db.due', 0.002)
+        scheduler = reminders.Scheduler(clock=Clock())
+        scheduler.schedule(1, 60, Mock())
+
+        with patch.object(reminders, '_metrics', self.metrics), \
+                patch.object(reminders, '_scheduler', scheduler), \
+                patch.object(reminders, '_delivery', reminders.DeliveryQueue(clock=Clock())):
+            response = reminders.reminders(Mock(), '#bots', 'me', 'message', 'reminders', ['stats'])
+
+        assert response == (u'1 pending, 5 fired, 2 rescheduled, 0 stale dropped, 0 waiting to send. '
+                            u'Fire lag <0.5s: 1, max 0.2s. '
+                            u'DB calls/avg ms/max ms due 2/3.0/4.0')
+
+
+class TestProfiler(object):
+
+    def setup(self):
+        self.clock = Clock()
+        self.profiler = reminders.Profiler(sample_rate=1, interval=60, clock=self.clock)
+
+        @self.profiler.profiled
+        def work(n):
+            return sum(xrange(n))
+
+        self.work = work
+
+    def test_disabled_by_default(self):
+        assert self.work(10) == 45
+        assert self.profiler.samples == 0
+
+    def test_samples_calls(self):
+        self.profiler.start()
+        self.work(10)
+        self.work(10)
+
+        assert self.profiler.samples == 2
+        assert self.profiler.stats.total_calls > 0
+
+    def test_sample_rate(self):
+        self.profiler.start(sample_rate=0)
+        self.work(10)
+        assert self.profiler.samples == 0
+
+    def test_dumps_periodically_and_when_stopped(self, tmpdir):
+        self.profiler.path = str(tmpdir.join('reminders.prof'))
+        self.profiler.start()
+        self.work(10)
+
+        self.clock.advance(60)
+        assert tmpdir.join('reminders.prof').check()
+
+        tmpdir.join('reminders.prof').remove()
+        self.profiler.stop()
+        assert not self.profiler.enabled
+        assert pstats.Stats(self.profiler.path).stats
+
+    @patch('helga_reminders._profiler')
+    def test_command_requires_operator(self, profiler):
+        client = Mock(operators=set(['admin']))
+
+        assert reminders.profile(client, 'me', ['on']) == u'Sorry me, only operators can change profiling'
+        assert not profiler.start.called
+
+    @patch('helga_reminders._profiler')
+    def test_command_on_and_off(self, profiler):
+        client = Mock(operators=set(['me']))
+        profiler.configure_mock(enabled=True, sample_rate=0.5, samples=3, path='reminders.prof', interval=300)
+
+        response = reminders.reminders(client, '#bots', 'me', 'message', 'reminders', ['profile', 'on', '0.5'])
+
+        profiler.start.assert_called_with(0.5)
+        assert response == u'Profiling 50% of calls, 3 samples so far, written to reminders.prof every 300s'
+
+        response = reminders.profile(client, 'me', ['off'])
+        assert profiler.stop.called
+        assert response == u'Profiling off. 3 samples written to reminders.prof'
+
+
+class TestParsing(object):
+
+    @pytest.mark.parametrize('args,expect', [
+        (['12m', 'stand', 'up'], (720, '#bots', 'stand up')),
+        (['2h', 'on', 'foo', 'stand', 'up'], (7200, '#foo', 'stand up')),
+        (['1d', 'on', '#foo', 'stand', 'up'], (86400, '#foo', 'stand up')),
+        (['1d', 'only', 'me'], (86400, '#bots', 'only me')),
+    ])
+    def test_in(self, args, expect):
+        assert reminders._parse_in_args(args, '#bots') == expect
+
+    @pytest.mark.parametrize('args', [[], ['12x', 'foo'], ['m', 'foo'], ['1.5h', 'foo']])
+    def test_in_invalid(self, args):
+        with pytest.raises(reminders.ParseError) as e:
+            reminders._parse_in_args(args, '#bots')
+        assert e.value.reply.startswith("Sorry I didn't understand")
+
+    @pytest.mark.parametrize('args,expect', [
+        (['13:00', 'standup'], (13, 0, 'US/Eastern', '#bots', 'standup', None)),
+        (['9:05', 'utc', 'standup'], (9, 5, 'UTC', '#bots', 'standup', None)),
+        (['13:00', 'EST', 'on', 'foo', 'standup'], (13, 0, 'EST', '#foo', 'standup', None)),
+        (['13:00', 'on', '#foo', 'standup', 'repeat', 'MWF'], (13, 0, 'US/Eastern', '#foo', 'standup', 21)),
+        (['13:00', 'only', 'me'], (13, 0, 'US/Eastern', '#bots', 'only me', None)),
+    ])
+    def test_at(self, args, expect):
+        hh, mm, timezone, channel, message, mask = reminders._parse_at_args(args, '#bots')
+        assert (hh, mm, timezone.zone, channel, message, mask) == expect
+
+    @pytest.mark.parametrize('args,reply', [
+        (['25:00', 'standup'], "Sorry I didn't understand '25:00'"),
+        (['noon', 'standup'], "Sorry I didn't understand 'noon'"),
+        (['13:00', 'standup', 'repeat', 'MXF'], "I didn't understand 'MXF'"),
+    ])
+    def test_at_invalid(self, args, reply):
+        with pytest.raises(reminders.ParseError) as e:
+            reminders._parse_at_args(args, '#bots')
+        assert e.value.reply.startswith(reply)
+
+    @patch('helga_reminders.pytz.timezone')
+    def test_timezones_are_cached(self, timezone):
+        reminders._timezone.cache.clear()
+        for _ in xrange(3):
+            reminders._parse_at_args(['13:00', 'Europe/Paris', 'standup'], '#bots')
+
+        timezone.assert_called_once_with('Europe/Paris')
+
+    def test_lru_cache_evicts_least_recent(self):
+        calls = []
+
+        @reminders._lru_cache(maxsize=2)
+        def double(key):
+            calls.append(key)
+            return key * 2
+
+        assert [double(key) for key in (1, 2, 1, 3, 1, 2)] == [2, 4, 2, 6, 2, 4]
+        assert calls == [1, 2, 3, 2]
+
+    def test_delete_invalid_id(self):
+        assert reminders.delete_reminder('#bots', 'nope') == u"Invalid ID format 'nope'"
+
+
+class TestYearOfFires(object):
+
+    def test_weekday_reminder_keeps_time_for_a_year(self):
+        tz = pytz.timezone('US/Eastern')
+        start = datetime.datetime(2014, 1, 1, 12)  # A wednesday, 7:00 EST
+        step = datetime.timedelta(minutes=37)  # Fires run up to this late
+        clock = Clock()
+        client = Mock()
+        fired = []
+        backend = reminders.MemoryBackend()
+
+        with freeze_time(start) as frozen, \
+                patch.object(reminders, '_store', reminders.ReminderStore(backend, inline=True)), \
+                patch.object(reminders, '_scheduler', reminders.Scheduler(clock=clock)), \
+                patch.object(reminders, '_delivery', reminders.DeliveryQueue(clock=clock)), \
+                patch.object(reminders, '_cache', {}), \
+                patch.object(reminders, '_horizon_end', None):
+            client.msg.side_effect = lambda channel, message: fired.append(datetime.datetime.utcnow())
+            result_of(reminders.at_reminder(client, '#bots', 'me',
+                                            ['13:00', 'US/Eastern', 'standup', 'repeat', 'MTuWThF']))
+
+            while datetime.datetime.utcnow() < start + datetime.timedelta(days=365):
+                frozen.tick(delta=step)
+                clock.advance(step.total_seconds())
+
+            stored = backend.docs.values()[0]
+
+        local = [pytz.UTC.localize(when).astimezone(tz) for when in fired]
+        weekdays = [day for day in (datetime.date(2014, 1, 1) + datetime.timedelta(days=i) for i in xrange(365))
+                    if day.weekday() < 5]
+
+        assert [when.date() for when in local] == weekdays
+        assert all(datetime.time(13) <= when.time() < datetime.time(13, 37) for when in local)
+
+        next_local = pytz.UTC.localize(stored['when']).astimezone(tz)
+        assert next_local.replace(tzinfo=None) == datetime.datetime(2015, 1, 1, 13)
+
+
+class TestRecurrenceRules(object):
+
+    def setup(self):
+        self.now = datetime.datetime(2014, 8, 13, 10, 7, 30, tzinfo=pytz.UTC)  # A wednesday
+
+    def next(self, spec, when=None, timezone=pytz.UTC):
+        return reminders.compile_rule(spec).next(when or self.now, self.now, timezone)
+
+    @pytest.mark.parametrize('spec,expect', [
+        ('*/15 * * * *', datetime.datetime(2014, 8, 13, 10, 15)),
+        ('30 * * * *', datetime.datetime(2014, 8, 13, 10, 30)),
+        ('0 9 * * *', datetime.datetime(2014, 8, 14, 9)),
+        ('0 9 1,15 * *', datetime.datetime(2014, 8, 15, 9)),
+        ('0 9 1 * *', datetime.datetime(2014, 9, 1, 9)),
+        ('0 9 * * 1-5', datetime.datetime(2014, 8, 14, 9)),
+        ('0 9 * * 0', datetime.datetime(2014, 8, 17, 9)),
+        ('0 9 * * 7', datetime.datetime(2014, 8, 17, 9)),
+        ('0 9 20 * 5', datetime.datetime(2014, 8, 15, 9)),  # Either day field matches
+        ('0 0 29 2 *', datetime.datetime(2016, 2, 29)),
+        ('0 9-17/4 * 1,12 *', datetime.datetime(2014, 12, 1, 9)),
+    ])
+    def test_cron(self, spec, expect):
+        assert self.next(spec) == pytz.UTC.localize(expect)
+
+    def test_cron_in_timezone(self):
+        tz = pytz.timezone('US/Eastern')
+        assert self.next('0 9 * * *', timezone=tz) == tz.localize(datetime.datetime(2014, 8, 13, 9))
+        assert self.next('0 9 * * *', timezone=tz).astimezone(tz).hour == 9
+
+    def test_cron_that_never_happens(self):
+        assert self.next('0 0 30 2 *') is None
+
+    @pytest.mark.parametrize('spec', ['* * * *', '60 * * * *', '0 24 * * *', '0 0 0 * *', '5-1 * * * *',
+                                      '*/0 * * * *', 'x * * * *'])
+    def test_invalid_cron(self, spec):
+        with pytest.raises(ValueError):
+            reminders.compile_rule(spec)
+
+    def test_interval(self):
+        when = self.now - datetime.timedelta(minutes=50)
+        assert self.next('every 900', when) == when + datetime.timedelta(minutes=60)
+        assert self.next('every 900', self.now) == self.now + datetime.timedelta(minutes=15)
+
+    def test_interval_minimum(self):
+        with pytest.raises(ValueError):
+            reminders.compile_rule('every 30')
+
+    def test_rules_are_compiled_once(self):
+        assert reminders.compile_rule(u'every 900') is reminders.compile_rule('every 900')
+
+    @pytest.mark.parametrize('repeat,describe', [
+        (0b10101, 'every M,W,F'),
+        ([0, 2], 'every M,W'),
+        ('every 900', 'every 15m'),
+        ('every 7200', 'every 2h'),
+        ('0 * * * *', 'cron 0 * * * *'),
+    ])
+    def test_describe(self, repeat, describe):
+        assert reminders.compile_rule(repeat).describe() == describe
+
+    @pytest.mark.parametrize('args,repeat', [
+        (['standup', 'repeat', 'hourly'], '30 * * * *'),
+        (['standup', 'repeat', 'every', '15m'], 'every 900'),
+        (['standup', 'repeat', '1st,15th'], '30 9 1,15 * *'),
+        (['standup', 'repeat', 'cron', '*/5', '9-17', '*', '*', '1-5'], '*/5 9-17 * * 1-5'),
+        (['standup', 'repeat', 'MWF'], 0b10101),
+        (['standup'], None),
+    ])
+    def test_parse(self, args, repeat):
+        assert reminders._parse_at_args(['9:30'] + args, '#bots')[-1] == repeat
+        assert reminders._parse_at_args(['9:30'] + args, '#bots')[-2] == 'standup'
+
+    @pytest.mark.parametrize('args', [
+        ['repeat', 'every', '15x'],
+        ['repeat', 'every', '30s'],
+        ['repeat', '32nd'],
+        ['repeat', 'cron', '0', '25', '*', '*', '*'],
+        ['repeat', 'fortnightly'],
+    ])
+    def test_parse_invalid(self, args):
+        with pytest.raises(reminders.ParseError):
+            reminders._parse_at_args(['9:30', 'standup'] + args, '#bots')
+
+    @patch('helga_reminders.db')
+    @patch('helga_reminders._scheduler')
+    def test_at_starts_on_first_matching_day(self, scheduler, db):
+        db.reminders.insert.return_value = 1
+
+        with freeze_time(self.now):
+            reminders.at_reminder(Mock(), '#bots', 'me', ['9:00', 'UTC', 'rent', 'repeat', '1st'])
+
+        rec = db.reminders.insert.call_args[0][0]
+        assert rec['when'] == pytz.UTC.localize(datetime.datetime(2014, 9, 1, 9))
+        assert rec['repeat'] == '0 9 1 * *'
+
+    def test_at_rule_that_never_happens(self):
+        with freeze_time(self.now):
+            response = reminders.at_reminder(Mock(), '#bots', 'me',
+                                             ['0:00', 'UTC', 'x', 'repeat', 'cron', '0', '0', '30', '2', '*'])
+        assert response == u"Sorry, 'cron 0 0 30 2 *' never happens"
+
+    def test_thousands_of_high_frequency_repeats(self):
+        backend = reminders.MemoryBackend()
+        clock = Clock()
+        client = Mock()
+
+        with freeze_time(self.now) as frozen, \
+                patch.object(reminders, '_store', reminders.ReminderStore(backend, inline=True)), \
+                patch.object(reminders, '_scheduler', reminders.Scheduler(clock=clock, tolerance=1)), \
+                patch.object(reminders, '_delivery', reminders.DeliveryQueue(clock=clock, rate=1e6, burst=1e6)), \
+                patch.object(reminders, '_cache', {}), \
+                patch.object(reminders, '_horizon_end', None):
+            for i in xrange(1000):
+                reminder = {'when': self.now + datetime.timedelta(minutes=1), 'channel': '#c{0}'.format(i),
+                            'message': 'ping', 'repeat': 'every 60'}
+                reminder['_id'] = backend.insert(reminder)
+                reminders._schedule_reminder(reminders.Reminder.from_doc(reminder), 60, client)
+
+            for _ in xrange(5):
+                frozen.tick(delta=datetime.timedelta(minutes=1))
+                clock.advance(60)
+
+        assert client.msg.call_count == 5000
+        assert all(doc['when'] == datetime.datetime(2014, 8, 13, 10, 13, 30) for doc in backend.docs.values())
+
+
+class TestTransfer(object):
+
+    def setup(self):
+        self.now = datetime.datetime(day=13, month=12, year=2013, hour=12)
+        self.id = objectid.ObjectId()
+
+    def reminder(self, **kwargs):
+        reminder = {
+            '_id': self.id,
+            'when': self.now,
+            'channel': '#bots',
+            'message': u'standup \u2603',
+            'creator': 'me',
+        }
+        reminder.update(kwargs)
+        return reminder
+
+    def test_dump_and_load(self):
+        reminder = self.reminder(repeat=21, timezone='US/Eastern', partition=3,
+                                 lease={'owner': 'a', 'expires': self.now})
+        line = reminders.dump_reminder(dict(reminder, when=self.now.replace(tzinfo=pytz.UTC)))
+
+        assert 'lease' not in line
+        assert '"when": "2013-12-13T12:00:00.000000Z"' in line
+        assert reminders.load_reminder(line) == dict((k, v) for k, v in reminder.iteritems() if k != 'lease')
+
+    @pytest.mark.parametrize('line,error', [
+        ('{', 'not JSON'),
+        ('[]', 'not a JSON object'),
+        ('{"channel": "#bots", "message": "hi"}', 'missing when'),
+        ('{"when": "tomorrow", "channel": "#bots", "message": "hi"}', 'when is not a'),
+        ('{"when": "2013-12-13T12:00:00.000000Z", "channel": 1, "message": "hi"}', 'channel is not a string'),
+        ('{"when": "2013-12-13T12:00:00.000000Z", "channel": ["#a", "#a"], "message": "hi"}',
+         'channel repeats a target'),
+        ('{"when": "2013-12-13T12:00:00.000000Z", "channel": "#bots", "message": "hi", "x": 1}',
+         'unknown fields x'),
+        ('{"when": "2013-12-13T12:00:00.000000Z", "channel": "#bots", "message": "hi", "_id": "abc"}',
+         '_id is not an ObjectId'),
+        ('{"when": "2013-12-13T12:00:00.000000Z", "channel": "#bots", "message": "hi", "timezone": "Mars"}',
+         'unknown timezone Mars'),
+        ('{"when": "2013-12-13T12:00:00.000000Z", "channel": "#bots", "message": "hi", "repeat": 200}',
+         'repeat 200 is not a valid rule'),
+        ('{"when": "2013-12-13T12:00:00.000000Z", "channel": "#bots", "message": "hi", "repeat": [9]}',
+         'repeat [9] is not a valid rule'),
+        ('{"when": "2013-12-13T12:00:00.000000Z", "channel": "#bots", "message": "hi", "repeat": "cron * *"}',
+         "repeat u'cron * *' is not a valid rule"),
+        ('{"when": "2013-12-13T12:00:00.000000Z", "channel": "#bots", "message": "hi", "repeat": "0 9 30 2 *"}',
+         "repeat u'0 9 30 2 *' never happens"),
+    ])
+    def test_load_invalid(self, line, error):
+        with pytest.raises(ValueError) as e:
+            reminders.load_reminder(line)
+        assert str(e.value).startswith(error)
+
+    def test_round_trip(self, backend):
+        source = reminders.MemoryBackend()
+        for i in xrange(5):
+            source.insert(self.reminder(_id=objectid.ObjectId(), message=str(i), repeat='every 3600'))
+
+        out = StringIO()
+        assert reminders.export_reminders(source, out, batch_size=2) == 5
+
+        assert reminders.import_reminders(backend, out.getvalue().splitlines(), batch_size=2) == (5, 0)
+        assert list(backend.scan()) == list(source.scan())
+
+        # Importing again leaves what is there alone
+        assert reminders.import_reminders(backend, out.getvalue().splitlines()) == (0, 0)
+
+    def test_import_batches(self):
+        backend = reminders.MemoryBackend()
+        lines = [reminders.dump_reminder(self.reminder(_id=objectid.ObjectId())) for _ in xrange(5)]
+
+        with patch.object(backend, 'insert_many', wraps=backend.insert_many) as insert_many:
+            reminders.import_reminders(backend, iter(lines), batch_size=2)
+
+        assert [len(call[0][0]) for call in insert_many.call_args_list] == [2, 2, 1]
+
+    def test_import_skips_invalid_lines(self):
+        backend = reminders.MemoryBackend()
+        errors = StringIO()
+        lines = ['{', '', reminders.dump_reminder(self.reminder())]
+
+        assert reminders.import_reminders(backend, lines, errors=errors) == (1, 1)
+        assert errors.getvalue() == 'line 1: not JSON\n'
+
+    def test_import_rebuilds_when(self):
+        backend = reminders.MemoryBackend()
+        lines = [
+            reminders.dump_reminder(self.reminder(repeat=1 << 4)),
+            reminders.dump_reminder(self.reminder(_id=objectid.ObjectId(), message='once')),
+            reminders.dump_reminder(self.reminder(_id=objectid.ObjectId(), repeat='cron 0 0 30 2 *')),
+        ]
+        utcnow = self.now + datetime.timedelta(days=30)
+
+        assert reminders.import_reminders(backend, lines, rebuild=True, utcnow=utcnow) == (2, 1)
+
+        # Friday the 13th moves to the first Friday after a month later, one-shots stay put
+        assert backend.get(self.id)['when'] == datetime.datetime(2014, 1, 17, 12)
+        assert [doc['when'] for doc in backend.scan()][1] == self.now
+
+    def test_import_reports_rules_that_never_happen(self):
+        backend = reminders.MemoryBackend()
+        errors = StringIO()
+        lines = [
+            '{"when": "2013-12-13T12:00:00.000000Z", "channel": "#bots", "message": "hi", "repeat": "0 9 30 2 *"}',
+            reminders.dump_reminder(self.reminder()),
+        ]
+        utcnow = self.now + datetime.timedelta(days=30)
+
+        assert reminders.import_reminders(backend, lines, rebuild=True, utcnow=utcnow, errors=errors) == (1, 1)
+        assert errors.getvalue() == "line 1: repeat u'0 9 30 2 *' never happens\n"
+
+    def test_main(self, tmpdir):
+        dump = tmpdir.join('reminders.jsonl')
+        source = reminders.SQLiteBackend(str(tmpdir.join('source.sqlite')))
+        source.ensure_indexes()
+        source.insert(self.reminder())
+
+        with patch.object(reminders.settings, 'REMINDERS_SQLITE_PATH', source.path, create=True):
+            assert reminders.main(['--backend', 'sqlite', 'export', str(dump)]) == 0
+
+        assert dump.read() == reminders.dump_reminder(self.reminder()) + '\n'
+
+        with patch.object(reminders.settings, 'REMINDERS_SQLITE_PATH', str(tmpdir.join('target.sqlite')),
+                          create=True):
+            assert reminders.main(['--backend', 'sqlite', 'import', str(dump)]) == 0
+            assert reminders.SQLiteBackend().get(self.id) == self.reminder()
+
+    def test_main_refuses_memory_backend(self):
+        with pytest.raises(SystemExit):
+            reminders.main(['--backend', 'memory', 'export'])
+
+        with patch.object(reminders.settings, 'REMINDERS_BACKEND', 'memory', create=True):
+            with pytest.raises(SystemExit):
+                reminders.main(['export'])
+
+
+class TestHistory(object):
+
+    # History older than REMINDERS_HISTORY_DAYS is expired as it is read, so time is frozen
+    @pytest.fixture(autouse=True)
+    def setup_plugin(self, plugin, frozen):
+        self.now = datetime.datetime(day=13, month=12, year=2013, hour=12)
+        self.backend = plugin
+        self.client = Mock()
+
+    def insert(self, minutes=0, **kwargs):
+        reminder = {'when': self.now + datetime.timedelta(minutes=minutes), 'channel': '#bots',
+                    'message': 'standup', 'creator': 'me'}
+        reminder.update(kwargs)
+        return self.backend.insert(reminder)
+
+    def fire(self, *reminder_ids):
+        with freeze_time(self.now + datetime.timedelta(seconds=5)):
+            reminders._do_reminders(list(reminder_ids), self.client)
+
+    def test_fired_reminders_are_archived(self):
+        once, repeat = self.insert(), self.insert(repeat='every 3600')
+        self.fire(once, repeat)
+
+        assert self.backend.get(once) is None
+        assert self.backend.get(repeat) is not None
+
+        [entry] = self.backend.history('#bots', 10)
+        assert entry['reminder_id'] == once
+        assert entry['delivered'] == self.now + datetime.timedelta(seconds=5)
+        assert entry['when'] == self.now
+
+    def test_repeats_are_archived_when_asked_for(self):
+        once, repeat = self.insert(), self.insert(repeat='every 3600')
+
+        with patch.object(reminders.settings, 'REMINDERS_HISTORY_REPEATS', True, create=True):
+            self.fire(once, repeat)
+
+        history = self.backend.history('#bots', 10)
+        assert sorted(entry['reminder_id'] for entry in history) == sorted([once, repeat])
+
+    def test_stale_reminders_are_archived(self):
+        stale = self.insert(minutes=-10)
+
+        with freeze_time(self.now):
+            reminders._schedule_loaded(self.backend.due(self.now), self.now, self.client)
+
+        assert self.backend.get(stale) is None
+        [entry] = self.backend.history('#bots', 10)
+        assert entry['reminder_id'] == stale
+        assert entry['delivered'] is None
+
+    def test_history_can_be_turned_off(self):
+        once = self.insert()
+
+        with patch.object(reminders.settings, 'REMINDERS_HISTORY_DAYS', 0, create=True):
+            self.fire(once)
+
+        assert self.backend.get(once) is None
+        assert not self.backend.archive
+
+    def test_history_command(self):
+        fired, stale = self.insert(message='lunch'), self.insert(minutes=-10)
+        self.fire(fired)
+        later = self.now + datetime.timedelta(minutes=1)
+        reminders._schedule_loaded(self.backend.due(later), later, self.client)
+
+        assert reminders.reminders(self.client, '#bots', 'me', 'message', 'reminders', ['history']) is None
+
+        self.client.me.assert_called_with('#bots', 'whispers to me')
+        assert [call[0] for call in self.client.msg.call_args_list[-3:]] == [
+            ('me', 'me, here are the latest reminders for channel: #bots'),
+            ('me', u"[{0}] Dropped, was due 12/13/13 11:50 UTC: 'standup'".format(stale)),
+            ('me', u"[{0}] Delivered 12/13/13 12:00 UTC: 'lunch'".format(fired)),
+        ]
+
+    def test_empty_history(self):
+        reminders.reminders(self.client, '#bots', 'me', 'message', 'reminders', ['history', '#other'])
+        self.client.msg.assert_called_with('me', 'There is no reminder history for channel: #other')
+
+
+class TestFanOut(object):
+
+    @pytest.fixture(autouse=True)
+    def setup_plugin(self, plugin, frozen):
+        self.now = datetime.datetime(day=13, month=12, year=2013, hour=12)
+        self.backend = plugin
+        self.client = Mock()
+
+    @pytest.mark.parametrize('target,expected', [
+        ('#a,#b,nick', ['#a', '#b', 'nick']),
+        ('#a,,#b,#a', ['#a', '#b']),
+        ('a,', '#a'),
+        ('a', '#a'),
+    ])
+    def test_parse_targets(self, target, expected):
+        assert reminders._parse_channel(['on', target, 'hello'], '#bots') == (expected, ['hello'])
+
+    def test_one_document_and_timer(self):
+        result_of(reminders.in_reminder(self.client, '#bots', 'me', ['1m', 'on', '#a,#b,nick', 'deploy']))
+
+        [doc] = list(self.backend.scan())
+        assert doc['channel'] == ['#a', '#b', 'nick']
+        assert len(reminders._scheduler) == 1
+        assert reminders._cache[doc['_id']].channel == ('#a', '#b', 'nick')
+
+        reminders._scheduler._clock.advance(60)
+
+        assert sorted(call[0] for call in self.client.msg.call_args_list) == [
+            ('#a', 'deploy'), ('#b', 'deploy'), ('nick', 'deploy')]
+        assert self.backend.get(doc['_id']) is None
+        assert [len(self.backend.history(target, 10)) for target in ('#a', '#b', 'nick')] == [1, 1, 1]
+
+    def test_listed_under_each_target(self):
+        id = self.backend.insert({'when': self.now, 'channel': ['#a', 'nick'], 'message': 'deploy'})
+
+        for target in ('#a', 'nick'):
+            result_of(reminders.list_reminders(self.client, 'me', target))
+            self.client.msg.assert_called_with(
+                'me', u"[{0}] At 12/13/13 12:00 UTC: 'deploy' (To #a, nick)".format(id))
+
+    def test_import_validates_targets(self):
+        line = '{"when": "2013-12-13T12:00:00.000000Z", "channel": %s, "message": "hi"}'
+
+        assert reminders.load_reminder(line % '["#a", "nick"]')['channel'] == ['#a', 'nick']
+        for channel in ('[]', '["#a", 1]'):
+            with pytest.raises(ValueError):
+                reminders.load_reminder(line % channel)
+
+
+class TestSnoozeAndMove(object):
+
+    @pytest.fixture(autouse=True)
+    def setup_plugin(self, plugin):
+        self.now = datetime.datetime(day=13, month=12, year=2013, hour=12)
+        self.backend = plugin
+        self.client = Mock()
+
+    def set_reminder(self, minutes=1):
+        result_of(reminders.in_reminder(self.client, '#bots', 'me', ['{0}m'.format(minutes), 'standup']))
+        [doc] = list(self.backend.scan())
+        return doc['_id']
+
+    def test_snooze_moves_the_pending_timer(self, frozen):
+        id = self.set_reminder()
+
+        resp = result_of(reminders.snooze_reminder(self.client, [str(id), '10m']))
+
+        assert resp == 'Reminder rescheduled for 10 minutes from now'
+        assert self.backend.get(id)['when'] == self.now + datetime.timedelta(minutes=10)
+        assert len(reminders._scheduler) == 1
+        assert reminders._cache[id].utc == self.now + datetime.timedelta(minutes=10)
+
+        reminders._scheduler._clock.advance(60)
+        assert not self.client.msg.called
+
+        reminders._scheduler._clock.advance(540)
+        self.client.msg.assert_called_once_with('#bots', 'standup')
+
+    def test_move(self, frozen):
+        id = self.set_reminder()
+
+        result_of(reminders.move_reminder(self.client, [str(id), '11:30', 'UTC']))
+
+        assert self.backend.get(id)['when'] == datetime.datetime(day=14, month=12, year=2013, hour=11, minute=30)
+        assert len(reminders._scheduler) == 1
+
+    def test_snooze_repeating_reminder_keeps_its_time(self, frozen):
+        # 07:00 on a Friday in New York, with the standup at 09:00
+        args = ['09:00', 'US/Eastern', 'standup', 'repeat', 'MTuWThF']
+        result_of(reminders.at_reminder(self.client, '#bots', 'me', args))
+        [doc] = list(self.backend.scan())
+        id = doc['_id']
+
+        result_of(reminders.snooze_reminder(self.client, [str(id), '10m']))
+
+        assert self.backend.get(id)['when'] == self.now + datetime.timedelta(minutes=10)
+        assert self.backend.get(id)['anchor'] == reminders.Reminder.from_doc(doc).when
+
+        reminders._scheduler._clock.advance(600)
+
+        self.client.msg.assert_called_once_with('#bots', 'standup')
+        doc = self.backend.get(id)
+        assert doc['when'] == datetime.datetime(day=16, month=12, year=2013, hour=14)
+        assert doc['anchor'] is None
+
+    def test_snooze_twice_keeps_first_anchor(self, frozen):
+        anchor = self.now + datetime.timedelta(hours=2)
+        id = self.backend.insert({'when': anchor, 'channel': '#bots', 'message': 'standup', 'repeat': 'every 3600'})
+
+        result_of(reminders.snooze_reminder(self.client, [str(id), '10m']))
+        result_of(reminders.snooze_reminder(self.client, [str(id), '20m']))
+
+        assert self.backend.get(id)['anchor'] == reminders.Reminder.from_doc({'_id': id, 'when': anchor}).when
+        assert reminders._cache[id].anchor == self.backend.get(id)['anchor']
+
+    def test_move_drops_the_snooze(self, frozen):
+        id = self.backend.insert({'when': self.now, 'channel': '#bots', 'message': 'standup',
+                                  'repeat': 'every 3600', 'anchor': 0})
+
+        result_of(reminders.move_reminder(self.client, [str(id), '13:30', 'UTC']))
+
+        assert self.backend.get(id)['anchor'] is None
+
+    def test_move_in_default_timezone(self, frozen):
+        id = self.set_reminder()
+
+        with patch.object(reminders.settings, 'TIMEZONE', 'US/Eastern', create=True):
+            result_of(reminders.move_reminder(self.client, [str(id), '08:00']))
+
+        assert self.backend.get(id)['when'] == datetime.datetime(day=13, month=12, year=2013, hour=13)
+
+    def test_past_the_horizon_leaves_the_scheduler(self, frozen):
+        id = self.set_reminder()
+        reminders._horizon_end = self.now + datetime.timedelta(hours=1)
+
+        result_of(reminders.snooze_reminder(self.client, [str(id), '2h']))
+
+        assert id not in reminders._scheduler
+        assert id not in reminders._cache
+
+    def test_into_the_horizon_is_scheduled(self, frozen):
+        reminders._horizon_end = self.now + datetime.timedelta(hours=1)
+        id = self.backend.insert({'when': self.now + datetime.timedelta(days=1), 'channel': '#bots',
+                                  'message': 'standup'})
+
+        result_of(reminders.snooze_reminder(self.client, [str(id), '5m']))
+
+        assert id in reminders._scheduler
+        assert reminders._cache[id].message is None
+
+    def test_coordinated_reminder_held_elsewhere(self, frozen):
+        coordinator = reminders.Coordinator(node_id='a', partitions=4, lease=30)
+        lease = {'owner': 'b', 'expires': self.now + datetime.timedelta(seconds=30)}
+        id = self.backend.insert({'when': self.now, 'channel': '#bots', 'message': 'standup',
+                                  'partition': 0, 'lease': lease})
+
+        with patch.object(reminders, '_coordinator', coordinator):
+            result_of(reminders.snooze_reminder(self.client, [str(id), '5m']))
+
+        assert self.backend.get(id)['lease'] is None
+        assert id not in reminders._scheduler
+
+    def test_reply_counts_from_the_command(self):
+        # Not frozen, so the database round trip takes real time
+        id = self.backend.insert({'when': datetime.datetime.utcnow(), 'channel': '#bots', 'message': 'standup'})
+        update = self.backend.update
+
+        def slow_update(reminder_id, fields):
+            time.sleep(0.01)
+            return update(reminder_id, fields)
+
+        with patch.object(self.backend, 'update', slow_update):
+            resp = result_of(reminders.snooze_reminder(self.client, [str(id), '10m']))
+
+        assert resp == 'Reminder rescheduled for 10 minutes from now'
+        assert 599 < reminders._scheduler._entries[id][0] <= 600
+
+    def test_not_found(self):
+        id = objectid.ObjectId()
+        resp = result_of(reminders.snooze_reminder(self.client, [str(id), '5m']))
+        assert resp == "No reminder found with id '{0}'".format(id)
+
+    @pytest.mark.parametrize('command,args,reply', [
+        ('snooze', ['xyz', '10m'], "Invalid ID format 'xyz'"),
+        ('snooze', ['54f529958973817f30dead5a', '10x'], "Sorry I didn't understand '10x'"),
+        ('snooze', ['54f529958973817f30dead5a'], 'Sorry, snooze takes'),
+        ('move', ['54f529958973817f30dead5a', '25:00'], "Sorry I didn't understand '25:00'"),
+        ('move', ['54f529958973817f30dead5a', '10:00', 'Nowhere'], "Sorry, I don't know the timezone 'Nowhere'"),
+        ('move', [], 'Sorry, move takes'),
+    ])
+    def test_invalid(self, command, args, reply):
+        func = {'snooze': reminders.snooze_reminder, 'move': reminders.move_reminder}[command]
+        assert func(self.client, args).startswith(reply)
@@ -0,0 +1,223 @@
+import pytest
+
+from mock import Mock, patch
+from twisted.internet.task import Clock
+
+from helga_reminders_scheduler import AsyncioClock, Scheduler, TwistedClock
+
+
+class TestScheduler(object):
+
+    def setup(self):
+        self.clock = Clock()
+        self.scheduler = Scheduler(clock=self.clock)
+
+    def test_runs_in_deadline_order(self):
+        fired = []
+        self.scheduler.schedule('b', 20, fired.append, 'b')
+        self.scheduler.schedule('a', 10, fired.append, 'a')
+        self.scheduler.schedule('c', 30, fired.append, 'c')
+
+        self.clock.advance(10)
+        assert fired == ['a']
+        self.clock.advance(20)
+        assert fired == ['a', 'b', 'c']
+        assert len(self.scheduler) == 0
+
+    def test_arms_a_single_timer(self):
+        for i in xrange(100):
+            self.scheduler.schedule(i, 100 - i, Mock())
+
+        assert len(self.clock.getDelayedCalls()) == 1
+        assert self.clock.getDelayedCalls()[0].getTime() == 1
+
+    def test_schedule_batches(self):
+        func = Mock()
+        self.scheduler.schedule('a', 5, func, 'client')
+        self.scheduler.schedule_batches([('a', 20), ('b', 10), ('c', 10)], func, 'client')
+
+        assert len(self.scheduler) == 3
+        assert len(self.clock.getDelayedCalls()) == 1
+
+        self.clock.advance(10)
+        func.assert_called_once_with(['b', 'c'], 'client')
+        self.clock.advance(10)
+        func.assert_called_with(['a'], 'client')
+
+    def test_cancel(self):
+        func = Mock()
+        self.scheduler.schedule('a', 10, func)
+
+        assert 'a' in self.scheduler
+        assert self.scheduler.cancel('a')
+        assert not self.scheduler.cancel('a')
+        assert 'a' not in self.scheduler
+
+        self.clock.advance(10)
+        assert not func.called
+        assert not self.clock.getDelayedCalls()
+
+    def test_reschedule(self):
+        func = Mock()
+        self.scheduler.schedule('a', 10, func, 1, foo='bar')
+
+        assert self.scheduler.reschedule('a', 30)
+        assert not self.scheduler.reschedule('b', 30)
+
+        self.clock.advance(10)
+        assert not func.called
+        self.clock.advance(20)
+        func.assert_called_once_with(1, foo='bar')
+
+    def test_schedule_replaces_existing(self):
+        first, second = Mock(), Mock()
+        self.scheduler.schedule('a', 10, first)
+        self.scheduler.schedule('a', 5, second)
+
+        self.clock.advance(10)
+        assert not first.called
+        assert second.called
+
+    def test_callback_can_reschedule_itself(self):
+        fired = []
+
+        def tick():
+            fired.append(self.clock.seconds())
+            self.scheduler.schedule('a', 5, tick)
+
+        self.scheduler.schedule('a', 5, tick)
+        self.clock.advance(5)
+        assert fired == [5]
+        assert 'a' in self.scheduler
+
+        self.clock.advance(5)
+        assert fired == [5, 10]
+
+    def test_failing_callback_does_not_stop_others(self):
+        func = Mock()
+        self.scheduler.schedule('a', 1, Mock(side_effect=Exception))
+        self.scheduler.schedule('b', 1, func)
+
+        self.clock.advance(1)
+        assert func.called
+
+    def test_batch_collects_entries_within_tolerance(self):
+        self.scheduler.tolerance = 1
+        func, other = Mock(), Mock()
+
+        self.scheduler.schedule_batch('a', 10, func, 'client')
+        self.scheduler.schedule_batch('b', 10.5, func, 'client')
+        self.scheduler.schedule_batch('c', 10.2, other, 'client')
+        self.scheduler.schedule_batch('d', 12, func, 'client')
+
+        self.clock.advance(10)
+        func.assert_called_once_with(['a', 'b'], 'client')
+        other.assert_called_once_with(['c'], 'client')
+
+        self.clock.advance(2)
+        func.assert_called_with(['d'], 'client')
+
+    def test_reschedule_keeps_batch(self):
+        func = Mock()
+        self.scheduler.schedule_batch('a', 10, func, 'client')
+        self.scheduler.reschedule('a', 20)
+
+        self.clock.advance(20)
+        func.assert_called_once_with(['a'], 'client')
+
+    def test_compacts_cancelled_entries(self):
+        for i in xrange(1000):
+            self.scheduler.schedule(i, i, Mock())
+        for i in xrange(990):
+            self.scheduler.cancel(i)
+
+        assert len(self.scheduler) == 10
+        assert len(self.scheduler._heap) < 100
+
+
+class FakeLoop(object):
+    """
+    Just the parts of an asyncio event loop that AsyncioClock uses
+    """
+
+    def __init__(self):
+        self.now = 100.0
+        self.handles = []
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, func, *args):
+        handle = Mock(when=when, func=func, args=args)
+        self.handles.append(handle)
+        return handle
+
+    @property
+    def live(self):
+        return [h for h in self.handles if not h.cancel.called]
+
+    def advance(self, seconds):
+        self.now += seconds
+        due = [h for h in self.handles if h.when <= self.now and not h.cancel.called]
+        self.handles = [h for h in self.handles if h not in due]
+        for handle in due:
+            handle.func(*handle.args)
+
+
+class TestClocks(object):
+
+    def test_twisted_clock_uses_reactor(self):
+        clock = TwistedClock()
+        func = Mock()
+
+        with patch('twisted.internet.reactor') as reactor:
+            reactor.seconds.return_value = 42
+            assert clock.seconds() == 42
+
+            clock.callLater(5, func, 1, foo='bar')
+            reactor.callLater.assert_called_with(5, func, 1, foo='bar')
+
+    def test_scheduler_on_asyncio_clock(self):
+        loop = FakeLoop()
+        scheduler = Scheduler(clock=AsyncioClock(loop), tolerance=1)
+        func = Mock()
+
+        scheduler.schedule_batch('a', 10, func, 'client')
+        scheduler.schedule_batch('b', 10.5, func, 'client')
+        scheduler.schedule('c', 5, func, 'c')
+        assert [h.when for h in loop.live] == [105]
+
+        loop.advance(5)
+        func.assert_called_once_with('c')
+        assert [h.when for h in loop.live] == [110]
+
+        loop.advance(5)
+        func.assert_called_with(['a', 'b'], 'client')
+        assert len(scheduler) == 0
+
+    def test_asyncio_call(self):
+        loop = FakeLoop()
+        call = AsyncioClock(loop).callLater(-1, Mock())
+
+        assert call.getTime() == 100
+        assert call.active()
+
+        call.cancel()
+        assert not call.active()
+        assert loop.handles[0].cancel.called
+
+    def test_real_asyncio_loop(self):
+        asyncio = pytest.importorskip('asyncio')
+        loop = asyncio.new_event_loop()
+        scheduler = Scheduler(clock=AsyncioClock(loop))
+        fired = []
+
+        scheduler.schedule('a', 0.02, fired.append, 'a')
+        scheduler.schedule('b', 0.01, fired.append, 'b')
+        scheduler.schedule('stop', 0.03, loop.stop)
+
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+        assert fired == ['b', 'a']